@@ -0,0 +1,558 @@
+# coding:utf-8
+"""Headless batch downloader for Pixiv and E(x)hentai, without Qt."""
+import argparse
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from urllib3 import Retry
+
+from modules import core, database, ehentai, jobs, pixiv, transfer
+
+EXIT_OK = 0  # Every page is downloaded or owned
+EXIT_FAILED = 1  # Some pages or targets failed
+EXIT_USAGE = 2  # Wrong arguments, the same as argparse
+EXIT_AUTH = 3  # Cookies or password are rejected
+EXIT_BANNED = 4  # IP is banned or download limitation is reached, the rest is cancelled
+EXIT_INTERRUPTED = 130
+
+_RE_USER = re.compile(r'(?:/users/|member(?:_illust)?\.php\?id=)(\d+)')
+_RE_ILLUST = re.compile(r'(?:/artworks/|illust_id=)(\d+)')
+_RETRIES = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+_THROTTLE_PAUSE = 60  # Seconds a site is left after status 403 or 429
+_LIMIT_PAUSE = 3600  # Seconds ehentai is left after the download limitation is reached
+_print_lock = threading.Lock()
+
+
+def emit(event: str, **fields):
+    """Print one progress event as a JSON line."""
+    line = json.dumps(dict(fields, event=event, time=round(time.time(), 3)), ensure_ascii=False)
+    with _print_lock:
+        print(line, flush=True)
+
+
+def read_targets(targets: list, input_file: str = None) -> list:
+    """Merge targets of command line and of a file ('-' for stdin), one per line, '#' for comments."""
+    targets = list(targets)
+    if input_file:
+        with (sys.stdin if input_file == '-' else open(input_file, encoding='utf-8')) as lines:
+            targets.extend(line.split('#', 1)[0].strip() for line in lines)
+    return [target for target in targets if target]
+
+
+def read_cookies(value: str) -> str:
+    """Cookies string, or the content of a file if value starts with '@'."""
+    if value and value.startswith('@'):
+        with open(value[1:], encoding='utf-8') as cookies:
+            return cookies.read().strip()
+    return value
+
+
+def new_session(tab: str, workers: int):
+    """Session with the same pools and rate limits as the GUI, where the limits use their defaults."""
+    se = requests.Session()
+    site = pixiv if tab == 'pixiv' else ehentai
+    transfer.mount_pools(se, site.pools(workers), workers + 1, Retry(total=3, backoff_factor=0.2))
+    for site, rate, burst in ((pixiv, 5.0, 10), (ehentai, 2.0, 5)):
+        transfer.rate_limiter.configure('request', site.RATE_HOSTS['request'], rate, burst)
+    return se
+
+
+class Runner(object):
+    """Download pages on a thread pool, retry connection errors and count results."""
+
+    def __init__(self, workers: int, retries: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.counts = {'done': 0, 'skipped': 0, 'failed': 0, 'cancelled': 0}
+        self.pending = 0
+        self.idle = threading.Condition(self.lock)
+        self.banned = None
+
+    def submit(self, fields: dict, fn, *args):
+        """Run fn(*args) in pool. fields identify the page in progress events."""
+        with self.lock:
+            if self.banned:
+                return
+            self.pending += 1
+        self.executor.submit(self._run, fields, 0, fn, *args)
+
+    def _run(self, fields: dict, attempt: int, fn, *args):
+        if self.banned:
+            self._finish(fields, 'cancelled')
+            return
+        try:
+            stats = fn(*args)
+        except _RETRIES as e:
+            if attempt < self.retries:  # Still pending
+                emit('retry', attempt=attempt + 1, error=repr(e), **fields)
+                self.executor.submit(self._run, fields, attempt + 1, fn, *args)
+            else:
+                self._finish(fields, 'failed', error=repr(e))
+        except (core.IPBannedError, core.LimitationReachedError) as e:
+            self.banned = e
+            self._finish(fields, 'failed', error=repr(e))
+        except Exception as e:  # Count anything else as a failed page, so wait() returns
+            self._finish(fields, 'failed', error=repr(e))
+        else:
+            if stats:
+                self._finish(fields, 'done', bytes=stats.size, seconds=round(stats.seconds, 3))
+            else:
+                self._finish(fields, 'skipped')
+
+    def _finish(self, fields: dict, status: str, **extra):
+        emit('page', status=status, **dict(fields, **extra))
+        with self.lock:
+            self.counts[status] += 1
+            self.pending -= 1
+            self.idle.notify_all()
+
+    def skip(self, fields: dict):
+        emit('page', status='skipped', **fields)
+        with self.lock:
+            self.counts['skipped'] += 1
+
+    def wait(self):
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+        self.executor.shutdown()
+
+
+def run_pixiv(args, runner: Runner) -> int:
+    se = new_session('pixiv', args.workers)
+    pixiv.login(se, read_cookies(args.cookies))
+    try:
+        user_id, user_name = pixiv.get_user(se, args.proxy)
+    except (requests.exceptions.RequestException, core.ResponseError) as e:
+        emit('error', site='pixiv', error=repr(e))
+        return EXIT_AUTH
+    emit('login', site='pixiv', user=user_id, name=user_name)
+
+    failed = 0
+    pids = []
+    owners = {}  # {pid: user id} of works listed by user targets, so their details are fetched in batches
+    if args.new is not None:
+        pids.extend(pixiv.get_new(se, args.proxy, num=args.new))
+    for target in read_targets(args.targets, args.input):
+        user = _RE_USER.search(target)
+        illust = _RE_ILLUST.search(target)
+        try:
+            if user or (args.users and target.isdigit()):
+                uid = user.group(1) if user else target
+                works = pixiv.get_new(se, args.proxy, user_id=uid)
+                emit('target', site='pixiv', user=uid, works=len(works))
+                pids.extend(works)
+                owners.update((pid, uid) for pid in works)
+            elif illust or target.isdigit():
+                pids.append(illust.group(1) if illust else target)
+            else:
+                emit('error', site='pixiv', target=target, error='Unknown target')
+                failed += 1
+        except (requests.exceptions.RequestException, core.ResponseError) as e:
+            emit('error', site='pixiv', target=target, error=repr(e))
+            failed += 1
+
+    hits, misses, _ = pixiv.fetch_many(pids)
+    items = list(hits.values())
+    groups = {}
+    for pid in misses:
+        groups.setdefault(owners.get(pid), []).append(pid)
+    fetched = []
+    for uid, group in groups.items():
+        fetched.extend(pixiv.fetch_details(se, group, args.proxy, ignore_errors=True, user_id=uid))
+    pixiv.pusher(fetched)
+    items.extend(fetched)
+    failed += len(set(misses) - {item['illustId'] for item in items})
+
+    folder_rule = dict(enumerate(args.folder_rule.split(',')))
+    file_rule = dict(enumerate(args.file_rule.split(',')))
+    for item in items:
+        path = pixiv.path_name(item, args.root, folder_rule, file_rule)
+        for page in range(int(item['pageCount'])):
+            fields = {'site': 'pixiv', 'id': item['illustId'], 'page': page}
+            if pixiv.page_owned(path, page):
+                runner.skip(fields)
+            else:
+                runner.submit(fields, pixiv.download_pic, se, args.proxy, item, path, page)
+    runner.wait()
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def run_ehentai(args, runner: Runner) -> int:
+    se = new_session('ehentai', args.workers)
+    try:
+        if args.username:
+            ehentai.login(se, args.proxy, args.username, args.password)
+        else:
+            ehentai.login_cookies(se, read_cookies(args.cookies))
+        used, limit = ehentai.account_info(se, args.proxy)
+    except core.IPBannedError as e:
+        emit('error', site='ehentai', error=repr(e))
+        return EXIT_BANNED
+    except (requests.exceptions.RequestException, core.ResponseError, core.ValidationError) as e:
+        emit('error', site='ehentai', error=repr(e))
+        return EXIT_AUTH
+    emit('login', site='ehentai', used=used, limit=limit)
+
+    failed = 0
+    for addr in read_targets(args.targets, args.input):
+        if runner.banned:
+            break
+        try:
+            info = ehentai.information(se, args.proxy, addr)
+            keys = ehentai.fetch_keys(se, args.proxy, info)
+        except core.IPBannedError as e:
+            runner.banned = e
+            emit('error', site='ehentai', target=addr, error=repr(e))
+            break
+        except (requests.exceptions.RequestException, core.ResponseError) as e:
+            emit('error', site='ehentai', target=addr, error=repr(e))
+            failed += 1
+            continue
+        emit('target', site='ehentai', target=addr, name=info['name'], pages=int(info['page']))
+        for page in range(1, int(info['page']) + 1):
+            fields = {'site': 'ehentai', 'id': addr, 'page': page}
+            if not args.rewrite and ehentai.page_owned(info, page, args.root, args.rename):
+                runner.skip(fields)
+            else:
+                runner.submit(fields, ehentai.download, se, args.proxy, info, keys, page, args.root,
+                              args.rename, args.rewrite)
+    runner.wait()
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def add_jobs(args) -> int:
+    """Queue targets for the service, with save options of the command line."""
+    queue = jobs.get()
+    options = {'root': os.path.abspath(args.root)}
+    if args.kind == 'ehentai':
+        options.update(rename=args.rename, rewrite=args.rewrite)
+    else:
+        options.update(folder_rule=args.folder_rule, file_rule=args.file_rule)
+    failed = 0
+    if args.following:  # Stream users to the queue page by page
+        se = new_session('pixiv', args.workers)
+        pixiv.login(se, read_cookies(args.following))
+        try:
+            account, _ = pixiv.get_user(se, args.proxy)
+            for users in pixiv.iter_following(se, args.proxy, account, workers=args.workers):
+                for uid, name in users:
+                    emit('queued', site='pixiv_user', target=uid, name=name, job=queue.add('pixiv_user', uid, options))
+        except (requests.exceptions.RequestException, core.ResponseError) as e:
+            emit('error', site='pixiv', target='following', error=repr(e))
+            failed += 1
+    for target in read_targets(args.targets, args.input):
+        if args.kind == 'ehentai':
+            site, target = 'ehentai', target.rstrip('/') + '/'
+        else:
+            user = _RE_USER.search(target)
+            illust = _RE_ILLUST.search(target)
+            if user or (args.kind == 'pixiv_user' and target.isdigit()):
+                site, target = 'pixiv_user', user.group(1) if user else target
+            elif illust or target.isdigit():
+                site, target = 'pixiv', illust.group(1) if illust else target
+            else:
+                emit('error', site='pixiv', target=target, error='Unknown target')
+                failed += 1
+                continue
+        emit('queued', site=site, target=target, job=queue.add(site, target, options))
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+class Service(object):
+    """
+    Long-running worker of jobs.JobQueue. Pages are claimed before jobs to be
+    expanded, so downloads go on while new targets wait. Several services may
+    share one jobs.db, each holding leases renewed by a heartbeat thread.
+    """
+
+    def __init__(self, sessions: dict, args):
+        self.queue = jobs.get()
+        self.sessions = sessions  # {site: session}, sites without a session are not claimed
+        self.proxy = args.proxy
+        self.lease = args.lease
+        self.poll = args.poll
+        self.once = args.once
+        self.owner = jobs.owner_name()
+        self.stop = threading.Event()
+        self.finished = threading.Event()  # Set when no page is in progress, so leases are no longer renewed
+        self.lock = threading.Lock()
+        self.paused = {}  # {site: time when claiming is resumed}
+        self.counts = {'done': 0, 'skipped': 0, 'retry': 0, 'failed': 0}
+
+    def sites(self) -> list:
+        now = time.time()
+        with self.lock:
+            return [site for site in self.sessions if self.paused.get(site, 0) <= now]
+
+    def pause(self, site: str, seconds: float):
+        """Stop claiming a site, in this process and others sharing the queue."""
+        with self.lock:
+            self.paused[site] = max(self.paused.get(site, 0), time.time() + seconds)
+        self.queue.delay(site, seconds)
+        emit('paused', site=site, seconds=seconds)
+
+    def heartbeat(self):
+        while not self.finished.wait(self.lease / 3):
+            self.queue.renew(self.owner, self.lease)
+
+    def work(self):
+        while not self.stop.is_set():
+            sites = self.sites()
+            tasks = self.queue.claim_pages(self.owner, sites, 1, self.lease) if sites else []
+            if tasks:
+                self.run_page(tasks[0])
+                continue
+            job = self.queue.claim_job(self.owner, sites, self.lease) if sites else None
+            if job:
+                self.expand(job)
+            elif self.once and self.queue.idle():
+                self.stop.set()
+            else:
+                self.stop.wait(self.poll)
+
+    def expand(self, job: dict):
+        """Fetch information of a job and queue its pages."""
+        site, target = job['site'], job['target']
+        se = self.sessions[site]
+        try:
+            if site == 'pixiv_user':
+                works = sorted(pixiv.get_new(se, self.proxy, user_id=target), key=int)
+                self.queue.expand(job['id'], {'works': len(works)}, children=(('pixiv', pid) for pid in works))
+                emit('job', job=job['id'], site=site, target=target, works=len(works))
+                return
+            if site == 'pixiv':
+                hits, misses, _ = pixiv.fetch_many([target])
+                items = list(hits.values()) or list(pixiv.fetch_details(se, misses, self.proxy))
+                pixiv.pusher(items)
+                if not items:
+                    raise core.ResponseError('No such illust: ' + target)
+                data, pages = items[0], range(int(items[0]['pageCount']))
+            else:
+                info = ehentai.information(se, self.proxy, target)
+                data = {'info': info, 'keys': ehentai.fetch_keys(se, self.proxy, info)}
+                pages = range(1, int(info['page']) + 1)
+        except core.IPBannedError as e:
+            self.queue.postpone(job['id'], None, e.seconds)
+            self.pause(site, e.seconds)
+        except (core.WrongAddressError, core.ResponseError) as e:
+            self.queue.fail_job(job['id'], repr(e), retry=False)
+            emit('job', job=job['id'], site=site, target=target, status='failed', error=repr(e))
+        except Exception as e:
+            self.queue.fail_job(job['id'], repr(e))
+            emit('job', job=job['id'], site=site, target=target, status='retry', error=repr(e))
+        else:
+            self.queue.expand(job['id'], data, pages)
+            emit('job', job=job['id'], site=site, target=target, pages=len(pages))
+
+    def run_page(self, task: dict):
+        site, data, options = task['site'], task['data'], task['options']
+        fields = {'site': site, 'job': task['job'], 'page': task['page']}
+        se = self.sessions[site]
+        try:
+            if site == 'pixiv':
+                path = pixiv.path_name(data, options['root'],
+                                       dict(enumerate(options['folder_rule'].split(','))),
+                                       dict(enumerate(options['file_rule'].split(','))))
+                stats = pixiv.download_pic(se, self.proxy, data, path, task['page'])
+            else:
+                stats = ehentai.download(se, self.proxy, data['info'], data['keys'], task['page'], options['root'],
+                                         options['rename'], options['rewrite'])
+        except core.IPBannedError as e:
+            self.queue.postpone(task['job'], task['page'], e.seconds)
+            self.pause(site, e.seconds)
+        except core.LimitationReachedError:
+            self.queue.postpone(task['job'], task['page'], _LIMIT_PAUSE)
+            self.pause(site, _LIMIT_PAUSE)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (403, 429):  # Throttled
+                self.queue.postpone(task['job'], task['page'], _THROTTLE_PAUSE)
+                self.pause(site, _THROTTLE_PAUSE)
+            else:
+                self._fail(fields, e)
+        except Exception as e:
+            self._fail(fields, e)
+        else:
+            self.queue.finish_page(task['job'], task['page'])
+            if stats:
+                self._count('done', fields, bytes=stats.size, seconds=round(stats.seconds, 3))
+            else:
+                self._count('skipped', fields)
+
+    def _fail(self, fields: dict, error: Exception):
+        attempts = self.queue.fail_page(fields['job'], fields['page'], repr(error))
+        self._count('failed' if attempts >= self.queue.max_attempts else 'retry', fields,
+                    attempt=attempts, error=repr(error))
+
+    def _count(self, status: str, fields: dict, **extra):
+        emit('page', status=status, **dict(fields, **extra))
+        with self.lock:
+            self.counts[status] += 1
+
+    def run(self, workers: int):
+        threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        threads.append(threading.Thread(target=self.heartbeat, daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads[:-1]:
+                while thread.is_alive():  # Join with timeout, so KeyboardInterrupt is raised here
+                    thread.join(0.5)
+        finally:  # Pages in progress are finished before the database is closed, the others are given back at once
+            self.stop.set()
+            try:
+                for thread in threads[:-1]:
+                    while thread.is_alive():  # Interrupt again to give back pages in progress too
+                        thread.join(0.5)
+            finally:
+                self.finished.set()
+                self.queue.release(self.owner)
+
+
+def serve(args) -> int:
+    sessions = {}
+    if args.pixiv_cookies:
+        se = new_session('pixiv', args.workers)
+        pixiv.login(se, read_cookies(args.pixiv_cookies))
+        try:
+            user_id, user_name = pixiv.get_user(se, args.proxy)
+        except (requests.exceptions.RequestException, core.ResponseError) as e:
+            emit('error', site='pixiv', error=repr(e))
+            return EXIT_AUTH
+        emit('login', site='pixiv', user=user_id, name=user_name)
+        sessions['pixiv'] = sessions['pixiv_user'] = se
+    if args.ehentai_cookies:
+        se = new_session('ehentai', args.workers)
+        ehentai.login_cookies(se, read_cookies(args.ehentai_cookies))
+        try:
+            used, limit = ehentai.account_info(se, args.proxy)
+        except core.IPBannedError as e:
+            emit('error', site='ehentai', error=repr(e))
+            return EXIT_BANNED
+        except (requests.exceptions.RequestException, core.ResponseError, core.ValidationError) as e:
+            emit('error', site='ehentai', error=repr(e))
+            return EXIT_AUTH
+        emit('login', site='ehentai', used=used, limit=limit)
+        sessions['ehentai'] = se
+
+    service = Service(sessions, args)
+    signal.signal(signal.SIGTERM, lambda *_: service.stop.set())
+    emit('serve', owner=service.owner, sites=sorted(sessions), **service.queue.summary())
+    try:
+        service.run(args.workers)
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    finally:
+        emit('stopped', owner=service.owner, **dict(service.counts, **service.queue.summary()))
+    return EXIT_FAILED if service.counts['failed'] else EXIT_OK
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Download from Pixiv and E(x)hentai without GUI. '
+                                                 'Progress is printed as JSON lines.')
+    parser.add_argument('--root', default='.', help='save root path (default: current directory)')
+    parser.add_argument('--workers', type=int, default=3, help='pages downloaded at the same time (default: 3)')
+    parser.add_argument('--retries', type=int, default=3, help='retries of a page on connection errors')
+    parser.add_argument('--proxy', help='proxy address like http://127.0.0.1:1080, for both http and https')
+    parser.add_argument('-i', '--input', help="file of targets, one per line, '-' for stdin")
+    sites = parser.add_subparsers(dest='command', required=True)
+
+    px = sites.add_parser('pixiv', help='illust ids, user ids or their urls')
+    px.add_argument('targets', nargs='*', help='illust id or url, or user url')
+    px.add_argument('--cookies', required=True, help="cookies copied from browser, or '@file'")
+    px.add_argument('--users', action='store_true', help='take bare numbers as user ids')
+    px.add_argument('--new', type=int, metavar='N', help="also download N new works of following, 0 for all")
+    px.add_argument('--folder-rule', default='userId', help='folder names by fields, comma separated')
+    px.add_argument('--file-rule', default='illustId', help='file name by fields, comma separated')
+
+    eh = sites.add_parser('ehentai', help='gallery urls')
+    eh.add_argument('targets', nargs='*', help='gallery url')
+    login = eh.add_mutually_exclusive_group(required=True)
+    login.add_argument('--cookies', help="cookies copied from browser, or '@file'")
+    login.add_argument('--username', help='login by username, with --password')
+    eh.add_argument('--password', help='password of --username')
+    eh.add_argument('--rename', action='store_true', help='name pictures by page number')
+    eh.add_argument('--rewrite', action='store_true', help='overwrite owned pictures')
+
+    qu = sites.add_parser('queue', help='queue targets for serve, or show and retry the queue')
+    actions = qu.add_subparsers(dest='action', required=True)
+    add = actions.add_parser('add', help='queue targets with save options of this command line')
+    add.add_argument('kind', choices=('pixiv', 'pixiv_user', 'ehentai'),
+                     help="pixiv_user takes bare numbers as user ids")
+    add.add_argument('targets', nargs='*', help='ids or urls')
+    add.add_argument('--following', metavar='COOKIES',
+                     help="with pixiv_user, also queue every user followed by the account of cookies, or '@file'")
+    add.add_argument('--folder-rule', default='userId', help='folder names by fields, comma separated')
+    add.add_argument('--file-rule', default='illustId', help='file name by fields, comma separated')
+    add.add_argument('--rename', action='store_true', help='name pictures by page number')
+    add.add_argument('--rewrite', action='store_true', help='overwrite owned pictures')
+    actions.add_parser('status', help='numbers of jobs and pages by state')
+    actions.add_parser('retry', help='queue failed jobs and pages again')
+
+    sv = sites.add_parser('serve', help='download queued pages until stopped, resuming unfinished ones')
+    sv.add_argument('--pixiv-cookies', help="cookies of pixiv, or '@file'; pixiv jobs are left if not given")
+    sv.add_argument('--ehentai-cookies', help="cookies of e(x)hentai, or '@file'")
+    sv.add_argument('--lease', type=float, default=jobs.LEASE,
+                    help='seconds before pages of a dead worker are claimable again (default: %(default)s)')
+    sv.add_argument('--poll', type=float, default=5, help='seconds between checks of an empty queue')
+    sv.add_argument('--once', action='store_true', help='exit when the queue is empty')
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve' and not (args.pixiv_cookies or args.ehentai_cookies):
+        parser.error('serve requires --pixiv-cookies or --ehentai-cookies')
+    if args.command == 'queue' and args.action == 'add' and args.following and args.kind != 'pixiv_user':
+        parser.error('--following requires pixiv_user')
+    if args.command == 'ehentai' and args.username and not args.password:
+        parser.error('--username requires --password')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    args.proxy = {'http': args.proxy, 'https': args.proxy} if args.proxy else {}
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    pixiv.init_db()
+    if args.command == 'queue':
+        try:
+            if args.action == 'add':
+                return add_jobs(args)
+            if args.action == 'retry':
+                emit('retry', count=jobs.get().retry_failed())
+            emit('status', **jobs.get().summary())
+            return EXIT_OK
+        finally:
+            database.close_all()
+    if args.command == 'serve':
+        try:
+            return serve(args)
+        finally:
+            database.close_all()
+    runner = Runner(args.workers, args.retries)
+    begin = time.perf_counter()
+    try:
+        code = run_pixiv(args, runner) if args.command == 'pixiv' else run_ehentai(args, runner)
+    except KeyboardInterrupt:
+        runner.banned = KeyboardInterrupt()  # Cancel queued pages
+        code = EXIT_INTERRUPTED
+    finally:
+        runner.executor.shutdown()  # Wait for pages in progress, they still use the database
+        database.close_all()
+    if runner.banned and code != EXIT_INTERRUPTED:
+        code = EXIT_BANNED
+    elif code == EXIT_OK and runner.counts['failed']:
+        code = EXIT_FAILED
+    emit('summary', seconds=round(time.perf_counter() - begin, 3), exit=code, **runner.counts)
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,12 +7,11 @@ from multiprocessing import freeze_support
 
 import requests
 from PyQt5.QtCore import QSettings, QCoreApplication
-from PyQt5.QtGui import QFont, QGuiApplication, QIcon
+from PyQt5.QtGui import QFont, QGuiApplication, QIcon, QPixmapCache
 from PyQt5.QtWidgets import QAction, QApplication, QMainWindow, QTabWidget, QMessageBox
-from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
-from modules import globj, pixiv_gui, pixiv, ehentai_gui
+from modules import globj, pixiv_gui, pixiv, ehentai, ehentai_gui, database, library, thumbs, transfer
 
 
 class MainWindow(QMainWindow):
@@ -46,6 +45,14 @@ class MainWindow(QMainWindow):
         self.misc_setting.closed.connect(self.misc_setting_checker)
         self.rule_setting = globj.SaveRuleDialog()
 
+        self.rate_limit_checker()
+        self.thumb_cache_checker()
+        QPixmapCache.setCacheLimit(globj.THUMB_MEMORY)
+        pixiv.init_db()  # Set up database schema once at startup
+        self.settings.beginGroup('RuleSetting')
+        library.get().scan_async([self.settings.value('pixiv_root_path', ''),
+                                  self.settings.value('ehentai_root_path', '')])  # Refresh skip index in background
+        self.settings.endGroup()
         self.init_ui()
 
     def init_ui(self):
@@ -78,23 +85,29 @@ class MainWindow(QMainWindow):
         self.setWindowTitle('PETSpider')
         self.show()
 
-    def init_var(self):
+    def init_var(self, tab: str):
         """
         Construct global instances for every class.
+        Args:
+            tab: 'pixiv' or 'ehentai', whose hosts get sized connection pools.
         Return:
             A globj.GlobalVar class instance, should be
             passed to construct func of every modal.
         """
         session = requests.Session()
-        retries = Retry(total=3, backoff_factor=0.2)
-        adp = HTTPAdapter(max_retries=retries)
-        session.mount('http://', adp)
-        session.mount('https://', adp)
         self.settings.beginGroup('MiscSetting')
         proxy = self.settings.value('proxy', {})
+        dl_sametime = int(self.settings.value('dl_sametime', 3))
         self.settings.endGroup()
+        self.mount_pools(session, tab, dl_sametime)
         return globj.GlobalVar(session, proxy, bundle_dir)
 
+    @staticmethod
+    def mount_pools(session, tab: str, dl_sametime: int):
+        """Mount connection pools following the download concurrency."""
+        site = pixiv if tab == 'pixiv' else ehentai
+        transfer.mount_pools(session, site.pools(dl_sametime), dl_sametime + 1, Retry(total=3, backoff_factor=0.2))
+
     def tab_logout(self, tab: str, info=None):
         """Switch tab widget to main page."""
         if tab == 'pixiv':
@@ -115,14 +128,14 @@ class MainWindow(QMainWindow):
         """Switch tab widget to login page."""
         if tab == 'pixiv':
             # Recreate glovar instance bacause old session contains old cookies
-            self.pixiv_var = self.init_var()
+            self.pixiv_var = self.init_var('pixiv')
             self.pixiv_login = pixiv_gui.LoginWidget(self.pixiv_var)
             self.pixiv_login.login_success.connect(self.tab_logout)
             self.tab_widget.removeTab(0)
             self.tab_widget.insertTab(0, self.pixiv_login, self.pixiv_icon, 'Pixiv')
             self.tab_widget.setCurrentIndex(0)
         if tab == 'ehentai':
-            self.ehentai_var = self.init_var()
+            self.ehentai_var = self.init_var('ehentai')
             self.ehentai_login = ehentai_gui.LoginWidget(self.ehentai_var)
             self.ehentai_login.login_success.connect(self.tab_logout)
             self.tab_widget.removeTab(1)
@@ -149,8 +162,11 @@ class MainWindow(QMainWindow):
         setting.show()
 
     def misc_setting_checker(self):
-        """Make the proxy and thumbnail setting active immediately."""
+        """Make the proxy, concurrency and thumbnail setting active immediately."""
         self.settings.beginGroup('MiscSetting')
+        dl_sametime = int(self.settings.value('dl_sametime', 3))
+        self.mount_pools(self.pixiv_var.session, 'pixiv', dl_sametime)
+        self.mount_pools(self.ehentai_var.session, 'ehentai', dl_sametime)
         if int(self.settings.value('pixiv_proxy', False)):
             self.pixiv_var.proxy = self.settings.value('proxy', {})
         else:
@@ -161,11 +177,33 @@ class MainWindow(QMainWindow):
         else:
             self.ehentai_var.proxy = {}
 
+        dl_min = int(self.settings.value('dl_min', 1))
         setting_thumbnail = int(self.settings.value('thumbnail', True))
-        if self.pixiv_main:  # Change thumbnail behavior
+        if self.pixiv_main:  # Change thumbnail behavior and concurrency bounds
             self.pixiv_main.change_thumb_state(setting_thumbnail)
+            self.pixiv_main.change_concurrency(dl_min, dl_sametime)
         if self.ehentai_main:
             self.ehentai_main.change_thumb_state(setting_thumbnail)
+            self.ehentai_main.change_concurrency(dl_min, dl_sametime)
+        self.settings.endGroup()
+        self.rate_limit_checker()
+        self.thumb_cache_checker()
+
+    def rate_limit_checker(self):
+        """Apply request and bandwidth budgets of every site to the shared rate limiter."""
+        self.settings.beginGroup('RateLimit')
+        for tab, site, rate, burst in (('pixiv', pixiv, 5.0, 10), ('ehentai', ehentai, 2.0, 5)):
+            transfer.rate_limiter.configure('request', site.RATE_HOSTS['request'],
+                                            float(self.settings.value(tab + '_rate', rate)),
+                                            int(self.settings.value(tab + '_burst', burst)))
+            bandwidth = float(self.settings.value(tab + '_bandwidth', 0.0)) * 1e6
+            transfer.rate_limiter.configure('bytes', site.RATE_HOSTS['bytes'], bandwidth, bandwidth)
+        self.settings.endGroup()
+
+    def thumb_cache_checker(self):
+        """Apply the size limit of the thumbnail cache."""
+        self.settings.beginGroup('MiscSetting')
+        thumbs.get().set_cap(int(self.settings.value('thumb_cache', 200)) * 1000 * 1000)
         self.settings.endGroup()
 
     def closeEvent(self, event):
@@ -190,4 +228,6 @@ if __name__ == '__main__':
         bundle_dir = os.path.dirname(os.path.abspath(__file__))
     app = QApplication(sys.argv)
     window = MainWindow()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    database.close_all()
+    sys.exit(exit_code)
@@ -0,0 +1,136 @@
+# coding:utf-8
+"""Global objects without GUI, importable by headless workers."""
+import platform
+import re
+
+_RE_SYMBOL = re.compile(r'[/\\|*?<>":]')
+PLATFORM = platform.system()
+
+
+class GlobalVar(object):
+    user_agent = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:65.0) Gecko/20100101 Firefox/65.0',
+                  ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                   'Chrome/73.0.3683.86 Safari/537.36'),
+                  ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                   'Chrome/64.0.3282.140 Safari/537.36 Edge/18.17763'))
+
+    def __init__(self, session, proxy: dict, home: str):
+        self._session = session
+        self._proxy = proxy
+        self._home = home
+
+    @property
+    def session(self):
+        return self._session
+
+    @session.deleter
+    def session(self):
+        self._session.close()
+
+    @property
+    def proxy(self):
+        return self._proxy
+
+    @proxy.setter
+    def proxy(self, new: dict):
+        self._proxy = new
+
+    @property
+    def home(self):
+        return self._home
+
+    @home.setter
+    def home(self, new: str):
+        self._home = new
+
+
+class ResponseError(Exception):
+    """Exception for abnormal response."""
+
+    def __init__(self, msg):
+        super().__init__(msg)  # Keep args, so that it is picklable from worker processes
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class IPBannedError(ResponseError):
+    """Exception for IP banned in e-hentai."""
+
+    def __init__(self, h, m, s):
+        super().__init__('IP address has been temporarily banned.')
+        self.args = (h, m, s)
+        self.h = h
+        self.m = m
+        self.s = s
+
+    @property
+    def seconds(self) -> int:
+        """Seconds before the ban is lifted."""
+        return int(self.h) * 3600 + int(self.m) * 60 + int(self.s)
+
+
+class LimitationReachedError(ResponseError):
+    """Exception for limitation has reached."""
+
+    def __init__(self, page):
+        super().__init__(page)
+
+
+class WrongAddressError(ResponseError):
+    """Exception for providing wrong address."""
+
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class ValidationError(Exception):
+    """Exception for wrong user-id or password or other error about validation."""
+
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+def name_verify(name: str, default: str = 'NoName') -> str:
+    """
+    Normalize file/folder name.
+    Args:
+        name: A string of file/folder name.
+        default: When the illegal name leads to an empty string, return this.
+    Returns:
+        A legal string for file/folder name.
+    """
+    if PLATFORM == 'Windows':
+        illegal_name = {'con', 'aux', 'nul', 'prn', 'com0', 'com1', 'com2', 'com3', 'com4', 'com5', 'com6', 'com7',
+                        'com8', 'com9', 'lpt0', 'lpt1', 'lpt2', 'lpt3', 'lpt4', 'lpt5', 'lpt6', 'lpt7', 'lpt8', 'lpt9'}
+        step1 = _RE_SYMBOL.sub('', name)  # Remove illegal symbol
+        step2 = step1.strip('.')  # Remove '.' at the beginning and end
+        if step2 in illegal_name or not step2:
+            return default
+        return step2
+    elif PLATFORM == 'Linux':
+        step1 = name.replace('/', '')  # Remove illegal '/'
+        step2 = step1.lstrip('.')  # Remove '.' at the beginning
+        if not step2:
+            return default
+        return step2
+
+
+if __name__ == '__main__':  # Import time of site modules, which must not load PyQt5
+    import subprocess
+    import sys
+
+    for module in ('modules.core', 'modules.pixiv', 'modules.ehentai', 'modules.globj'):
+        code = ('import sys, time; begin = time.perf_counter(); import {0}; '
+                'print("{0}: {{0:.0f}} ms, PyQt5 loaded: {{1}}".format((time.perf_counter() - begin) * 1000, '
+                '"PyQt5" in sys.modules))').format(module)
+        subprocess.run([sys.executable, '-c', code])
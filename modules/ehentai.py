@@ -3,16 +3,17 @@
 import os
 import random
 import re
-from tempfile import NamedTemporaryFile
 
 import requests
 from bs4 import BeautifulSoup
 
-from modules import globj
+from modules import core, library, thumbs, transfer
 
 _LOGIN_URL = 'https://forums.e-hentai.org/index.php'
 _ACCOUNT_URL = 'https://e-hentai.org/home.php'
 _EXHENTAI_URL = 'https://exhentai.org/'
+RATE_HOSTS = {'request': ('e-hentai.org', 'exhentai.org'),  # Host suffixes paced by transfer.rate_limiter
+              'bytes': ('hath.network',)}  # H@H image servers
 
 
 def _ban_checker(html: BeautifulSoup):
@@ -24,21 +25,21 @@ def _ban_checker(html: BeautifulSoup):
         h = match_h.group(1) if match_h else 0
         m = match_m.group(1) if match_m else 0
         s = match_s.group(1) if match_s else 0
-        raise globj.IPBannedError(h, m, s)
+        raise core.IPBannedError(h, m, s)
 
 
 def login(se, proxy: dict, uid: str, pw: str) -> bool:
     """
     Login and set cookies for exhentai.
     Exceptions:
-        globj.ValidationError: Raised when username/pw is wrong, or have no permission to get into exhentai.
-        globj.ResponseError: Raised when server sends abnormal response(include AttributeError).
+        core.ValidationError: Raised when username/pw is wrong, or have no permission to get into exhentai.
+        core.ResponseError: Raised when server sends abnormal response(include AttributeError).
     """
     try:
         with se.post(_LOGIN_URL,
                      params={'act': 'Login', 'CODE': '01'},
                      data={'CookieDate': '1', 'UserName': uid, 'PassWord': pw},
-                     headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                     headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                      proxies=proxy,
                      timeout=5) as login_res:
             login_html = BeautifulSoup(login_res.text, 'lxml')
@@ -47,34 +48,45 @@ def login(se, proxy: dict, uid: str, pw: str) -> bool:
         if login_html.head.title.string == 'Please stand by...':
             with se.get(_EXHENTAI_URL,
                         proxies=proxy,
-                        headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                        headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                         timeout=5) as ex_res:
                 ex_html = BeautifulSoup(ex_res.text, 'lxml')
                 if ex_html.head.title.string == 'ExHentai.org':
                     se.cookies.update(ex_res.cookies)  # Set cookies for exhentai
                     return True
                 else:
-                    raise globj.ValidationError('Login: Cannot get into exhentai.')
+                    raise core.ValidationError('Login: Cannot get into exhentai.')
         elif login_html.head.title.string == 'Log In':
-            raise globj.ValidationError('Login: Incorrect username or password.')
+            raise core.ValidationError('Login: Incorrect username or password.')
         else:
-            raise globj.ResponseError('Login: Abnormal response.')
+            raise core.ResponseError('Login: Abnormal response.')
 
     except requests.Timeout:
         raise requests.Timeout('Login: Timeout.')
     except AttributeError as e:
-        raise globj.ResponseError('Login: ' + repr(e))
+        raise core.ResponseError('Login: ' + repr(e))
+
+
+def login_cookies(se, c: str) -> bool:
+    """Resolve string-like cookies copied from browser and set it to session for both sites."""
+    cookie_jar = requests.cookies.RequestsCookieJar()
+    for item in c.split('; '):
+        name, value = item.split('=', 1)
+        cookie_jar.set(name, value, domain='.e-hentai.org')
+        cookie_jar.set(name, value, domain='.exhentai.org')
+    se.cookies.update(cookie_jar)
+    return True
 
 
 def account_info(se, proxy: dict) -> tuple:
     """
     Get download limitation(used/all).
     Exceptions:
-        globj.ResponseError: Raised when server sends abnormal response.
+        core.ResponseError: Raised when server sends abnormal response.
     """
     try:
         with se.get(_ACCOUNT_URL,
-                    headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                    headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                     proxies=proxy,
                     timeout=5) as info_res:
             info_html = BeautifulSoup(info_res.text, 'lxml')
@@ -84,7 +96,7 @@ def account_info(se, proxy: dict) -> tuple:
             limit = info_node('strong')
             return limit[0].string, limit[1].string
         else:
-            raise globj.ResponseError('Account_info: Abnormal response.')
+            raise core.ResponseError('Account_info: Abnormal response.')
     except requests.Timeout:
         raise requests.Timeout('Account_info: Timeout.')
 
@@ -97,19 +109,19 @@ def information(se, proxy: dict, addr: str) -> dict:
         proxy: (Optional) The proxy used.
         addr: Gallery address.
     Exceptions:
-        globj.ResponseError: Raised when server sends abnormal response.
+        core.ResponseError: Raised when server sends abnormal response.
     """
     re_thumb = re.compile(r'.*url\((.*)\).*')
     try:
         with se.get(addr,
                     params={'inline_set': 'ts_m'},
-                    headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                    headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                     proxies=proxy,
                     timeout=5) as gallery_res:
             gallery_html = BeautifulSoup(gallery_res.text, 'lxml')
         _ban_checker(gallery_html)
         if 'Gallery not found.' in gallery_html.body.get_text() or 'Key missing' in gallery_html.body.get_text():
-            raise globj.WrongAddressError('Wrong address provided.')
+            raise core.WrongAddressError('Wrong address provided.')
         name: str = gallery_html.find('h1', id='gj').string  # Japanese name is prior
         if not name:
             name = gallery_html.find('h1', id='gn').string
@@ -124,12 +136,12 @@ def information(se, proxy: dict, addr: str) -> dict:
                 'thumb': thumb
             }
         else:
-            raise globj.ResponseError('Information: Abnormal response.')
+            raise core.ResponseError('Information: Abnormal response.')
 
     except requests.Timeout:
         raise requests.Timeout('Information: Timeout.')
     except AttributeError as e:
-        raise globj.ResponseError('Information: ' + repr(e))
+        raise core.ResponseError('Information: ' + repr(e))
 
 
 def fetch_keys(se, proxy: dict, info: dict) -> dict:
@@ -142,44 +154,76 @@ def fetch_keys(se, proxy: dict, info: dict) -> dict:
     Return:
         A dictionary. {'page': imgkey, '0': showkey}
     Exceptions:
-        globj.ResponseError: Raised when server sends abnormal response.
+        core.ResponseError: Raised when server sends abnormal response.
     """
+    keys = dict()
+    for p in range(key_pages(info)):
+        keys.update(fetch_imgkeys(se, proxy, info, p))
+    keys['0'] = fetch_showkey(se, proxy, info, keys['1'])
+    return keys
+
+
+def key_pages(info: dict) -> int:
+    """Number of thumbnail pages of a gallery, 40 pictures each."""
+    return int(info['page']) // 40 + 1  # range(0) has no element
+
+
+def fetch_imgkeys(se, proxy: dict, info: dict, p: int) -> dict:
+    """
+    Fetch imgkeys from one thumbnail page of gallery.
+    Args:
+        p: Number of the thumbnail page, from 0 to key_pages(info) - 1.
+    Return:
+        A dictionary. {'page': imgkey}
+    """
+    try:
+        with se.get(info['addr'],
+                    params={'inline_set': 'ts_m', 'p': p},
+                    headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
+                    proxies=proxy,
+                    timeout=5) as gallery_res:
+            return parse_imgkeys(gallery_res.text)
+    except requests.Timeout:
+        raise requests.Timeout('Fetch_keys: Timeout.')
+
+
+def parse_imgkeys(text: str) -> dict:
+    """Parse imgkeys from html of a thumbnail page, the CPU-bound part of fetch_imgkeys()."""
     re_imgkey = re.compile(r'https://exhentai\.org/s/(\w{10})/\d*-(\d{1,4})')
+    keys = dict()
+    try:
+        gallery_html = BeautifulSoup(text, 'lxml')
+        _ban_checker(gallery_html)
+
+        # Fetch imgkey from every picture
+        pics = gallery_html.find_all('div', class_='gdtm')
+        for item in pics:
+            match = re_imgkey.match(item.a['href'])
+            keys[match.group(2)] = match.group(1)
+        return keys
+
+    except AttributeError as e:
+        raise core.ResponseError('Fetch_keys: ' + repr(e))
+
+
+def fetch_showkey(se, proxy: dict, info: dict, imgkey: str) -> str:
+    """Fetch showkey from the first picture, whose imgkey is given."""
     re_showkey = re.compile(r'[\S\s]*showkey="(\w{11})"[\S\s]*')
     gid = info['addr'].split('/')[-3]
-    pn = int(info['page']) // 40 + 1  # range(0) has no element
-    keys = dict()
+    showkey_url = '/'.join(['https://exhentai.org/s', imgkey, gid + '-1'])
     try:
-        for p in range(pn):
-            with se.get(info['addr'],
-                        params={'inline_set': 'ts_m', 'p': p},
-                        headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
-                        proxies=proxy,
-                        timeout=5) as gallery_res:
-                gallery_html = BeautifulSoup(gallery_res.text, 'lxml')
-            _ban_checker(gallery_html)
-
-            # Fetch imgkey from every picture
-            pics = gallery_html.find_all('div', class_='gdtm')
-            for item in pics:
-                match = re_imgkey.match(item.a['href'])
-                keys[match.group(2)] = match.group(1)
-
-        # Fetch showkey from first picture
-        showkey_url = '/'.join(['https://exhentai.org/s', keys['1'], gid + '-1'])
         with se.get(showkey_url,
-                    headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                    headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                     proxies=proxy,
                     timeout=5) as showkey_res:
             showkey_html = BeautifulSoup(showkey_res.text, 'lxml')
         _ban_checker(showkey_html)
-        keys['0'] = re_showkey.match(showkey_html('script')[1].string).group(1)
-        return keys
+        return re_showkey.match(showkey_html('script')[1].string).group(1)
 
     except requests.Timeout:
         raise requests.Timeout('Fetch_keys: Timeout.')
     except AttributeError as e:
-        raise globj.ResponseError('Fetch_keys: ' + repr(e))
+        raise core.ResponseError('Fetch_keys: ' + repr(e))
 
 
 def download(se, proxy: dict, info: dict, keys: dict, page: int, path: str, rename=False, rewrite=False):
@@ -194,11 +238,20 @@ def download(se, proxy: dict, info: dict, keys: dict, page: int, path: str, rena
         path: Save root path.
         rename: Control whether rename to origin name/image number.
         rewrite: Overwrite image instead of skipping it.
+    Return:
+        A transfer.TransferStats instance, or None if the page is owned already.
     Exceptions:
-        globj.ResponseError: Raised when server sends abnormal response.
-        globj.LimitationReachedError: Raised when reach view limitation.
+        core.ResponseError: Raised when server sends abnormal response.
+        core.LimitationReachedError: Raised when reach view limitation.
+        core.IPBannedError: Raised when IP is banned for too many requests.
     """
     gid = info['addr'].split('/')[-3]
+    lib = library.get()
+    if not rewrite:  # Skip owned page before asking for its url
+        owned = page_owned(info, page, path, rename)
+        if owned:
+            print('Skip:', owned)
+            return None
     try:
         with se.post(_EXHENTAI_URL + 'api.php',
                      json={'method': 'showpage',
@@ -206,17 +259,19 @@ def download(se, proxy: dict, info: dict, keys: dict, page: int, path: str, rena
                            'page': int(page),
                            'imgkey': keys[str(page)],
                            'showkey': keys['0']},
-                     headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                     headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                      proxies=proxy,
                      timeout=5) as dl_res:  # Fetch original url of picture
+            if 'Your IP address has been' in dl_res.text:  # Banned for too many requests, not json
+                _ban_checker(BeautifulSoup(dl_res.text, 'lxml'))
             dl_json = dl_res.json()
 
         if dl_json.get('error'):  # Wrong imgkey or showkey
-            raise globj.ResponseError('Download: ' + dl_json['error'])
+            raise core.ResponseError('Download: ' + dl_json['error'])
         if dl_json.get('i3'):  # Whether Reach limitation
             url_html = BeautifulSoup(dl_json['i3'], 'lxml')
             if url_html.a.img['src'] == 'https://exhentai.org/img/509.gif':
-                raise globj.LimitationReachedError(page)
+                raise core.LimitationReachedError(page)
 
         if dl_json.get('i7'):
             url_html = BeautifulSoup(dl_json['i7'], 'lxml')  # Origin image
@@ -225,59 +280,80 @@ def download(se, proxy: dict, info: dict, keys: dict, page: int, path: str, rena
             url_html = BeautifulSoup(dl_json['i3'], 'lxml')  # Showing image is original
             origin = url_html.a.img['src']
         else:
-            raise globj.ResponseError('Download: No plenty elements.')
-
-        folder_name = globj.name_verify(info['name'])
-        folder_path = os.path.join(path, folder_name)
-        try:  # Prevent threads starting at same time
-            os.makedirs(folder_path)
-            print('mkdir:', folder_path)
-        except FileExistsError:
-            pass
+            raise core.ResponseError('Download: No plenty elements.')
+
+        folder_path = os.path.join(path, core.name_verify(info['name']))
+        lib.ensure_dir(folder_path)
         with se.get(origin,
-                    headers={'User-Agent': random.choice(globj.GlobalVar.user_agent)},
+                    headers={'User-Agent': random.choice(core.GlobalVar.user_agent)},
                     proxies=proxy,
                     stream=True,
                     timeout=5) as pic_res:
             url = pic_res.url
             if url.split('/')[2] == 'exhentai.org':  # If response cannot redirect(302), raise exception
-                raise globj.LimitationReachedError(page)
+                raise core.LimitationReachedError(page)
             file_name = os.path.split(pic_res.url)[-1].rstrip('?dl=1')  # Get file name from url
             if rename:
                 file_name = str(page) + os.path.splitext(file_name)[1]
             real_path = os.path.join(folder_path, file_name)
-            if not os.path.exists(real_path) or rewrite:  # If file exists or not rewrite, skip it
-                if os.path.exists(real_path):
-                    os.remove(real_path)
+            if not lib.exists(real_path) or rewrite:  # If file exists or not rewrite, skip it
                 print('Downloading page {0} to {1}'.format(page, real_path))
-                with open(real_path, 'ab') as data:
-                    for chunk in pic_res.iter_content():
-                        data.write(chunk)
-            else:
-                print('Skip:', file_name)
+                header = {'User-Agent': random.choice(core.GlobalVar.user_agent)}
+                try:
+                    stats = transfer.save_response(se, pic_res, real_path, header, proxy)
+                except FileNotFoundError:  # Folder removed after being indexed, nothing of pic_res is read yet
+                    lib.ensure_dir(folder_path, recheck=True)
+                    stats = transfer.save_response(se, pic_res, real_path, header, proxy)
+                print('Downloaded page {0}: {1}'.format(page, stats))
+                lib.add(real_path, page_key(gid, page), stats.digest)
+                return stats
+            print('Skip:', file_name)
+            return None
     except requests.Timeout:
         raise requests.Timeout('Download: Timeout.')
     except AttributeError as e:
-        raise globj.ResponseError('Download: ' + repr(e))
+        raise core.ResponseError('Download: ' + repr(e))
+
+
+def page_key(gid: str, page) -> str:
+    """Library key of a gallery page, since its file name is unknown before fetching its url."""
+    return 'ehentai:{0}:{1}'.format(gid, page)
+
+
+def page_owned(info: dict, page, path: str, rename=False) -> str:
+    """
+    Check the library index for a downloaded page.
+    Args:
+        info: Information of the gallery.
+        page: Page number.
+        path: Save root path.
+        rename: Whether pages are saved as image number.
+    Return:
+        Path of the file if owned, or ''.
+    """
+    lib = library.get()
+    if rename:
+        return lib.find_stem(os.path.join(path, core.name_verify(info['name'])), str(page))
+    return lib.find_key(page_key(info['addr'].split('/')[-3], page))
+
+
+def pools(concurrency: int) -> dict:
+    """
+    Connection pool sizes of exhentai hosts, for transfer.mount_pools().
+    Pictures come from many H@H hosts, each of which gets a default pool.
+    Args:
+        concurrency: Number of pictures downloaded at the same time.
+    """
+    return {_EXHENTAI_URL: concurrency + 1}  # Showpage calls of download threads, and the gallery thread
 
 
 def download_thumb(se, proxy: dict, info: dict) -> str:
-    """Download thumbnail to a temp folder."""
-    header = {'User-Agent': random.choice(globj.GlobalVar.user_agent)}
+    """Download thumbnail into the thumbnail cache, or find it there."""
+    header = {'User-Agent': random.choice(core.GlobalVar.user_agent)}
     try:
-        with se.get(info['thumb'],
-                    headers=header,
-                    proxies=proxy,
-                    stream=True,
-                    timeout=5) as thumb_res:
-            with NamedTemporaryFile('w+b', prefix='PETSpider_', delete=False) as thumb:
-                for chunk in thumb_res.iter_content():
-                    thumb.write(chunk)
-                path = thumb.name
+        return thumbs.get().fetch(se, info['thumb'], header, proxy)
     except (OSError, IOError):
         return ''
-    else:
-        return path
 
 
 if __name__ == '__main__':
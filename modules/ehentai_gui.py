@@ -6,12 +6,12 @@ from functools import partial
 
 import requests
 from PyQt5.QtCore import Qt, QSettings, QThread, pyqtSignal, QThreadPool, QObject, QRunnable
-from PyQt5.QtGui import QPixmap
+from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QFormLayout, QWidget, QGroupBox, QLineEdit, QPushButton,
                              QCheckBox, QLabel, QSplitter, QFileDialog, QFrame, QMessageBox, QTableWidget, QHeaderView,
                              QAbstractItemView, QTableWidgetItem, QSpinBox)
 
-from modules import globj, ehentai
+from modules import globj, ehentai, jobs, library, transfer, workers
 
 
 class LoginWidget(QWidget):
@@ -157,6 +157,9 @@ class VerifyThread(QThread):
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError) as e:
             self.except_signal.emit(self.parent, QMessageBox.Warning, '连接失败', '请检查网络或使用代理。\n' + repr(e))
+        except workers.PoolStoppedError as e:
+            if not self.processes.closed:  # Nothing to report if queue stopped
+                self.except_signal.emit(self.parent, QMessageBox.Critical, '错误', '下载进程异常退出：\n' + repr(e))
         except globj.IPBannedError as e:
             self.except_signal.emit(self.parent, QMessageBox.Critical, 'IP被封禁',
                                     '当前IP已被封禁，将在{0}小时{1}分{2}秒后解封。'.format(e.args[0], e.args[1], e.args[2]))
@@ -185,6 +188,9 @@ class FetchDataThread(QThread):
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError) as e:
             self.except_signal.emit(self.parent, QMessageBox.Warning, '连接失败', '请检查网络或使用代理。\n' + repr(e))
+        except workers.PoolStoppedError as e:
+            if not self.processes.closed:  # Nothing to report if queue stopped
+                self.except_signal.emit(self.parent, QMessageBox.Critical, '错误', '下载进程异常退出：\n' + repr(e))
         except globj.IPBannedError as e:
             self.except_signal.emit(self.parent, QMessageBox.Critical, 'IP被封禁',
                                     '当前IP已被封禁，将在{0}小时{1}分{2}秒后解封。'.format(e.args[0], e.args[1], e.args[2]))
@@ -205,7 +211,8 @@ class DownloadSignals(QObject):
 
 
 class DownloadPicThread(QRunnable):
-    def __init__(self, parent, sess, proxy, info: dict, keys: dict, page: int, path: str, rename=False, rewrite=False):
+    def __init__(self, parent, sess, proxy, info: dict, keys: dict, page: int, path: str, controller,
+                 rename=False, rewrite=False, processes=None):
         super().__init__()
         self.parent = parent
         self.sess = sess
@@ -214,21 +221,41 @@ class DownloadPicThread(QRunnable):
         self.keys = keys
         self.path = path
         self.page = page
+        self.controller = controller
         self.rn = rename
         self.rw = rewrite
+        self.processes = processes  # A workers.ProcessPool in multiprocess mode
         self.signals = DownloadSignals()
 
     def run(self):  # Only do retrying when connection error occurs
         try:
-            ehentai.download(self.sess, self.proxy, self.info, self.keys, self.page, self.path, self.rn, self.rw)
+            if self.processes:
+                stats = self.processes.download(self.info, self.keys, self.page, self.path, self.rn, self.rw)
+            else:
+                stats = ehentai.download(self.sess, self.proxy, self.info, self.keys, self.page, self.path,
+                                         self.rn, self.rw)
         except (requests.exceptions.ProxyError,
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError,
                 requests.exceptions.ChunkedEncodingError) as e:
+            self.controller.failure()
             self.signals.retry_signal.emit(self.info, self.keys, self.path, self.rn, True, repr(e))
+        except workers.PoolStoppedError as e:
+            if self.processes.closed:  # Queue stopped, counted down like a retry
+                self.signals.retry_signal.emit(self.info, self.keys, self.path, self.rn, True, repr(e))
+            else:
+                self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '错误',
+                                                '下载进程异常退出：\n' + repr(e))
+        except globj.IPBannedError as e:
+            self.controller.ban()
+            self.signals.except_signal.emit(self.parent, QMessageBox.Critical, 'IP被封禁',
+                                            '当前IP已被封禁，将在{0}小时{1}分{2}秒后解封。'.format(e.h, e.m, e.s))
         except globj.LimitationReachedError:
             self.signals.except_signal.emit(self.parent, QMessageBox.Warning, '警告',
                                             '当前IP已达下载限额，请更换代理IP。')
+        except requests.exceptions.HTTPError as e:
+            self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '下载失败',
+                                            '服务器返回错误：\n' + repr(e))
         except (FileNotFoundError, PermissionError) as e:
             self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '错误',
                                             '文件系统错误：\n' + repr(e))
@@ -236,43 +263,53 @@ class DownloadPicThread(QRunnable):
             self.signals.except_signal.emit(self.parent, QMessageBox.Critical,
                                             '未知错误', '返回值错误，请向开发者反馈\n{0}'.format(repr(e)))
         else:
+            if stats:
+                self.controller.success(stats)
             self.signals.download_success.emit(self.info, self.keys, self.page, self.path, self.rn, self.rw)
 
 
 class DownloadThumbThread(QThread):
-    download_success = pyqtSignal(dict)
+    download_success = pyqtSignal(dict, QImage)
 
-    def __init__(self, session, proxy, info):
+    def __init__(self, session, proxy, info, size):
         super().__init__()
         self.session = session
         self.proxy = proxy
         self.info = info
+        self.size = size
 
     def run(self):
         path = ehentai.download_thumb(self.session, self.proxy, self.info)
         if path:
             self.info['thumb_path'] = path
-            self.download_success.emit(self.info)
+            self.download_success.emit(self.info, globj.load_thumb(path, self.size))  # Decoded off GUI thread
 
 
 class FetchKeyThread(QThread):
     fetch_success = pyqtSignal(dict, dict)
     except_signal = pyqtSignal(object, int, str, str)
 
-    def __init__(self, parent, session, proxy: dict, info: dict):
+    def __init__(self, parent, session, proxy: dict, info: dict, processes=None):
         super().__init__()
         self.parent = parent
         self.session = session
         self.proxy = proxy
         self.info = info
+        self.processes = processes
 
     def run(self):
         try:
-            keys = ehentai.fetch_keys(self.session, self.proxy, self.info)
+            if self.processes:  # Thumbnail pages are parsed by all worker processes
+                keys = self.processes.fetch_keys(self.info)
+            else:
+                keys = ehentai.fetch_keys(self.session, self.proxy, self.info)
         except (requests.exceptions.ProxyError,
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError) as e:
             self.except_signal.emit(self.parent, QMessageBox.Warning, '连接失败', '请检查网络或使用代理。\n' + repr(e))
+        except workers.PoolStoppedError as e:
+            if not self.processes.closed:  # Nothing to report if queue stopped
+                self.except_signal.emit(self.parent, QMessageBox.Critical, '错误', '下载进程异常退出：\n' + repr(e))
         except globj.IPBannedError as e:
             self.except_signal.emit(self.parent, QMessageBox.Critical, 'IP被封禁',
                                     '当前IP已被封禁，将在{0}小时{1}分{2}秒后解封。'.format(e.args[0], e.args[1], e.args[2]))
@@ -301,7 +338,9 @@ class MainWidget(QWidget):
         self.current_line = dict()  # Save current downloading line
         self.que_dict = dict()  # Save all items in the queue, the key is addr
         self.remain = set()  # Save remaining/unsuccessful pages
-        self.thread_pool = QThreadPool.globalInstance()
+        self.jobs = jobs.get()  # Unfinished galleries of the queue, restored after a restart
+        self.thread_pool = QThreadPool(self)  # Own pool, sized by the controller of this site
+        self.process_pool = None  # Worker processes of current queue in multiprocess mode
         self.thread_count = 0
         self.cancel_download_flag = 0
 
@@ -337,6 +376,13 @@ class MainWidget(QWidget):
         self.btn_start.clicked.connect(self.start_que_before)
 
         self.user_info = QLabel('下载限额：{0}/{1}'.format(info[0], info[1]))
+        self.settings.beginGroup('MiscSetting')
+        self.controller = transfer.ConcurrencyController(int(self.settings.value('dl_min', 1)),
+                                                         int(self.settings.value('dl_sametime', 3)))
+        self.settings.endGroup()
+        self.lbl_level = QLabel()
+        self.lbl_level.setToolTip('根据下载速度与错误自动调整，范围在首选项中设置。')
+        self.apply_level()
         self.btn_refresh = QPushButton('刷新限额')
         self.btn_refresh.clicked.connect(self.refresh)
         self.btn_logout = QPushButton('退出登陆')
@@ -377,6 +423,9 @@ class MainWidget(QWidget):
         self.que.horizontalHeader().setHighlightSections(False)
 
         self.init_ui()
+        for job, info in self.jobs.unfinished('ehentai'):
+            info['job'] = job
+            self.append_row(info)
 
     def init_ui(self):
         hlay_addr = QHBoxLayout()
@@ -412,6 +461,7 @@ class MainWidget(QWidget):
         vlay_right.addWidget(self.user_info, alignment=Qt.AlignHCenter)
         vlay_right.addWidget(self.btn_refresh)
         vlay_right.addWidget(self.btn_logout)
+        vlay_right.addWidget(self.lbl_level, alignment=Qt.AlignHCenter)
         right_wid = QWidget()
         right_wid.setLayout(vlay_right)
 
@@ -467,16 +517,12 @@ class MainWidget(QWidget):
     def show_info(self, info: dict):
         """Download thumbnail."""
         if self.show_thumb_flag:
-            if 'thumb_path' in info:
-                thumb = QPixmap()
-                if thumb.load(info['thumb_path']):  # If thumbnail is deleted, redownload it
-                    self.thumbnail.setPixmap(thumb)
-                else:
-                    self.thumb_thread = DownloadThumbThread(self.glovar.session, self.glovar.proxy, info)
-                    self.thumb_thread.download_success.connect(self.show_thumb)
-                    self.thumb_thread.start()
-            else:
-                self.thumb_thread = DownloadThumbThread(self.glovar.session, self.glovar.proxy, info)
+            thumb = globj.thumb_pixmap(info['thumb'])
+            if thumb:  # Decoded before, no disk or network
+                self.thumbnail.setPixmap(thumb)
+            else:  # Found in the thumbnail cache or downloaded into it
+                self.thumb_thread = DownloadThumbThread(self.glovar.session, self.glovar.proxy, info,
+                                                        self.thumbnail.contentsRect().size())
                 self.thumb_thread.download_success.connect(self.show_thumb)
                 self.thumb_thread.start()
         # Set min height to 0 before text changed to avoid unchangeable sizeHint
@@ -484,9 +530,11 @@ class MainWidget(QWidget):
         self.info.setText(info['name'] + '\n大小：' + info['size'] + '\n页数：' + info['page'])
         self.info.setMinimumHeight(self.info.sizeHint().height())  # Set to sizeHint to change height autometically
 
-    def show_thumb(self, info: dict):
+    def show_thumb(self, info: dict, image: QImage):
         self.current = info  # Update current which includes thumb_path
-        self.thumbnail.setPixmap(QPixmap(info['thumb_path']))
+        thumb = globj.thumb_pixmap(info['thumb'], image)
+        if thumb:
+            self.thumbnail.setPixmap(thumb)
 
     def add_que(self, info: dict = None):
         """Add current info to queue. If don't have current info, fetch it."""
@@ -497,21 +545,10 @@ class MainWidget(QWidget):
             addr = origin + '/' if origin[-1] != '/' else origin
             if self.current and addr == self.current['addr']:  # Current info avaliable and address doesn't change
                 self.show_info(self.current)
-                row_count = self.que.rowCount()
-                self.que.setRowCount(row_count + 1)
-
-                self.que.setItem(row_count, 0, QTableWidgetItem(self.current['name']))
-                size = QTableWidgetItem(self.current['size'])
-                size.setTextAlignment(Qt.AlignCenter)
-                self.que.setItem(row_count, 1, size)
-                page = QTableWidgetItem(self.current['page'])
-                page.setTextAlignment(Qt.AlignCenter)
-                self.que.setItem(row_count, 2, page)
-                self.que.setItem(row_count, 3, QTableWidgetItem('等待中'))
-                self.que.setItem(row_count, 4, QTableWidgetItem(self.current['addr']))
-
-                self.que.selectRow(row_count)
-                self.que_dict[self.current['addr']] = self.current
+                info = {key: value for key, value in self.current.items() if key != 'job'}
+                self.current['job'] = self.jobs.add('ehentai', addr, data=info, source=jobs.GUI)
+                self.append_row(self.current)
+                self.que.selectRow(self.que.rowCount() - 1)
 
             else:  # When current info has not fetched but addr served or changed, get info
                 if self.ledit_addr.text():
@@ -529,6 +566,22 @@ class MainWidget(QWidget):
                 else:
                     globj.show_messagebox(self, QMessageBox.Warning, '错误', '请输入画廊地址！')
 
+    def append_row(self, info: dict):
+        """Append a gallery to the end of queue."""
+        row_count = self.que.rowCount()
+        self.que.setRowCount(row_count + 1)
+
+        self.que.setItem(row_count, 0, QTableWidgetItem(info['name']))
+        size = QTableWidgetItem(info['size'])
+        size.setTextAlignment(Qt.AlignCenter)
+        self.que.setItem(row_count, 1, size)
+        page = QTableWidgetItem(info['page'])
+        page.setTextAlignment(Qt.AlignCenter)
+        self.que.setItem(row_count, 2, page)
+        self.que.setItem(row_count, 3, QTableWidgetItem('等待中'))
+        self.que.setItem(row_count, 4, QTableWidgetItem(info['addr']))
+        self.que_dict[info['addr']] = info
+
     def fetch_info_succeed(self, info: dict):
         """After fetching info successfully, set Current variable."""
         self.current = info  # Set current in case of thumb is turned off
@@ -555,6 +608,7 @@ class MainWidget(QWidget):
             for i in range(del_row):
                 status = self.que.item(del_bottom, 3).text()
                 if status == '等待中' or status == '已完成':
+                    self.jobs.remove(self.que_dict[self.que.item(del_bottom, 4).text()]['job'])
                     self.que.removeRow(del_bottom)
                     del_bottom -= 1
                 else:
@@ -588,16 +642,20 @@ class MainWidget(QWidget):
                 self.que.item(line, 3).setText('准备中')
                 info = self.que_dict[self.que.item(line, 4).text()]
                 self.current_line['info'] = info
-                self.fetch_key_thread = FetchKeyThread(self, self.glovar.session, self.glovar.proxy, info)
+                self.jobs.set_state(info['job'], jobs.READY)  # Started again after finished
+                self.open_process_pool()
+                self.fetch_key_thread = FetchKeyThread(self, self.glovar.session, self.glovar.proxy, info,
+                                                       self.process_pool)
                 self.fetch_key_thread.except_signal.connect(globj.show_messagebox)
                 self.fetch_key_thread.fetch_success.connect(self.fetch_finished)
                 self.fetch_key_thread.start()
             else:
                 self.current_line = dict()
+                self.close_process_pool()
                 self.btn_start.setText('开始队列')
                 self.btn_start.clicked.disconnect(self.stop_que)
                 self.btn_start.clicked.connect(self.start_que_before)
-                globj.show_messagebox(self, QMessageBox.Information, '完成', '队列下载完成！')
+                globj.show_messagebox(self, QMessageBox.Information, '完成', '队列下载完成！\n' + library.report_text())
         else:
             globj.show_messagebox(self, QMessageBox.Warning, '警告', '下载队列为空！')
 
@@ -609,22 +667,27 @@ class MainWidget(QWidget):
         self.settings.beginGroup('RuleSetting')
         root_path = self.settings.value('ehentai_root_path', os.path.abspath('.'))
         self.settings.endGroup()
-        self.settings.beginGroup('MiscSetting')
-        dl_sametime = int(self.settings.value('dl_sametime', 3))
-        self.settings.endGroup()
-        self.thread_pool.setMaxThreadCount(dl_sametime)
+        self.apply_level()
 
         rename = self.cbox_rename.checkState()
         rewrite = self.cbox_rewrite.checkState()
         start_page = self.sbox_begin_page.value()
         end_page = self.sbox_end_page.value() if self.sbox_end_page.value() <= int(info['page']) else int(info['page'])
         self.remain = set(range(start_page, end_page + 1))
-        self.download(info, keys, root_path, rename, rewrite)
+        if not rewrite:  # Drop owned pages before queuing, by library index
+            self.remain = {num for num in self.remain if not ehentai.page_owned(info, num, root_path, rename)}
+        if self.remain:
+            self.download(info, keys, root_path, rename, rewrite)
+        else:
+            self.que.item(line, 3).setText('已完成')
+            self.jobs.set_state(info['job'], jobs.DONE)
+            self.start_que(True)
 
     def download(self, info, keys, root_path, rename, rewrite):
         for num in self.remain:
             thread = DownloadPicThread(self, self.glovar.session, self.glovar.proxy, info, keys, num,
-                                       root_path, rename=rename, rewrite=rewrite)
+                                       root_path, self.controller, rename=rename, rewrite=rewrite,
+                                       processes=self.process_pool)
             thread.signals.except_signal.connect(self.download_exception)
             thread.signals.retry_signal.connect(self.retry_exception)
             thread.signals.download_success.connect(self.download_finished)
@@ -632,6 +695,7 @@ class MainWidget(QWidget):
             self.thread_pool.start(thread)
 
     def retry_exception(self, *args):
+        self.apply_level()
         self.thread_count -= 1
         print('Thread error：', args[-1])
         print('Active thread：', self.thread_pool.activeThreadCount(), 'Thread count：', self.thread_count)
@@ -640,12 +704,14 @@ class MainWidget(QWidget):
             self.download(*args[:-1])
 
     def download_exception(self, *args):
+        self.apply_level()
         self.thread_count -= 1
         if not self.thread_count:
             self.stop_que()
             globj.show_messagebox(*args)
 
     def download_finished(self, info, keys, page, root_path, rename, rewrite):
+        self.apply_level()
         self.thread_count -= 1
         print('Active thread：', self.thread_pool.activeThreadCount(), 'Thread count：', self.thread_count)
         if not self.cancel_download_flag:
@@ -655,10 +721,36 @@ class MainWidget(QWidget):
                     print('Redownloading：', self.remain)
                     self.download(info, keys, root_path, rename, rewrite)
                 else:
+                    print('Connections:', transfer.pool_report(self.glovar.session))
                     line = self.get_line('下载中')
                     self.que.item(line, 3).setText('已完成')
+                    self.jobs.set_state(info['job'], jobs.DONE)
                     self.start_que(True)
 
+    def open_process_pool(self):
+        """Start worker processes for this download if multiprocess mode is on."""
+        self.settings.beginGroup('MiscSetting')
+        enabled = int(self.settings.value('multiprocess', False))
+        self.settings.endGroup()
+        if enabled and self.process_pool is None:
+            self.process_pool = workers.ProcessPool('ehentai', self.glovar.session, self.glovar.proxy,
+                                                    self.controller.upper)
+
+    def close_process_pool(self):
+        if self.process_pool:
+            self.process_pool.shutdown()
+            self.process_pool = None
+
+    def apply_level(self):
+        """Size the thread pool by the concurrency controller, and show it."""
+        self.thread_pool.setMaxThreadCount(self.controller.level)
+        self.lbl_level.setText('并发数：{0}/{1}'.format(self.controller.level, self.controller.upper))
+
+    def change_concurrency(self, lower: int, upper: int):
+        """Change bounds of download concurrency in setting."""
+        self.controller.set_bounds(lower, upper)
+        self.apply_level()
+
     def cancel_download(self):
         self.btn_start.setDisabled(True)
         self.cancel_download_flag = 1
@@ -673,6 +765,7 @@ class MainWidget(QWidget):
 
     def stop_que(self):
         self.cancel_download()
+        self.close_process_pool()
         self.btn_start.setText('开始队列')
         self.btn_start.clicked.disconnect(self.stop_que)
         self.btn_start.clicked.connect(self.start_que_before)
@@ -714,6 +807,7 @@ class MainWidget(QWidget):
                 self.refresh_thread.exit(-1)
                 self.fetch_thread.exit(-1)
                 self.thread_pool.waitForDone()
+                self.close_process_pool()
                 self.logout_sig.emit('ehentai')
                 return True
             else:
@@ -724,6 +818,7 @@ class MainWidget(QWidget):
             self.refresh_thread.exit(-1)
             self.fetch_thread.exit(-1)
             self.thread_pool.waitForDone()
+            self.close_process_pool()
             self.logout_sig.emit('ehentai')
             return True
 
@@ -1,56 +1,20 @@
 # coding:utf-8
-"""Global objects."""
+"""Global objects of GUI. Objects without GUI are in core, and re-exported here."""
 import os
-import platform
 import re
 
 from PyQt5.QtCore import Qt, QSettings, pyqtSignal
-from PyQt5.QtGui import QFont
+from PyQt5.QtGui import QFont, QImage, QImageReader, QPixmap, QPixmapCache
 from PyQt5.QtWidgets import (QWidget, QLineEdit, QGroupBox, QPushButton, QCheckBox, QMessageBox, QTabWidget,
-                             QDoubleSpinBox, QSpinBox, QFormLayout, QHBoxLayout, QVBoxLayout, QGridLayout, QMenu)
+                             QDoubleSpinBox, QSpinBox, QFormLayout, QHBoxLayout, QVBoxLayout, QGridLayout, QMenu,
+                             QLabel)
 
 from modules import pixiv_gui, ehentai_gui
+from modules.core import (PLATFORM, GlobalVar, ResponseError, IPBannedError, LimitationReachedError,  # Re-export
+                          WrongAddressError, ValidationError, name_verify)
 
-_RE_SYMBOL = re.compile(r'[/\\|*?<>":]')
+THUMB_MEMORY = 64 * 1024  # KB of decoded thumbnails kept in memory
 _RE_PROXY = re.compile(r'.*:([1-9]\d{0,3}|[1-5]\d{4}|6[0-4]\d{4}|65[0-4]\d{2}|655[0-2]\d|6553[0-5])$')
-PLATFORM = platform.system()
-
-
-class GlobalVar(object):
-    user_agent = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:65.0) Gecko/20100101 Firefox/65.0',
-                  ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                   'Chrome/73.0.3683.86 Safari/537.36'),
-                  ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                   'Chrome/64.0.3282.140 Safari/537.36 Edge/18.17763'))
-
-    def __init__(self, session, proxy: dict, home: str):
-        self._session = session
-        self._proxy = proxy
-        self._home = home
-
-    @property
-    def session(self):
-        return self._session
-
-    @session.deleter
-    def session(self):
-        self._session.close()
-
-    @property
-    def proxy(self):
-        return self._proxy
-
-    @proxy.setter
-    def proxy(self, new: dict):
-        self._proxy = new
-
-    @property
-    def home(self):
-        return self._home
-
-    @home.setter
-    def home(self, new: str):
-        self._home = new
 
 
 class MiscSettingDialog(QWidget):
@@ -73,17 +37,73 @@ class MiscSettingDialog(QWidget):
         self.sbox_simi.setDecimals(2)
         self.sbox_simi.setSuffix(' %')
         self.sbox_dlcount = QSpinBox()
-        self.sbox_dlcount.setToolTip('可同时下载的图片数，过大可能会导致连接中断或IP被ban。')
+        self.sbox_dlcount.setToolTip('可同时下载的图片数上限，下载时会根据速度与错误在上下限间自动调整。')
         self.sbox_dlcount.setContextMenuPolicy(Qt.NoContextMenu)
-        self.sbox_dlcount.setRange(1, 5)
-        self.sbox_dlcount.setWrapping(True)
+        self.sbox_dlcount.setRange(1, 32)
+        self.sbox_dlmin = QSpinBox()
+        self.sbox_dlmin.setToolTip('可同时下载的图片数下限，出错或IP被ban时会降至该值。')
+        self.sbox_dlmin.setContextMenuPolicy(Qt.NoContextMenu)
+        self.sbox_dlmin.setRange(1, 32)
+        self.sbox_dlcount.valueChanged.connect(self.sbox_dlmin.setMaximum)  # Keep lower bound not above upper
+        self.sbox_ttl = QSpinBox()
+        self.sbox_ttl.setToolTip('缓存超过该天数后会在后台刷新，刷新期间仍使用旧数据。')
+        self.sbox_ttl.setContextMenuPolicy(Qt.NoContextMenu)
+        self.sbox_ttl.setRange(1, 365)
+        self.sbox_ttl.setSuffix(' 天')
+        self.sbox_expire = QSpinBox()
+        self.sbox_expire.setToolTip('缓存超过该天数后视为失效并重新获取，0为永不失效。')
+        self.sbox_expire.setContextMenuPolicy(Qt.NoContextMenu)
+        self.sbox_expire.setRange(0, 3650)
+        self.sbox_expire.setSuffix(' 天')
         self.cbox_thumb = QCheckBox()
+        self.sbox_thumb_cache = QSpinBox()
+        self.sbox_thumb_cache.setToolTip('预览图保存在thumbnails文件夹，超过该大小时删除最久未查看的。')
+        self.sbox_thumb_cache.setContextMenuPolicy(Qt.NoContextMenu)
+        self.sbox_thumb_cache.setRange(10, 10000)
+        self.sbox_thumb_cache.setSingleStep(50)
+        self.sbox_thumb_cache.setSuffix(' MB')
+        self.cbox_process = QCheckBox()
+        self.cbox_process.setToolTip('下载与解析在独立进程中进行，每个并发占用一个进程，可利用多核。')
+        self.sbox_pixiv_rate = self._rate_sbox()
+        self.sbox_pixiv_burst = self._burst_sbox()
+        self.sbox_pixiv_bandwidth = self._bandwidth_sbox()
+        self.sbox_ehentai_rate = self._rate_sbox()
+        self.sbox_ehentai_burst = self._burst_sbox()
+        self.sbox_ehentai_bandwidth = self._bandwidth_sbox()
 
         self.setWindowModality(Qt.ApplicationModal)
         self.setWindowFlags(Qt.CustomizeWindowHint | Qt.WindowCloseButtonHint)
         self.settings = QSettings(os.path.join(os.path.abspath('.'), 'settings.ini'), QSettings.IniFormat)
         self.init_ui()
 
+    @staticmethod
+    def _rate_sbox():
+        sbox = QDoubleSpinBox()
+        sbox.setToolTip('每秒可发出的网页与接口请求数，同一网站的所有线程共用，0为不限制。')
+        sbox.setContextMenuPolicy(Qt.NoContextMenu)
+        sbox.setRange(0, 100)
+        sbox.setSingleStep(0.5)
+        sbox.setDecimals(1)
+        return sbox
+
+    @staticmethod
+    def _burst_sbox():
+        sbox = QSpinBox()
+        sbox.setToolTip('空闲后可连续发出的请求数。')
+        sbox.setContextMenuPolicy(Qt.NoContextMenu)
+        sbox.setRange(1, 100)
+        return sbox
+
+    @staticmethod
+    def _bandwidth_sbox():
+        sbox = QDoubleSpinBox()
+        sbox.setToolTip('图片下载的总带宽，0为不限制。')
+        sbox.setContextMenuPolicy(Qt.NoContextMenu)
+        sbox.setRange(0, 1000)
+        sbox.setDecimals(1)
+        sbox.setSuffix(' MB/s')
+        return sbox
+
     def init_ui(self):
         self.restore()
         self.ledit_http.setPlaceholderText('服务器地址:端口号')
@@ -115,13 +135,35 @@ class MiscSettingDialog(QWidget):
         flay_misc = QFormLayout()
         flay_misc.setSpacing(20)
         flay_misc.addRow('图片相似度', self.sbox_simi)
-        flay_misc.addRow('并发线程数', self.sbox_dlcount)
+        flay_misc.addRow('最大并发数', self.sbox_dlcount)
+        flay_misc.addRow('最小并发数', self.sbox_dlmin)
+        flay_misc.addRow('缓存刷新期', self.sbox_ttl)
+        flay_misc.addRow('缓存失效期', self.sbox_expire)
         flay_misc.addRow('开启预览图', self.cbox_thumb)
+        flay_misc.addRow('预览图缓存', self.sbox_thumb_cache)
+        flay_misc.addRow('多进程下载', self.cbox_process)
         gbox_misc.setLayout(flay_misc)
 
+        gbox_rate = QGroupBox('限速')
+        glay_rate = QGridLayout()
+        glay_rate.setSpacing(20)
+        glay_rate.addWidget(QLabel('请求/秒'), 0, 1, alignment=Qt.AlignHCenter)
+        glay_rate.addWidget(QLabel('突发请求数'), 0, 2, alignment=Qt.AlignHCenter)
+        glay_rate.addWidget(QLabel('图片带宽'), 0, 3, alignment=Qt.AlignHCenter)
+        glay_rate.addWidget(QLabel('Pixiv'), 1, 0)
+        glay_rate.addWidget(self.sbox_pixiv_rate, 1, 1)
+        glay_rate.addWidget(self.sbox_pixiv_burst, 1, 2)
+        glay_rate.addWidget(self.sbox_pixiv_bandwidth, 1, 3)
+        glay_rate.addWidget(QLabel('Ehentai'), 2, 0)
+        glay_rate.addWidget(self.sbox_ehentai_rate, 2, 1)
+        glay_rate.addWidget(self.sbox_ehentai_burst, 2, 2)
+        glay_rate.addWidget(self.sbox_ehentai_bandwidth, 2, 3)
+        gbox_rate.setLayout(glay_rate)
+
         glay_all = QGridLayout()
         glay_all.addWidget(gbox_proxy, 0, 0)
         glay_all.addWidget(gbox_misc, 0, 1)
+        glay_all.addWidget(gbox_rate, 1, 0, 1, 2)
 
         hlay_btn = QHBoxLayout()  # Confirm and cancel button
         hlay_btn.addStretch(1)
@@ -149,7 +191,20 @@ class MiscSettingDialog(QWidget):
             self.settings.setValue('proxy', {'http': http_proxy, 'https': https_proxy})
             self.settings.setValue('similarity', self.sbox_simi.value())
             self.settings.setValue('dl_sametime', self.sbox_dlcount.value())
+            self.settings.setValue('dl_min', self.sbox_dlmin.value())
+            self.settings.setValue('cache_ttl', self.sbox_ttl.value())
+            self.settings.setValue('cache_expire', self.sbox_expire.value())
             self.settings.setValue('thumbnail', int(self.cbox_thumb.isChecked()))
+            self.settings.setValue('thumb_cache', self.sbox_thumb_cache.value())
+            self.settings.setValue('multiprocess', int(self.cbox_process.isChecked()))
+            self.settings.endGroup()
+            self.settings.beginGroup('RateLimit')
+            self.settings.setValue('pixiv_rate', self.sbox_pixiv_rate.value())
+            self.settings.setValue('pixiv_burst', self.sbox_pixiv_burst.value())
+            self.settings.setValue('pixiv_bandwidth', self.sbox_pixiv_bandwidth.value())
+            self.settings.setValue('ehentai_rate', self.sbox_ehentai_rate.value())
+            self.settings.setValue('ehentai_burst', self.sbox_ehentai_burst.value())
+            self.settings.setValue('ehentai_bandwidth', self.sbox_ehentai_bandwidth.value())
             self.settings.sync()
             self.settings.endGroup()
             self.close()
@@ -169,7 +224,20 @@ class MiscSettingDialog(QWidget):
         setting_proxy = self.settings.value('proxy', {'http': '', 'https': ''})
         setting_similarity = float(self.settings.value('similarity', 60.0))
         setting_dlcount = int(self.settings.value('dl_sametime', 3))
+        setting_dlmin = int(self.settings.value('dl_min', 1))
+        setting_ttl = int(self.settings.value('cache_ttl', 7))
+        setting_expire = int(self.settings.value('cache_expire', 90))
         setting_thumbnail = int(self.settings.value('thumbnail', True))
+        setting_thumb_cache = int(self.settings.value('thumb_cache', 200))
+        setting_process = int(self.settings.value('multiprocess', False))
+        self.settings.endGroup()
+        self.settings.beginGroup('RateLimit')
+        setting_pixiv_rate = float(self.settings.value('pixiv_rate', 5.0))
+        setting_pixiv_burst = int(self.settings.value('pixiv_burst', 10))
+        setting_pixiv_bandwidth = float(self.settings.value('pixiv_bandwidth', 0.0))
+        setting_ehentai_rate = float(self.settings.value('ehentai_rate', 2.0))
+        setting_ehentai_burst = int(self.settings.value('ehentai_burst', 5))
+        setting_ehentai_bandwidth = float(self.settings.value('ehentai_bandwidth', 0.0))
         self.settings.endGroup()
 
         self.cbox_pixiv.setChecked(setting_pixiv_proxy)
@@ -179,7 +247,19 @@ class MiscSettingDialog(QWidget):
         self.ledit_https.setText(setting_proxy['https'])
         self.sbox_simi.setValue(setting_similarity)
         self.sbox_dlcount.setValue(setting_dlcount)
+        self.sbox_dlmin.setMaximum(setting_dlcount)
+        self.sbox_dlmin.setValue(setting_dlmin)
+        self.sbox_ttl.setValue(setting_ttl)
+        self.sbox_expire.setValue(setting_expire)
         self.cbox_thumb.setChecked(setting_thumbnail)
+        self.sbox_thumb_cache.setValue(setting_thumb_cache)
+        self.cbox_process.setChecked(setting_process)
+        self.sbox_pixiv_rate.setValue(setting_pixiv_rate)
+        self.sbox_pixiv_burst.setValue(setting_pixiv_burst)
+        self.sbox_pixiv_bandwidth.setValue(setting_pixiv_bandwidth)
+        self.sbox_ehentai_rate.setValue(setting_ehentai_rate)
+        self.sbox_ehentai_burst.setValue(setting_ehentai_burst)
+        self.sbox_ehentai_bandwidth.setValue(setting_ehentai_bandwidth)
 
     def keyPressEvent(self, k):
         if k.key() == Qt.Key_Escape:
@@ -275,53 +355,6 @@ class LineEditor(QLineEdit):
             self.paste()
 
 
-class ResponseError(Exception):
-    """Exception for abnormal response."""
-
-    def __init__(self, msg):
-        self.msg = msg
-
-    def __str__(self):
-        return repr(self.msg)
-
-
-class IPBannedError(ResponseError):
-    """Exception for IP banned in e-hentai."""
-
-    def __init__(self, h, m, s):
-        super().__init__('IP address has been temporarily banned.')
-        self.h = h
-        self.m = m
-        self.s = s
-
-
-class LimitationReachedError(ResponseError):
-    """Exception for limitation has reached."""
-
-    def __init__(self, page):
-        super().__init__(page)
-
-
-class WrongAddressError(ResponseError):
-    """Exception for providing wrong address."""
-
-    def __init__(self, msg):
-        self.msg = msg
-
-    def __str__(self):
-        return repr(self.msg)
-
-
-class ValidationError(Exception):
-    """Exception for wrong user-id or password or other error about validation."""
-
-    def __init__(self, msg):
-        self.msg = msg
-
-    def __str__(self):
-        return repr(self.msg)
-
-
 def show_messagebox(parent, style, title: str, message: str):
     msg_box = QMessageBox(parent)
     msg_box.setWindowTitle(title)
@@ -331,34 +364,39 @@ def show_messagebox(parent, style, title: str, message: str):
     msg_box.exec()
 
 
-def name_verify(name: str, default: str = 'NoName') -> str:
+def load_thumb(path: str, size) -> QImage:
+    """
+    Decode a thumbnail scaled down to fit size. Safe in worker threads, unlike QPixmap.
+    Args:
+        path: Path of the image.
+        size: QSize of the label showing it.
+    Return:
+        A QImage, null if path cannot be decoded.
+    """
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    origin = reader.size()
+    if origin.isValid() and (origin.width() > size.width() or origin.height() > size.height()):
+        reader.setScaledSize(origin.scaled(size, Qt.KeepAspectRatio))  # Large JPEGs are decoded at reduced size
+    return reader.read()
+
+
+def thumb_pixmap(url: str, image: QImage = None):
     """
-    Normalize file/folder name.
+    Get a decoded thumbnail from the in-memory pixmap cache, shared by all tabs.
+    Call it in GUI thread only.
     Args:
-        name: A string of file/folder name.
-        default: When the illegal name leads to an empty string, return this.
-    Returns:
-        A legal string for file/folder name.
+        url: Url of the thumbnail, the cache key.
+        image: (optional) The thumbnail decoded by load_thumb(), cached on a miss.
+    Return:
+        A QPixmap, None if not in memory and image is not given or null.
     """
-    if PLATFORM == 'Windows':
-        illegal_name = {'con', 'aux', 'nul', 'prn', 'com0', 'com1', 'com2', 'com3', 'com4', 'com5', 'com6', 'com7',
-                        'com8', 'com9', 'lpt0', 'lpt1', 'lpt2', 'lpt3', 'lpt4', 'lpt5', 'lpt6', 'lpt7', 'lpt8', 'lpt9'}
-        step1 = _RE_SYMBOL.sub('', name)  # Remove illegal symbol
-        step2 = step1.strip('.')  # Remove '.' at the beginning and end
-        if step2 in illegal_name or not step2:
-            return default
-        return step2
-    elif PLATFORM == 'Linux':
-        step1 = name.replace('/', '')  # Remove illegal '/'
-        step2 = step1.lstrip('.')  # Remove '.' at the beginning
-        if not step2:
-            return default
-        return step2
+    pixmap = QPixmapCache.find(url)
+    if pixmap is None and image is not None and not image.isNull():
+        pixmap = QPixmap.fromImage(image)
+        QPixmapCache.insert(url, pixmap)
+    return pixmap
 
 
 if __name__ == '__main__':
     pass
-    # print('/con?:', name_verify('/con?', 'IllegalName'))
-    # print('.hack"thank:', name_verify('.hack"thank', 'IllegalName'))
-    # print('...aux*Myname...:', name_verify('...aux*Myname...', 'IllegalName'))
-    # print('...:', name_verify('...', 'IllegalName'))
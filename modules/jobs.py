@@ -0,0 +1,316 @@
+# coding:utf-8
+"""On-disk download queue with per-page states, leases and retry counts."""
+import json
+import os
+import socket
+import threading
+import time
+
+from modules import database
+
+_DB_PATH = 'jobs.db'
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS JOBS(
+    ID          INTEGER PRIMARY KEY,
+    SITE        TEXT    NOT NULL,
+    TARGET      TEXT    NOT NULL,
+    SOURCE      TEXT    NOT NULL,
+    OPTIONS     TEXT    NOT NULL,
+    DATA        TEXT,
+    STATE       TEXT    NOT NULL,
+    ATTEMPTS    INT     NOT NULL DEFAULT 0,
+    OWNER       TEXT,
+    LEASEUNTIL  REAL    NOT NULL DEFAULT 0,
+    ERROR       TEXT,
+    CREATEDAT   REAL    NOT NULL);
+CREATE INDEX IF NOT EXISTS JOBS_CLAIM ON JOBS(SOURCE, STATE, LEASEUNTIL);
+CREATE INDEX IF NOT EXISTS JOBS_TARGET ON JOBS(SITE, TARGET);
+CREATE TABLE IF NOT EXISTS PAGES(
+    JOB         INT     NOT NULL,
+    PAGE        INT     NOT NULL,
+    STATE       TEXT    NOT NULL,
+    ATTEMPTS    INT     NOT NULL DEFAULT 0,
+    OWNER       TEXT,
+    LEASEUNTIL  REAL    NOT NULL DEFAULT 0,
+    ERROR       TEXT,
+    PRIMARY KEY(JOB, PAGE));
+CREATE INDEX IF NOT EXISTS PAGES_CLAIM ON PAGES(STATE, LEASEUNTIL);'''
+
+SERVICE = 'service'  # Jobs claimed by workers of cli.py serve
+GUI = 'gui'  # Jobs run by the GUI itself, only recorded for resuming
+NEW = 'new'  # Job waiting to be expanded into pages
+PENDING = 'pending'
+LEASED = 'leased'
+READY = 'ready'  # Job expanded, its pages are queued
+DONE = 'done'
+FAILED = 'failed'
+_OPEN = (NEW, LEASED, READY)
+LEASE = 120  # Default seconds a claim is held without renew()
+MAX_ATTEMPTS = 5
+_BACKOFF = 15  # Seconds before the first retry, doubled by each failure
+_BACKOFF_MAX = 1800
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def owner_name() -> str:
+    """Lease owner of this process, unique among hosts sharing the database."""
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def backoff(attempts: int) -> float:
+    """Seconds before retrying after given number of failures."""
+    return min(_BACKOFF_MAX, _BACKOFF * 2 ** max(attempts - 1, 0))
+
+
+def _in(values) -> str:
+    return ', '.join('?' * len(values))
+
+
+class JobQueue(object):
+    """
+    Jobs are targets like a gallery or an illustration, expanded into pages.
+    Claims of jobs and pages are leases, written in an immediate transaction
+    so that worker threads and processes never claim the same row. A lease
+    not renewed before expiring is claimable again, so pages of a crashed
+    worker are re-queued, while finished pages are never downloaded again.
+    """
+
+    def __init__(self, db_path: str = _DB_PATH, max_attempts: int = MAX_ATTEMPTS):
+        self._db = database.get(db_path, _SCHEMA)
+        self.max_attempts = max_attempts
+
+    def add(self, site: str, target: str, options: dict = None, data=None, pages=None, source: str = SERVICE) -> int:
+        """
+        Queue a target, or return the unfinished job of the same target.
+        Args:
+            site: Kind of target, like 'pixiv', 'pixiv_user' or 'ehentai'.
+            target: Id or address of the target.
+            options: (optional) Save options used by the worker.
+            data: (optional) Information fetched already. With pages, the job is ready at once.
+            pages: (optional) Page numbers to download.
+            source: SERVICE or GUI.
+        Return:
+            Id of the job.
+        """
+        with self._db.writer(immediate=True) as pdb:
+            row = pdb.execute('SELECT ID FROM JOBS WHERE SITE = ? AND TARGET = ? AND SOURCE = ? AND STATE IN ({0})'
+                              .format(_in(_OPEN)), (site, target, source) + _OPEN).fetchone()
+            if row:
+                job = row[0]
+            else:
+                state = READY if pages is not None else NEW
+                job = pdb.execute('INSERT INTO JOBS(SITE, TARGET, SOURCE, OPTIONS, DATA, STATE, CREATEDAT) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (site, target, source, json.dumps(options or {}, ensure_ascii=False),
+                                   None if data is None else json.dumps(data, ensure_ascii=False),
+                                   state, time.time())).lastrowid
+            if pages is not None:
+                self._add_pages(pdb, job, pages)
+        return job
+
+    @staticmethod
+    def _add_pages(pdb, job: int, pages):
+        pdb.executemany('INSERT OR IGNORE INTO PAGES(JOB, PAGE, STATE) VALUES (?, ?, ?)',
+                        ((job, page, PENDING) for page in pages))
+        pdb.execute('UPDATE JOBS SET STATE = ?, OWNER = NULL WHERE ID = ?', (READY, job))
+
+    def claim_job(self, owner: str, sites, lease: float = LEASE) -> dict:
+        """
+        Lease a job waiting to be expanded.
+        Args:
+            owner: Lease owner, see owner_name().
+            sites: Sites this worker can handle.
+            lease: Seconds before the lease expires.
+        Return:
+            A dict of id, site, target, options and attempts, or None if nothing is claimable.
+        """
+        sites = tuple(sites)
+        now = time.time()
+        with self._db.writer(immediate=True) as pdb:
+            row = pdb.execute('SELECT ID, SITE, TARGET, OPTIONS, ATTEMPTS FROM JOBS WHERE SOURCE = ? '
+                              'AND STATE IN (?, ?) AND LEASEUNTIL <= ? AND SITE IN ({0}) ORDER BY ID LIMIT 1'
+                              .format(_in(sites)), (SERVICE, NEW, LEASED, now) + sites).fetchone()
+            if row is None:
+                return None
+            pdb.execute('UPDATE JOBS SET STATE = ?, OWNER = ?, LEASEUNTIL = ? WHERE ID = ?',
+                        (LEASED, owner, now + lease, row[0]))
+        return {'id': row[0], 'site': row[1], 'target': row[2], 'options': json.loads(row[3]), 'attempts': row[4]}
+
+    def expand(self, job: int, data, pages=(), children=()):
+        """
+        Finish a claimed job by queuing its pages, or new jobs it is made of.
+        Args:
+            job: Id of the job.
+            data: Information used to download its pages.
+            pages: Page numbers to download.
+            children: Tuples of (site, target) queued with the same options, like works of a user.
+        """
+        pages = list(pages)
+        with self._db.writer(immediate=True) as pdb:
+            options = pdb.execute('SELECT OPTIONS FROM JOBS WHERE ID = ?', (job,)).fetchone()[0]
+            pdb.execute('UPDATE JOBS SET DATA = ?, ERROR = NULL WHERE ID = ?',
+                        (json.dumps(data, ensure_ascii=False), job))
+            for site, target in children:
+                if not pdb.execute('SELECT 1 FROM JOBS WHERE SITE = ? AND TARGET = ? AND SOURCE = ? '
+                                   'AND STATE IN ({0})'.format(_in(_OPEN)),
+                                   (site, target, SERVICE) + _OPEN).fetchone():
+                    pdb.execute('INSERT INTO JOBS(SITE, TARGET, SOURCE, OPTIONS, STATE, CREATEDAT) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', (site, target, SERVICE, options, NEW, time.time()))
+            if pages:
+                self._add_pages(pdb, job, pages)
+            else:
+                pdb.execute('UPDATE JOBS SET STATE = ?, OWNER = NULL WHERE ID = ?', (DONE, job))
+
+    def fail_job(self, job: int, error: str, retry: bool = True) -> int:
+        """Give a claimed job back with a delay, or mark it failed after too many attempts. Return attempts."""
+        with self._db.writer() as pdb:
+            return self._fail(pdb, 'JOBS', 'ID = ?', (job,), NEW, error, retry)
+
+    def claim_pages(self, owner: str, sites, limit: int = 1, lease: float = LEASE) -> list:
+        """
+        Lease pages of ready jobs, in the order of jobs.
+        Return:
+            A list of dicts of job, page, site, options, data and attempts.
+        """
+        sites = tuple(sites)
+        now = time.time()
+        with self._db.writer(immediate=True) as pdb:
+            rows = pdb.execute('SELECT P.JOB, P.PAGE, J.SITE, J.OPTIONS, J.DATA, P.ATTEMPTS '
+                               'FROM PAGES P JOIN JOBS J ON J.ID = P.JOB '
+                               'WHERE P.STATE IN (?, ?) AND P.LEASEUNTIL <= ? AND J.SOURCE = ? AND J.SITE IN ({0}) '
+                               'ORDER BY P.JOB, P.PAGE LIMIT ?'.format(_in(sites)),
+                               (PENDING, LEASED, now, SERVICE) + sites + (limit,)).fetchall()
+            pdb.executemany('UPDATE PAGES SET STATE = ?, OWNER = ?, LEASEUNTIL = ? WHERE JOB = ? AND PAGE = ?',
+                            ((LEASED, owner, now + lease, job, page) for job, page, *_ in rows))
+        return [{'job': job, 'page': page, 'site': site, 'options': json.loads(options), 'data': json.loads(data),
+                 'attempts': attempts} for job, page, site, options, data, attempts in rows]
+
+    def finish_page(self, job: int, page: int):
+        """Mark a page downloaded or owned. The job is done with its last page."""
+        self.finish_pages(job, (page,))
+
+    def finish_pages(self, job: int, pages):
+        with self._db.writer() as pdb:
+            pdb.executemany('UPDATE PAGES SET STATE = ?, OWNER = NULL, ERROR = NULL WHERE JOB = ? AND PAGE = ?',
+                            ((DONE, job, page) for page in pages))
+            self._settle(pdb, job)
+
+    def fail_page(self, job: int, page: int, error: str, retry: bool = True) -> int:
+        """Give a claimed page back with a delay, or mark it failed after too many attempts. Return attempts."""
+        with self._db.writer() as pdb:
+            attempts = self._fail(pdb, 'PAGES', 'JOB = ? AND PAGE = ?', (job, page), PENDING, error, retry)
+            self._settle(pdb, job)
+        return attempts
+
+    def _fail(self, pdb, table: str, where: str, key: tuple, retry_state: str, error: str, retry: bool):
+        row = pdb.execute('SELECT ATTEMPTS FROM {0} WHERE {1}'.format(table, where), key).fetchone()
+        if row is None:
+            return 0
+        attempts = row[0] + 1
+        state = retry_state if retry and attempts < self.max_attempts else FAILED
+        pdb.execute('UPDATE {0} SET STATE = ?, ATTEMPTS = ?, OWNER = NULL, LEASEUNTIL = ?, ERROR = ? WHERE {1}'
+                    .format(table, where), (state, attempts, time.time() + backoff(attempts), error) + key)
+        return attempts
+
+    def postpone(self, job: int, page, seconds: float):
+        """Give a claimed page, or job if page is None, back after seconds, without counting an attempt."""
+        until = time.time() + seconds
+        with self._db.writer() as pdb:
+            if page is None:
+                pdb.execute('UPDATE JOBS SET STATE = ?, OWNER = NULL, LEASEUNTIL = ? WHERE ID = ?', (NEW, until, job))
+            else:
+                pdb.execute('UPDATE PAGES SET STATE = ?, OWNER = NULL, LEASEUNTIL = ? WHERE JOB = ? AND PAGE = ?',
+                            (PENDING, until, job, page))
+
+    @staticmethod
+    def _settle(pdb, job: int):
+        """Close a ready job whose pages are all finished or failed."""
+        pdb.execute('UPDATE JOBS SET STATE = CASE WHEN EXISTS '
+                    '(SELECT 1 FROM PAGES WHERE JOB = ?1 AND STATE = ?2) THEN ?2 ELSE ?3 END '
+                    'WHERE ID = ?1 AND STATE = ?4 AND NOT EXISTS '
+                    '(SELECT 1 FROM PAGES WHERE JOB = ?1 AND STATE IN (?5, ?6))',
+                    (job, FAILED, DONE, READY, PENDING, LEASED))
+
+    def renew(self, owner: str, lease: float = LEASE):
+        """Extend every lease held by owner. Call it well within the lease."""
+        until = time.time() + lease
+        with self._db.writer() as pdb:
+            pdb.execute('UPDATE JOBS SET LEASEUNTIL = ? WHERE OWNER = ? AND STATE = ?', (until, owner, LEASED))
+            pdb.execute('UPDATE PAGES SET LEASEUNTIL = ? WHERE OWNER = ? AND STATE = ?', (until, owner, LEASED))
+
+    def release(self, owner: str, delay: float = 0):
+        """
+        Give back every lease held by owner, without counting an attempt.
+        Args:
+            owner: Lease owner.
+            delay: (optional) Seconds before they are claimable, like the rest of an IP ban.
+        """
+        until = time.time() + delay
+        with self._db.writer() as pdb:
+            pdb.execute('UPDATE JOBS SET STATE = ?, OWNER = NULL, LEASEUNTIL = ? WHERE OWNER = ? AND STATE = ?',
+                        (NEW, until, owner, LEASED))
+            pdb.execute('UPDATE PAGES SET STATE = ?, OWNER = NULL, LEASEUNTIL = ? WHERE OWNER = ? AND STATE = ?',
+                        (PENDING, until, owner, LEASED))
+
+    def delay(self, site: str, seconds: float):
+        """Keep unclaimed pages and jobs of a site from being claimed for seconds."""
+        until = time.time() + seconds
+        with self._db.writer() as pdb:
+            pdb.execute('UPDATE JOBS SET LEASEUNTIL = MAX(LEASEUNTIL, ?) WHERE SITE = ? AND STATE = ?',
+                        (until, site, NEW))
+            pdb.execute('UPDATE PAGES SET LEASEUNTIL = MAX(LEASEUNTIL, ?) WHERE STATE = ? AND JOB IN '
+                        '(SELECT ID FROM JOBS WHERE SITE = ?)', (until, PENDING, site))
+
+    def set_state(self, job: int, state: str):
+        """Set state of a job run by the GUI."""
+        with self._db.writer() as pdb:
+            pdb.execute('UPDATE JOBS SET STATE = ? WHERE ID = ?', (state, job))
+
+    def remove(self, job: int):
+        with self._db.writer() as pdb:
+            pdb.execute('DELETE FROM PAGES WHERE JOB = ?', (job,))
+            pdb.execute('DELETE FROM JOBS WHERE ID = ?', (job,))
+
+    def unfinished(self, site: str, source: str = GUI) -> list:
+        """
+        Unfinished jobs of a site, for restoring the queue after a restart.
+        Return:
+            A list of tuples. (job id, data)
+        """
+        rows = self._db.reader.execute('SELECT ID, DATA FROM JOBS WHERE SITE = ? AND SOURCE = ? AND STATE IN ({0}) '
+                                       'ORDER BY ID'.format(_in(_OPEN)), (site, source) + _OPEN).fetchall()
+        return [(job, json.loads(data) if data else None) for job, data in rows]
+
+    def retry_failed(self) -> int:
+        """Queue failed pages and jobs of the service again. Return the number of them."""
+        with self._db.writer() as pdb:
+            count = pdb.execute('UPDATE PAGES SET STATE = ?, ATTEMPTS = 0, LEASEUNTIL = 0 WHERE STATE = ? AND JOB IN '
+                                '(SELECT ID FROM JOBS WHERE SOURCE = ?)', (PENDING, FAILED, SERVICE)).rowcount
+            count += pdb.execute('UPDATE JOBS SET STATE = ?, ATTEMPTS = 0, LEASEUNTIL = 0 '
+                                 'WHERE STATE = ? AND SOURCE = ? AND DATA IS NULL', (NEW, FAILED, SERVICE)).rowcount
+            pdb.execute('UPDATE JOBS SET STATE = ? WHERE STATE = ? AND SOURCE = ? AND DATA IS NOT NULL',
+                        (READY, FAILED, SERVICE))
+        return count
+
+    def summary(self) -> dict:
+        """Numbers of jobs and pages of the service by state, like {'jobs': {'new': 1}, 'pages': {...}}."""
+        reader = self._db.reader
+        return {'jobs': dict(reader.execute('SELECT STATE, COUNT(*) FROM JOBS WHERE SOURCE = ? GROUP BY STATE',
+                                            (SERVICE,))),
+                'pages': dict(reader.execute('SELECT P.STATE, COUNT(*) FROM PAGES P JOIN JOBS J ON J.ID = P.JOB '
+                                             'WHERE J.SOURCE = ? GROUP BY P.STATE', (SERVICE,)))}
+
+    def idle(self) -> bool:
+        """Whether no job or page of the service is left, claimable or not."""
+        return not self._db.reader.execute(
+            'SELECT 1 FROM JOBS WHERE SOURCE = ? AND STATE IN ({0}) LIMIT 1'.format(_in(_OPEN)),
+            (SERVICE,) + _OPEN).fetchone()
+
+
+def get() -> JobQueue:
+    """Get the shared JobQueue instance."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
@@ -0,0 +1,350 @@
+# coding:utf-8
+"""In-memory index of downloaded files, for skip checks without touching the disk."""
+import hashlib
+import os
+import sys
+import threading
+import time
+
+from modules import database
+
+_DB_PATH = 'library.db'
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS LIBRARY(
+    PATH        TEXT    PRIMARY KEY NOT NULL,
+    KEY         TEXT,
+    HASH        TEXT,
+    SIZE        INT,
+    LINKED      INT     NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS LIBRARY_KEY ON LIBRARY(KEY);
+CREATE INDEX IF NOT EXISTS LIBRARY_HASH ON LIBRARY(HASH);
+CREATE TABLE IF NOT EXISTS ROOTS(
+    ROOT        TEXT    PRIMARY KEY NOT NULL,
+    SCANNEDAT   REAL    NOT NULL);'''
+_TEMP_SUFFIXES = ('.part', '.link')  # Unfinished downloads and links
+_FICLONE = 0x40049409  # Linux ioctl sharing extents of a file, on btrfs, xfs and others
+_library = None
+_library_lock = threading.Lock()
+
+
+def _norm(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _migrate(pdb):
+    """Add content columns to LIBRARY created by older versions."""
+    cols = database.columns(pdb, 'LIBRARY')
+    if cols and 'HASH' not in cols:
+        pdb.execute('ALTER TABLE LIBRARY ADD COLUMN HASH TEXT')
+        pdb.execute('ALTER TABLE LIBRARY ADD COLUMN SIZE INT')
+        pdb.execute('ALTER TABLE LIBRARY ADD COLUMN LINKED INT NOT NULL DEFAULT 0')
+
+
+def file_digest(path: str) -> str:
+    """SHA-1 of a file, the same as transfer.TransferStats.digest."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(src: str, dst: str) -> bool:
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+def _link(src: str, dst: str) -> bool:
+    """Replace dst by a hardlink, or else a reflink, of src. Return False if neither is supported."""
+    tmp = dst + '.link'
+    try:
+        os.link(src, tmp)
+    except OSError:  # Cross device, or not supported by the file system
+        if not _reflink(src, tmp):
+            return False
+    os.replace(tmp, dst)
+    return True
+
+
+class Library(object):
+    """
+    Index of files under save roots.
+    The index is loaded from library.db and refreshed by one os.scandir pass
+    per root in background, and kept current by add() when downloads finish.
+    Paths outside scanned roots, and all paths before loading, fall back to the file system.
+    """
+
+    def __init__(self, db_path: str = _DB_PATH):
+        self._db = database.get(db_path, _SCHEMA, _migrate)
+        self._lock = threading.RLock()
+        self._folders = {}  # {folder: {stem: name}}
+        self._keys = {}  # {key: path}
+        self._dirs = set()  # Folders known to exist
+        self._roots = set()  # Roots whose files are all indexed
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """Load the index from library.db, once. Called by scan() so that it runs in the scanning thread."""
+        with self._load_lock:
+            if self._loaded:
+                return
+            reader = self._db.reader
+            rows = reader.execute('SELECT PATH, KEY FROM LIBRARY').fetchall()
+            roots = [root for (root,) in reader.execute('SELECT ROOT FROM ROOTS')]
+            with self._lock:
+                for path, key in rows:
+                    self._index(path, key)
+                self._roots.update(roots)
+                self._loaded = True
+
+    def _index(self, path: str, key: str = None):
+        folder, name = os.path.split(path)
+        self._folders.setdefault(folder, {})[os.path.splitext(name)[0]] = name
+        if key:
+            self._keys[key] = path
+
+    def _covered(self, path: str) -> bool:
+        return any(path.startswith(root + os.sep) for root in self._roots)
+
+    def scan(self, root: str):
+        """Index every file under root with one os.scandir pass, and persist it."""
+        self.load()
+        root = _norm(root)
+        prefix = root + os.sep
+        with self._lock:  # Files added while walking are not seen by the walk, so only these may be gone
+            indexed = {os.path.join(folder, name)
+                       for folder, stems in self._folders.items() if folder.startswith(prefix) or folder == root
+                       for name in stems.values()}
+        found = set()
+        dirs = set()
+        stack = [root]
+        while stack:
+            folder = stack.pop()
+            try:
+                with os.scandir(folder) as entries:
+                    dirs.add(folder)
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif not entry.name.endswith(_TEMP_SUFFIXES):
+                            found.add(entry.path)
+            except (FileNotFoundError, PermissionError, NotADirectoryError):
+                continue
+
+        gone = {path for path in indexed - found if not os.path.exists(path)}  # Or deleted and downloaded again
+        new = found - indexed
+        with self._lock:
+            for path in gone:
+                folder, name = os.path.split(path)
+                self._folders[folder].pop(os.path.splitext(name)[0], None)
+            self._keys = {key: path for key, path in self._keys.items() if path not in gone}
+            for path in new:
+                self._index(path)
+            self._dirs = {folder for folder in self._dirs if not folder.startswith(prefix) and folder != root} | dirs
+            self._roots.add(root)
+        with self._db.writer() as pdb:
+            pdb.executemany('DELETE FROM LIBRARY WHERE PATH = ?', ((path,) for path in gone))
+            pdb.executemany('INSERT OR IGNORE INTO LIBRARY(PATH) VALUES (?)', ((path,) for path in new))
+            pdb.execute('INSERT OR REPLACE INTO ROOTS VALUES (?, ?)', (root, time.time()))
+        print('Library scanned:', root, len(found), 'files')
+
+    def scan_async(self, roots):
+        """Load the index and scan roots in a background thread."""
+        roots = [root for root in roots if root]
+        thread = threading.Thread(target=lambda: [self.scan(root) for root in roots], daemon=True)
+        thread.start()
+        return thread
+
+    def exists(self, path: str) -> bool:
+        """Whether the file is owned."""
+        path = _norm(path)
+        folder, name = os.path.split(path)
+        with self._lock:
+            if self._folders.get(folder, {}).get(os.path.splitext(name)[0]) == name:
+                return True
+            if self._covered(path):
+                return False
+        return os.path.exists(path)
+
+    def find_stem(self, folder: str, stem: str) -> str:
+        """Return the path of the file in folder named stem with any extension, or '' if not owned."""
+        folder = _norm(folder)
+        with self._lock:
+            name = self._folders.get(folder, {}).get(stem)
+            if name:
+                return os.path.join(folder, name)
+            if self._covered(os.path.join(folder, stem)):
+                return ''
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if os.path.splitext(entry.name)[0] == stem and not entry.name.endswith(_TEMP_SUFFIXES):
+                        return entry.path
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return ''
+
+    def find_key(self, key: str) -> str:
+        """Return the path recorded for key by add(), or '' if not owned."""
+        with self._lock:
+            if key in self._keys or self._loaded:
+                return self._keys.get(key, '')
+        row = self._db.reader.execute('SELECT PATH FROM LIBRARY WHERE KEY = ?', (key,)).fetchone()
+        return row[0] if row else ''
+
+    def add(self, path: str, key: str = None, digest: str = '') -> int:
+        """
+        Record a finished download, and link it to an owned copy of the same content.
+        Args:
+            path: Path of the file.
+            key: (Optional) An id to find the file before its name is known.
+            digest: (Optional) SHA-1 of the file, given by transfer.TransferStats.
+        Return:
+            Bytes saved by linking.
+        """
+        path = _norm(path)
+        with self._lock:
+            self._index(path, key)
+            self._dirs.add(os.path.dirname(path))
+        size = os.path.getsize(path) if digest else None
+        saved = self._dedup(path, digest, size) if digest else 0
+        with self._db.writer() as pdb:
+            pdb.execute('INSERT OR REPLACE INTO LIBRARY VALUES (?, ?, ?, ?, ?)',
+                        (path, key, digest or None, size, int(bool(saved))))
+        return saved
+
+    def learn(self, path: str, key: str = None):
+        """Index a file recorded by add() of another process, without writing library.db."""
+        path = _norm(path)
+        with self._lock:
+            self._index(path, key)
+            self._dirs.add(os.path.dirname(path))
+
+    def _dedup(self, path: str, digest: str, size: int) -> int:
+        """Replace path by a link of an owned file with the same digest and size."""
+        rows = self._db.reader.execute('SELECT PATH FROM LIBRARY WHERE HASH = ? AND SIZE = ? AND PATH != ?',
+                                       (digest, size, path)).fetchall()
+        for (other,) in rows:
+            try:
+                if os.path.samefile(other, path):  # Linked already
+                    return size
+                if os.path.getsize(other) != size:  # Changed after being recorded
+                    continue
+            except OSError:  # Removed after being recorded
+                continue
+            if _link(other, path):
+                print('Linked', path, 'to', other)
+                return size
+            return 0  # Linking is not supported here, keep the copy
+        return 0
+
+    def deduplicate(self, root: str) -> int:
+        """
+        Hash files under root not hashed yet, and link duplicated ones.
+        Return:
+            Bytes saved by linking.
+        """
+        root = _norm(root)
+        rows = self._db.reader.execute('SELECT PATH, KEY FROM LIBRARY WHERE HASH IS NULL AND PATH GLOB ?',
+                                       (_glob_escape(root + os.sep) + '*',)).fetchall()
+        saved = 0
+        for path, key in rows:
+            try:
+                saved += self.add(path, key, file_digest(path))
+            except OSError:  # Removed after being scanned
+                continue
+        return saved
+
+    def report(self) -> tuple:
+        """
+        Dedup statistics of hashed files.
+        Return:
+            A tuple. (dedup ratio, bytes saved)
+        """
+        logical, saved = self._db.reader.execute('SELECT TOTAL(SIZE), TOTAL(SIZE * LINKED) FROM LIBRARY').fetchone()
+        if logical <= saved:
+            return 1.0, 0
+        return logical / (logical - saved), int(saved)
+
+    def ensure_dir(self, folder: str, recheck=False):
+        """
+        Create folder if it is not known to exist.
+        Args:
+            folder: Path of the folder.
+            recheck: Create it anyway, when a write into it failed since it was removed after being indexed.
+        """
+        folder = _norm(folder)
+        with self._lock:
+            if recheck:
+                self._dirs.discard(folder)
+            elif folder in self._dirs:
+                return
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            self._dirs.add(folder)
+
+
+def _glob_escape(text: str) -> str:
+    return ''.join('[{0}]'.format(c) if c in '*?[' else c for c in text)
+
+
+def report_text() -> str:
+    """Dedup statistics for showing in dialogs."""
+    ratio, saved = get().report()
+    return '去重率：{0:.2f}，节省空间：{1:.1f} MB'.format(ratio, saved / 1e6)
+
+
+def get() -> Library:
+    """Get the shared Library instance."""
+    global _library
+    with _library_lock:
+        if _library is None:
+            _library = Library()
+        return _library
+
+
+if __name__ == '__main__':  # Skip check cost; on network shares os.path.exists is a round trip each
+    import tempfile
+
+    if sys.argv[1:]:  # Deduplicate existing files: python -m modules.library ROOT [ROOT ...]
+        for dedup_root in sys.argv[1:]:
+            get().scan(dedup_root)
+            print('Saved {0:.1f} MB under {1}'.format(get().deduplicate(dedup_root) / 1e6, dedup_root))
+        print(report_text())
+        database.close_all()
+        sys.exit()
+
+    bench_root = tempfile.mkdtemp(prefix='PETSpider_')
+    for i in range(200):
+        bench_folder = os.path.join(bench_root, str(i))
+        os.makedirs(bench_folder)
+        for j in range(50):
+            open(os.path.join(bench_folder, '{0}_p0.jpg'.format(j)), 'w').close()
+    bench_lib = Library(os.path.join(tempfile.mkdtemp(prefix='PETSpider_'), 'library.db'))
+    begin = time.perf_counter()
+    bench_lib.scan(bench_root)
+    print('scan 10000 files: {0:.3f} s'.format(time.perf_counter() - begin))
+    paths = [os.path.join(bench_root, str(i % 200), '{0}_p0.jpg'.format(i % 53)) for i in range(20000)]
+
+    begin = time.perf_counter()
+    for p in paths:
+        os.path.exists(p)
+    before = (time.perf_counter() - begin) / len(paths)
+    begin = time.perf_counter()
+    for p in paths:
+        bench_lib.exists(p)
+    after = (time.perf_counter() - begin) / len(paths)
+    print('os.path.exists: {0:.2f} us'.format(before * 1e6))
+    print('library index:  {0:.2f} us'.format(after * 1e6))
+    database.close_all()
@@ -5,13 +5,18 @@ import os
 import random
 import re
 import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
-from tempfile import NamedTemporaryFile
+from functools import lru_cache
+from itertools import product
 
 import requests
 from bs4 import BeautifulSoup
 
-from modules import globj
+from modules import core, database, library, thumbs, transfer
 
 # Define misc
 _LOGIN_URL = 'https://accounts.pixiv.net/'
@@ -19,6 +24,116 @@ _USER_URL = 'https://www.pixiv.net/ajax/user/'
 _ILLUST_URL = 'https://www.pixiv.net/ajax/illust/'
 _ROOT_URL = 'https://www.pixiv.net/'
 _SAUCENAO_URL = 'https://saucenao.com/search.php'
+_DB_PATH = 'database.db'
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS PIXIV(
+    ILLUSTID    TEXT    PRIMARY KEY NOT NULL,
+    ILLUSTTITLE TEXT    NOT NULL,
+    CREATEDATE  TEXT    NOT NULL,
+    URL         TEXT    NOT NULL,
+    THUMB       TEXT    NOT NULL,
+    USERID      TEXT    NOT NULL,
+    USERNAME    TEXT    NOT NULL,
+    PAGECOUNT   INT     NOT NULL,
+    FETCHEDAT   REAL    NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS PIXIV_USERID ON PIXIV(USERID, CREATEDATE);
+CREATE INDEX IF NOT EXISTS PIXIV_USERNAME ON PIXIV(USERNAME);
+CREATE INDEX IF NOT EXISTS PIXIV_CREATEDATE ON PIXIV(CREATEDATE);
+CREATE TABLE IF NOT EXISTS SYNCSTATE(
+    ACCOUNT     TEXT    PRIMARY KEY NOT NULL,
+    NEWEST      INT     NOT NULL,
+    SYNCEDAT    REAL    NOT NULL);
+CREATE TABLE IF NOT EXISTS FOLLOWING(
+    ACCOUNT     TEXT    NOT NULL,
+    POS         INT     NOT NULL,
+    USERID      TEXT    NOT NULL,
+    USERNAME    TEXT    NOT NULL,
+    PRIMARY KEY(ACCOUNT, POS));
+CREATE TABLE IF NOT EXISTS FOLLOWINGSTATE(
+    ACCOUNT     TEXT    PRIMARY KEY NOT NULL,
+    FETCHEDAT   REAL    NOT NULL);'''
+# Trigram index of titles and user names, finding any run of 3 characters in
+# any language, so it narrows GLOB patterns of fetcher() as well. Contentless,
+# with pid as rowid, so it stores no copy of the text and survives VACUUM
+# renumbering rowids of PIXIV.
+_FTS_SCHEMA = '''CREATE VIRTUAL TABLE IF NOT EXISTS PIXIV_FTS USING fts5(
+    ILLUSTTITLE, USERNAME, content='', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS PIXIV_FTS_INSERT AFTER INSERT ON PIXIV BEGIN
+    INSERT INTO PIXIV_FTS(rowid, ILLUSTTITLE, USERNAME)
+        VALUES (CAST(new.ILLUSTID AS INTEGER), new.ILLUSTTITLE, new.USERNAME);
+END;
+CREATE TRIGGER IF NOT EXISTS PIXIV_FTS_DELETE AFTER DELETE ON PIXIV BEGIN
+    INSERT INTO PIXIV_FTS(PIXIV_FTS, rowid, ILLUSTTITLE, USERNAME)
+        VALUES ('delete', CAST(old.ILLUSTID AS INTEGER), old.ILLUSTTITLE, old.USERNAME);
+END;
+CREATE TRIGGER IF NOT EXISTS PIXIV_FTS_UPDATE AFTER UPDATE OF ILLUSTTITLE, USERNAME ON PIXIV
+    WHEN old.ILLUSTTITLE IS NOT new.ILLUSTTITLE OR old.USERNAME IS NOT new.USERNAME BEGIN
+    INSERT INTO PIXIV_FTS(PIXIV_FTS, rowid, ILLUSTTITLE, USERNAME)
+        VALUES ('delete', CAST(old.ILLUSTID AS INTEGER), old.ILLUSTTITLE, old.USERNAME);
+    INSERT INTO PIXIV_FTS(rowid, ILLUSTTITLE, USERNAME)
+        VALUES (CAST(new.ILLUSTID AS INTEGER), new.ILLUSTTITLE, new.USERNAME);
+END;
+INSERT INTO PIXIV_FTS(rowid, ILLUSTTITLE, USERNAME)
+    SELECT CAST(ILLUSTID AS INTEGER), ILLUSTTITLE, USERNAME FROM PIXIV
+    WHERE NOT EXISTS (SELECT 1 FROM PIXIV_FTS);'''  # Index rows cached by older versions
+_SEARCH_SQL = '''SELECT PIXIV.* FROM PIXIV_FTS JOIN PIXIV ON ILLUSTID = CAST(PIXIV_FTS.rowid AS TEXT)
+    WHERE PIXIV_FTS MATCH ?{0} ORDER BY bm25(PIXIV_FTS, 2.0, 1.0) LIMIT ?'''  # Title weighs twice user name
+_no_fts = set()  # Paths of databases whose SQLite has no FTS5 trigram tokenizer
+_RE_WILDCARD = re.compile(r'[*?]|\[\^?]?[^]]*]')  # Wildcards and character classes of GLOB
+_MIN_RUN = 3  # Shorter text has no trigram to be looked up by
+_UPSERT = '''INSERT INTO PIXIV(ILLUSTID, ILLUSTTITLE, CREATEDATE, URL, THUMB, USERID, USERNAME, PAGECOUNT, FETCHEDAT)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(ILLUSTID) DO UPDATE SET
+        ILLUSTTITLE = excluded.ILLUSTTITLE,
+        CREATEDATE = excluded.CREATEDATE,
+        URL = CASE WHEN excluded.URL = '' THEN PIXIV.URL ELSE excluded.URL END,
+        THUMB = excluded.THUMB,
+        USERID = excluded.USERID,
+        USERNAME = excluded.USERNAME,
+        PAGECOUNT = excluded.PAGECOUNT,
+        FETCHEDAT = excluded.FETCHEDAT'''
+_CHUNK_SIZE = 500  # Keep bound parameters under SQLITE_MAX_VARIABLE_NUMBER
+STALE_TTL = 7 * 86400  # Default seconds before a cached row should be refreshed in background
+EXPIRE_TTL = 90 * 86400  # Default seconds before a cached row is fetched again
+_BATCH_SIZE = 48  # Max works per request of profile/illusts
+_MAX_NEW_PAGE = 100  # The limitation of page number of following's new illustration
+_MAX_FOLLOWING_PAGE = 500  # Pages of 48 users, beyond the limitation of following count
+FOLLOWING_TTL = 86400  # Default seconds before a cached following list is crawled again
+_host_limiter = transfer.HostLimiter(4)  # Concurrent API requests per host, shared by all fetching threads
+_API_POOL = 8  # Detail requests held by _host_limiter, plus feed pages of iter_new()
+_IMAGE_URL = 'https://i.pximg.net/'
+RATE_HOSTS = {'request': ('pixiv.net',),  # Host suffixes paced by transfer.rate_limiter
+              'bytes': ('pximg.net',)}
+_url_locks = {}  # Lock of every illustration whose original url is being resolved
+_url_locks_lock = threading.Lock()
+
+
+def _migrate(pdb):
+    """Add columns missing in databases created by older versions."""
+    cols = database.columns(pdb, 'PIXIV')
+    if cols and 'FETCHEDAT' not in cols:
+        pdb.execute('ALTER TABLE PIXIV ADD COLUMN FETCHEDAT REAL NOT NULL DEFAULT 0')
+        pdb.execute('UPDATE PIXIV SET FETCHEDAT = ?', (time.time(),))  # Age of old rows is unknown, count from now
+
+
+def _migrate_fts(pdb):
+    """Drop the word index created by older versions, rebuilt with trigrams by _FTS_SCHEMA."""
+    row = pdb.execute("SELECT sql FROM sqlite_master WHERE name = 'PIXIV_FTS'").fetchone()
+    if row and 'trigram' not in row[0]:
+        for trigger in ('PIXIV_FTS_INSERT', 'PIXIV_FTS_DELETE', 'PIXIV_FTS_UPDATE'):  # Kept if trigram is missing
+            pdb.execute('DROP TRIGGER IF EXISTS ' + trigger)
+        pdb.execute('DROP TABLE PIXIV_FTS')
+
+
+def init_db(db_path: str = None) -> database.Database:
+    """Open the shared database, or the one at db_path, and set up schema. Call it once at startup."""
+    db = database.get(db_path or _DB_PATH, _SCHEMA, _migrate)
+    if db.path not in _no_fts:
+        try:
+            db.ensure(_FTS_SCHEMA, _migrate_fts)
+        except sqlite3.OperationalError as e:  # Built without FTS5 or trigram, searches fall back to scans
+            print(repr(e))
+            _no_fts.add(db.path)
+    return db
 
 
 def login(se, c) -> bool:
@@ -37,12 +152,12 @@ def login(se, c) -> bool:
     #         pk_html = BeautifulSoup(pk_res.text, 'lxml')
     #     pk_node = pk_html.find('input', attrs={'name': 'post_key'})
     #     if not pk_node:
-    #         raise globj.ResponseError('Cannot fetch post key.')
+    #         raise core.ResponseError('Cannot fetch post key.')
     #
     #     login_form = {'password': pw,
     #                   'pixiv_id': uid,
     #                   'post_key': pk_node['value'],
-    #                   'User-Agent': random.choice(globj.GlobalVar.user_agent)}
+    #                   'User-Agent': random.choice(core.GlobalVar.user_agent)}
     #     with requests.post(_LOGIN_URL + 'api/login',
     #                        proxies=proxy,
     #                        data=login_form,
@@ -51,7 +166,7 @@ def login(se, c) -> bool:
     #         login_json = json.loads(login_res.text)['body']
     #         print(login_json)
     #         if 'validation_errors' in login_json:
-    #             raise globj.ValidationError(login_json['validation_errors'])
+    #             raise core.ValidationError(login_json['validation_errors'])
     #         elif 'success' in login_json:
     #             se.cookies.update(login_res.cookies)
     #             return True
@@ -59,7 +174,7 @@ def login(se, c) -> bool:
     #             return False
     # except requests.Timeout:
     #     raise requests.Timeout('Timeout during login.')
-    # except (globj.ResponseError, globj.ValidationError):
+    # except (core.ResponseError, core.ValidationError):
     #     raise
 
 
@@ -71,102 +186,235 @@ def get_user(se, proxy: dict) -> tuple:
                     timeout=5,
                     headers={
                         'Referer': 'https://www.pixiv.net/',
-                        'User-Agent': random.choice(globj.GlobalVar.user_agent)}
+                        'User-Agent': random.choice(core.GlobalVar.user_agent)}
                     ) as user_res:
             user_info = re.findall(r'"userData":{"id":"(\d{1,10})","pixivId":"(.*)","name":"(.*)","profileImg":',
                                    user_res.text)
 
         if not user_info:
-            raise globj.ResponseError('Cannot fetch user info.')
+            raise core.ResponseError('Cannot fetch user info.')
 
         user_id = user_info[0][0]
         user_name = user_info[0][2]
         return user_id, user_name
     except requests.Timeout:
         raise requests.Timeout('Timeout during getting user info.')
-    except globj.ResponseError:
+    except core.ResponseError:
         raise
 
 
-def get_following(se, proxy: dict) -> dict:
-    """Get the list of loginned user's following."""
-    try:
-        with se.get(_ROOT_URL + 'bookmark.php',
-                    params={'type': 'user'},
-                    proxies=proxy,
-                    timeout=5) as fo_res:
-            fo_html = BeautifulSoup(fo_res.text, 'lxml')
-        fo_node = fo_html.find_all('div', class_='userdata')
-        if not fo_node:
-            raise globj.ResponseError('Cannot fetch following info.')
-
-        fo_info = {ele.a['data-user_id']: ele.a['data-user_name'] for ele in fo_node}
-        return fo_info
-    except requests.Timeout:
-        raise requests.Timeout('Timeout during getting following info.')
-    except globj.ResponseError:
-        raise
+def _following_page(se, proxy: dict, page: int) -> list:
+    """Get (user id, user name) on one page of following, empty after the last page."""
+    with se.get(_ROOT_URL + 'bookmark.php',
+                params={'type': 'user', 'p': str(page)},
+                proxies=proxy,
+                timeout=5) as fo_res:
+        fo_html = BeautifulSoup(fo_res.text, 'lxml')
+    return [(ele.a['data-user_id'], ele.a['data-user_name']) for ele in fo_html.find_all('div', class_='userdata')]
 
 
-def get_new(se, proxy: dict = None, num: int = 0, user_id: str = None) -> set:
+def cached_following(account: str, ttl: float = FOLLOWING_TTL) -> list:
     """
-    Get new items of following or specified user.
+    Get the following list of account stored by iter_following().
+    Return:
+        A list of (user id, user name) in the order of pixiv, or None if it
+        is never crawled or crawled more than ttl seconds ago.
+    """
+    reader = init_db().reader
+    row = reader.execute('SELECT FETCHEDAT FROM FOLLOWINGSTATE WHERE ACCOUNT = ?', (account,)).fetchone()
+    if not row or time.time() - row[0] > ttl:
+        return None
+    return reader.execute('SELECT USERID, USERNAME FROM FOLLOWING WHERE ACCOUNT = ? ORDER BY POS',
+                          (account,)).fetchall()
+
+
+def iter_following(se, proxy: dict = None, account: str = None, ttl: float = FOLLOWING_TTL, workers: int = 4):
+    """
+    Get the following list of loginned user page by page.
     Args:
         se: Session instance.
         proxy: (optinal) the proxy used.
-        num: (optinal when user_id specified) the number of illustration
-            will be downloaded. If user_id specified and num omitted,
-            all illustration will be downloaded.
-        user_id: (optinal) the id of the aimed user. If not given, the new
-            illustration will be fetched from following.
+        account: (optinal) Pixiv id of loginned user. If given, a list crawled
+            within ttl seconds is read from database, and a crawled list is
+            stored once all pages are fetched.
+        ttl: (optinal) Seconds a stored list is fresh, 0 to crawl anyway.
+        workers: (optinal) Number of pages fetched in parallel.
     Return:
-        A set of pixiv ids fetched.
+        A generator yielding lists of (user id, user name), one list per page.
+        Pages are fetched ahead by a sliding window of 'workers' pages, until
+        the first empty page.
     """
+    if account and ttl:
+        users = cached_following(account, ttl)
+        if users is not None:
+            if users:
+                yield users
+            return
+
+    users = []
+    seen = set()
     try:
-        item_dic = {}
-        if user_id:  # Fetch user's new illustration
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque(executor.submit(_following_page, se, proxy, p) for p in range(1, workers + 1))
+            next_page = len(pending) + 1
+            try:
+                first = True
+                while pending:
+                    page_users = pending.popleft().result()
+                    if not page_users:
+                        if first:
+                            raise core.ResponseError('Cannot fetch following info.')
+                        break
+                    first = False
+                    if next_page <= _MAX_FOLLOWING_PAGE:  # Keep the window full
+                        pending.append(executor.submit(_following_page, se, proxy, next_page))
+                        next_page += 1
+                    page_users = [user for user in page_users if user[0] not in seen]  # Shifted by new follows
+                    seen.update(uid for uid, _ in page_users)
+                    users.extend(page_users)
+                    if page_users:
+                        yield page_users
+            finally:
+                for future in pending:
+                    future.cancel()
+    except requests.Timeout:
+        raise requests.Timeout('Timeout during getting following info.')
+
+    if account:  # Complete, replace the stored list
+        with init_db().writer() as pdb:
+            pdb.execute('DELETE FROM FOLLOWING WHERE ACCOUNT = ?', (account,))
+            pdb.executemany('INSERT INTO FOLLOWING VALUES (?, ?, ?, ?)',
+                            ((account, pos, uid, name) for pos, (uid, name) in enumerate(users)))
+            pdb.execute('INSERT OR REPLACE INTO FOLLOWINGSTATE VALUES (?, ?)', (account, time.time()))
+
+
+def get_following(se, proxy: dict, account: str = None, ttl: float = FOLLOWING_TTL, workers: int = 4) -> dict:
+    """
+    Get the list of loginned user's following. Args are the same as iter_following().
+    Return:
+        A dict of {user id: user name}, in the order of pixiv.
+    """
+    return {uid: name for users in iter_following(se, proxy, account, ttl, workers) for uid, name in users}
+
+
+def _new_page(se, proxy: dict, page: int) -> list:
+    """Get illustration ids on one page of following's new illustration, newest first."""
+    with se.get(_ROOT_URL + 'bookmark_new_illust.php',
+                params={'p': str(page)},
+                proxies=proxy,
+                timeout=5) as new_res:
+        new_html = BeautifulSoup(new_res.text, 'lxml')
+    new_node = new_html.find(id='js-mount-point-latest-following')
+    if not new_node:
+        raise core.ResponseError('Cannot fetch new following items.')
+    return [item['illustId'] for item in json.loads(new_node['data-items'])]
+
+
+def iter_new(se, proxy: dict = None, num: int = 0, user_id: str = None, since: int = None, workers: int = 4):
+    """
+    Get new items of following or specified user page by page.
+    Args are the same as get_new().
+    Return:
+        A generator yielding lists of new pixiv ids, one list per page, newest
+        first. Following pages are fetched ahead by a sliding window of
+        'workers' pages, so the consumer can work on a page while the next
+        ones are loading.
+    """
+    try:
+        if user_id:  # Fetch user's new illustration, all ids come in one response
             with se.get(_USER_URL + user_id + '/profile/all',
                         proxies=proxy,
                         timeout=5) as user_res:
                 user_json = json.loads(user_res.text)
             if user_json['error']:
-                raise globj.ResponseError(user_json['message'] + '(user pic)')
+                raise core.ResponseError(user_json['message'] + '(user pic)')
             user_json = user_json['body']
             if user_json['manga'] and user_json['illusts']:  # Combine illustration and comic into one dict
                 item_dic = {**user_json['illusts'], **user_json['manga']}
             else:
                 item_dic = user_json['manga'] if user_json['manga'] else user_json['illusts']
-
-        else:  # Fetch following's new illustration
-            if num // 20 + 1 > 100:  # the limitation of page number is 100
-                pn = 100
-            else:
-                pn = num // 20 + 1 if num else 0
-            for p in range(pn):
-                with se.get(_ROOT_URL + 'bookmark_new_illust.php',
-                            params={'p': str(p + 1)},
-                            proxies=proxy,
-                            timeout=5) as new_res:
-                    new_html = BeautifulSoup(new_res.text, 'lxml')
-                new_node = new_html.find(id='js-mount-point-latest-following')
-                if not new_node:
-                    raise globj.ResponseError('Cannot fetch new following items.')
-                p_json = json.loads(new_node['data-items'])
-                item_dic.update({item['illustId']: None for item in p_json})
-
-        item_set = set()
-        for item in item_dic:
-            item_set.add(item)
-            if len(item_set) == num:
-                return item_set
-        return item_set
+            ids = list(item_dic)[:num] if num else list(item_dic)
+            if ids:
+                yield ids
+            return
+
+        # Fetch following's new illustration
+        if since is not None:
+            pn = min(num // 20 + 1, _MAX_NEW_PAGE) if num else _MAX_NEW_PAGE
+        else:
+            pn = min(num // 20 + 1, _MAX_NEW_PAGE) if num else 0
+        seen = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque(executor.submit(_new_page, se, proxy, p) for p in range(1, min(workers, pn) + 1))
+            next_page = len(pending) + 1
+            try:
+                while pending:
+                    ids = pending.popleft().result()
+                    if next_page <= pn:  # Keep the window full
+                        pending.append(executor.submit(_new_page, se, proxy, next_page))
+                        next_page += 1
+                    if since is not None:
+                        ids = [pid for pid in ids if int(pid) > since]
+                    if not ids:  # Known or empty page, stop paging
+                        break
+                    ids = [pid for pid in ids if pid not in seen]
+                    if num:
+                        ids = ids[:num - len(seen)]
+                    seen.update(ids)
+                    if ids:
+                        yield ids
+                    if num and len(seen) >= num:
+                        break
+            finally:
+                for future in pending:
+                    future.cancel()
 
     except requests.Timeout:
         raise requests.Timeout('Timeout during getting new items.')
-    except globj.ResponseError:
+    except core.ResponseError:
         raise
 
 
+def get_new(se, proxy: dict = None, num: int = 0, user_id: str = None, since: int = None, workers: int = 4) -> set:
+    """
+    Get new items of following or specified user.
+    Args:
+        se: Session instance.
+        proxy: (optinal) the proxy used.
+        num: (optinal when user_id or since specified) the number of illustration
+            will be downloaded. If user_id specified and num omitted,
+            all illustration will be downloaded.
+        user_id: (optinal) the id of the aimed user. If not given, the new
+            illustration will be fetched from following.
+        since: (optinal) Incremental sync of following. Only ids newer than
+            this high-water mark are returned, paging stops at the first page
+            contains no newer id. See get_mark().
+        workers: (optinal) Number of following pages fetched in parallel.
+    Return:
+        A set of pixiv ids fetched.
+    """
+    item_set = set()
+    for ids in iter_new(se, proxy, num, user_id, since, workers):
+        item_set.update(ids)
+    return item_set
+
+
+def get_mark(account: str) -> int:
+    """Get the newest illustration id synced of following for given account, 0 if never synced."""
+    row = init_db().reader.execute('SELECT NEWEST FROM SYNCSTATE WHERE ACCOUNT = ?', (account,)).fetchone()
+    return row[0] if row else 0
+
+
+def set_mark(account: str, pids):
+    """Raise the high-water mark of account to the newest id in pids. Call it after items are stored."""
+    newest = max((int(pid) for pid in pids), default=0)
+    with init_db().writer() as pdb:
+        pdb.execute('''INSERT INTO SYNCSTATE VALUES (?, ?, ?)
+            ON CONFLICT(ACCOUNT) DO UPDATE SET
+                NEWEST = MAX(NEWEST, excluded.NEWEST),
+                SYNCEDAT = excluded.SYNCEDAT''', (account, newest, time.time()))
+
+
 def get_detail(se, pid: str, proxy: dict = None) -> dict:
     """
     Get detail of specified illustration.
@@ -185,7 +433,7 @@ def get_detail(se, pid: str, proxy: dict = None) -> dict:
                     timeout=5) as item_detail:
             item_json = json.loads(item_detail.text)
         if item_json['error']:
-            raise globj.ResponseError(item_json['message'] + '(illust detail)')
+            raise core.ResponseError(item_json['message'] + '(illust detail)')
 
         item_json = item_json['body']
         create_date = item_json['createDate'].split('T')[0]
@@ -201,10 +449,123 @@ def get_detail(se, pid: str, proxy: dict = None) -> dict:
         }
     except requests.Timeout:
         raise requests.Timeout('Timeout during getting illust detail.')
-    except globj.ResponseError:
+    except core.ResponseError:
         raise
 
 
+def get_details(se, user_id: str, pids: list, proxy: dict = None) -> list:
+    """
+    Get detail of at most 48 illustrations of one user in one request.
+    The original url is not provided by this api, so 'url' is left empty
+    and should be resolved by resolve_url() before downloading.
+    Args:
+        se: Session instance.
+        user_id: The id of the user who owns these illustrations.
+        pids: A list of illustration id.
+        proxy: (optinal) the proxy used.
+    Return:
+        A list of dicts in the same shape as get_detail() returns.
+    """
+    re_thumb = re.compile(r'/c/[^/]+/')
+
+    try:
+        with se.get(_USER_URL + user_id + '/profile/illusts',
+                    params={'ids[]': pids, 'work_category': 'illustManga', 'is_first_page': 0},
+                    proxies=proxy,
+                    timeout=5) as works_res:
+            works_json = json.loads(works_res.text)
+        if works_json['error']:
+            raise core.ResponseError(works_json['message'] + '(user works)')
+
+        return [{
+            'illustId': work['id'],
+            'illustTitle': work['title'],
+            'createDate': work['createDate'].split('T')[0],
+            'url': '',
+            'thumb': re_thumb.sub('/c/150x150/', work['url']),
+            'userId': work['userId'],
+            'userName': work['userName'],
+            'pageCount': work['pageCount']
+        } for work in works_json['body']['works'].values()]
+    except requests.Timeout:
+        raise requests.Timeout('Timeout during getting user works.')
+    except core.ResponseError:
+        raise
+
+
+def resolve_url(se, item: dict, proxy: dict = None) -> dict:
+    """
+    Fill the original url of an item generated by get_details(). Thread safe,
+    page threads sharing the same item send only one request.
+    """
+    with _url_locks_lock:
+        lock = _url_locks.setdefault(item['illustId'], threading.Lock())
+    with lock:
+        if not item['url']:
+            detail = _limited_detail(se, item['illustId'], proxy)[0]
+            pusher([detail])
+            item['url'] = detail['url']
+    with _url_locks_lock:
+        _url_locks.pop(item['illustId'], None)
+    return item
+
+
+def _limited_detail(se, pid: str, proxy: dict) -> list:
+    with _host_limiter.hold(_ILLUST_URL):
+        return [get_detail(se, pid, proxy)]
+
+
+def _limited_details(se, user_id: str, pids: list, proxy: dict) -> list:
+    with _host_limiter.hold(_USER_URL):
+        items = get_details(se, user_id, pids, proxy)
+    found = {item['illustId'] for item in items}
+    for pid in pids:  # Works not listed by the batch api, ask one by one
+        if pid not in found:
+            items.extend(_limited_detail(se, pid, proxy))
+    return items
+
+
+def fetch_details(se, pids, proxy: dict = None, workers: int = 8, ignore_errors: bool = False, user_id: str = None):
+    """
+    Get detail of many illustrations concurrently.
+    Args:
+        se: Session instance.
+        pids: An iterable of illustration ids.
+        proxy: (optinal) the proxy used.
+        workers: (optinal) Size of the worker pool. Requests per host are
+            further limited by a limiter shared across all calls.
+        ignore_errors: (optinal) Skip failed ids instead of raising.
+        user_id: (optinal) If all illustrations belong to this user, fetch
+            48 of them per request by get_details().
+    Return:
+        A generator yielding detail dicts in the order they arrive.
+        Exceptions of get_detail are raised from it and cancel the rest.
+    """
+    pids = list(pids)
+    if not pids:
+        return
+    if user_id:
+        tasks = [(_limited_details, se, user_id, pids[i:i + _BATCH_SIZE], proxy)
+                 for i in range(0, len(pids), _BATCH_SIZE)]
+    else:
+        tasks = [(_limited_detail, se, pid, proxy) for pid in pids]
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(tasks)))
+    futures = {}
+    try:
+        futures = {executor.submit(*task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                yield from future.result()
+            except (requests.exceptions.RequestException, core.ResponseError) as e:
+                if not ignore_errors:
+                    raise
+                print('Detail failed:', futures[future][2], repr(e))
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
 def saucenao(path: str, sim: float):
     """Search pixiv id by picture, use sauceNAO engine."""
     try:
@@ -241,37 +602,37 @@ def path_name(item: dict, save_path: str, folder_rule: dict = None, file_rule: d
     else:
         folder_name = ''
         for i in range(len(folder_rule)):
-            next_name = globj.name_verify(str(item[folder_rule[i]]), item['userId'])
+            next_name = core.name_verify(str(item[folder_rule[i]]), item['userId'])
             folder_name = os.path.join(folder_name, next_name)
         folder_name = os.path.join(save_path, folder_name)
 
     if file_rule is None:
         file_name = item['illustId']  # Default folder name: illustId
     else:
-        raw = (globj.name_verify(str(item[file_rule[i]]), item['userId']) for i in range(len(file_rule)))
+        raw = (core.name_verify(str(item[file_rule[i]]), item['userId']) for i in range(len(file_rule)))
         file_name = '_'.join(raw)  # File name without page number and ext
 
     return folder_name, file_name
 
 
+def pools(concurrency: int) -> dict:
+    """
+    Connection pool sizes of pixiv hosts, for transfer.mount_pools().
+    Args:
+        concurrency: Number of pictures downloaded at the same time.
+    """
+    return {_ROOT_URL: _API_POOL,
+            _IMAGE_URL: concurrency + 1}  # Download threads and the thumbnail thread
+
+
 def download_thumb(se, proxy: dict, item: dict) -> str:
-    """Download thumbnail to a temp folder."""
+    """Download thumbnail into the thumbnail cache, or find it there."""
     header = {'Referer': _ROOT_URL,
-              'User-Agent': random.choice(globj.GlobalVar.user_agent)}
+              'User-Agent': random.choice(core.GlobalVar.user_agent)}
     try:
-        with se.get(item['thumb'],
-                    headers=header,
-                    proxies=proxy,
-                    stream=True,
-                    timeout=5) as thumb_res:
-            with NamedTemporaryFile('w+b', prefix='PETSpider_', delete=False) as thumb:
-                for chunk in thumb_res.iter_content():
-                    thumb.write(chunk)
-                path = thumb.name
+        return thumbs.get().fetch(se, item['thumb'], header, proxy)
     except (OSError, IOError):
         return ''
-    else:
-        return path
 
 
 def download_pic(se, proxy: dict, item: dict, path: tuple, page: int):
@@ -283,40 +644,117 @@ def download_pic(se, proxy: dict, item: dict, path: tuple, page: int):
         item: An instance generated by get_new().
         path: Save path. A tuple generated by path_name().
         page: The current page number.
+    Return:
+        A transfer.TransferStats instance, or None if the page is owned already.
     """
     referer = 'https://www.pixiv.net/member_illust.php?mode=medium&illust_id=' + item['illustId']
     re_page = re.compile(r'_p0')
+    lib = library.get()
+    owned = page_owned(path, page)
+    if owned:  # If file exists, skip it
+        print('skip', owned)
+        return None
+    if not item['url']:  # Fetched by get_details(), original url is unknown yet
+        resolve_url(se, item, proxy)
 
     real_url = re_page.sub('_p' + str(page), item['url']) if item['pageCount'] > 1 else item['url']
-    try:  # Prevent threads starting at same time
-        os.makedirs(path[0])
-        print('mkdir:', path[0])
-    except FileExistsError:
-        pass
+    lib.ensure_dir(path[0])
     file_name = ''.join((path[1], '_p', str(page), os.path.splitext(real_url)[1]))
     file_path = os.path.join(path[0], file_name)
-    if not os.path.exists(file_path):  # If file exists, skip it
-        print('downloading', file_path)
-        header = {'Referer': referer,
-                  'User-Agent': random.choice(globj.GlobalVar.user_agent)}
-        se.headers.update(header)
+    print('downloading', file_path)
+    header = {'Referer': referer,
+              'User-Agent': random.choice(core.GlobalVar.user_agent)}
+    se.headers.update(header)
+    try:
         try:
-            with se.get(real_url,
-                        headers=header,
-                        proxies=proxy,
-                        stream=True,
-                        timeout=5) as pic_res:
-                with open(file_path, 'ab') as data:
-                    for chunk in pic_res.iter_content():
-                        data.write(chunk)
-        except requests.Timeout:
-            raise requests.Timeout('Timeout during retrieving', item['url'])
-    else:
-        print('skip', file_path)
+            stats = transfer.download_file(se, real_url, file_path, header, proxy)
+        except FileNotFoundError:  # Folder removed after being indexed
+            lib.ensure_dir(path[0], recheck=True)
+            stats = transfer.download_file(se, real_url, file_path, header, proxy)
+        print('downloaded', file_path, stats)
+    except requests.Timeout:
+        raise requests.Timeout('Timeout during retrieving', item['url'])
+    lib.add(file_path, digest=stats.digest)
+    return stats
+
+
+def page_owned(path: tuple, page: int) -> str:
+    """
+    Check the library index for a downloaded page, whatever its extension.
+    Args:
+        path: Save path. A tuple generated by path_name().
+        page: The page number.
+    Return:
+        Path of the file if owned, or ''.
+    """
+    return library.get().find_stem(path[0], ''.join((path[1], '_p', str(page))))
+
+
+def _row_item(row) -> dict:
+    """Convert a row of PIXIV table to illustration info dict."""
+    return {
+        'illustId': row[0],
+        'illustTitle': row[1],
+        'createDate': row[2],
+        'url': row[3],
+        'thumb': row[4],
+        'userId': row[5],
+        'userName': row[6],
+        'pageCount': row[7]
+    }
+
+
+@lru_cache(maxsize=None)
+def _select_sql(pname: bool, uid: bool, uname: bool, match: bool = False) -> str:
+    """
+    Build the SELECT statement of one query shape.
+    Same shape always gets the same string, so sqlite3 reuses its prepared statement.
+    """
+    conditions = ['CREATEDATE >= ?', 'CREATEDATE <= ?']
+    if pname:
+        conditions.append('ILLUSTTITLE GLOB ?')
+    if uid:
+        conditions.append('USERID = ?')
+    if uname:
+        conditions.append('USERNAME GLOB ?')
+    if match:  # Candidates found by index, checked by the GLOB above
+        conditions.append('ILLUSTID IN (SELECT CAST(rowid AS TEXT) FROM PIXIV_FTS WHERE PIXIV_FTS MATCH ?)')
+    return 'SELECT * FROM PIXIV WHERE ' + ' AND '.join(conditions)
+
+
+def _phrase(text: str) -> str:
+    return '"{0}"'.format(text.replace('"', '""'))
+
+
+def _pattern_query(pname: str = None, uname: str = None) -> str:
+    """
+    Build an FTS5 query of rows which may match GLOB patterns of title and user
+    name, by the runs of each pattern without wildcards.
+    Return:
+        The query, '' if no run is long enough to be looked up.
+    """
+    parts = []
+    for column, pattern in (('ILLUSTTITLE', pname), ('USERNAME', uname)):
+        runs = [run for run in _RE_WILDCARD.split(pattern or '') if len(run) >= _MIN_RUN]
+        if runs:
+            parts.append('{0} : ({1})'.format(column, ' AND '.join(_phrase(run) for run in runs)))
+    return ' AND '.join(parts)
+
+
+def _select_query(pname: str = None, uid: str = None, uname: str = None,
+                  t_upper: str = '2007-01-01', t_lower: str = None, indexed: bool = False) -> tuple:
+    """
+    Return SQL and bound parameters for a fetcher() search.
+    With indexed, name patterns are looked up in PIXIV_FTS instead of scanned.
+    """
+    match = _pattern_query(pname, uname) if indexed else ''
+    params = [t_upper, t_lower or str(date.today())]
+    params.extend(arg for arg in (pname, uid, uname, match) if arg)
+    return _select_sql(bool(pname), bool(uid), bool(uname), bool(match)), params
 
 
 def fetcher(pid: str = None, pname: str = None, uid: str = None,
-            uname: str = None, t_upper: str = '2007-01-01', t_lower: str = str(date.today())):
+            uname: str = None, t_upper: str = '2007-01-01', t_lower: str = None, db: database.Database = None):
     """
     Fetch illustration info out of database. Run it in thread.
     At least one parameter must be passed in.
@@ -327,78 +765,106 @@ def fetcher(pid: str = None, pname: str = None, uid: str = None,
         uid: (optinal) The id of user.
         uname: (optinal) The name of user. Support wildcard.
         t_upper: (optinal) Fetch illustration AFTER this time. Format: YYYY-MM-DD.
-        t_lower: (optinal) Fetch illustration BEFORE this time. Format: YYYY-MM-DD.
+        t_lower: (optinal) Fetch illustration BEFORE this time. Format: YYYY-MM-DD. Default today.
+        db: (optinal) Database to read, given by init_db(). Default the shared one.
     Return:
-        If pid specified, return a dictionary, or return a generator of required illustration info.
+        If pid specified, return a dictionary, or return a list of required illustration info.
     """
     try:
-        pdb = sqlite3.connect('database.db')
-        cursor = pdb.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS PIXIV(
-                ILLUSTID    TEXT    PRIMARY KEY NOT NULL,
-                ILLUSTTITLE TEXT    NOT NULL,
-                CREATEDATE  TEXT    NOT NULL,
-                URL         TEXT    NOT NULL,
-                THUMB       TEXT    NOT NULL,
-                USERID      TEXT    NOT NULL,
-                USERNAME    TEXT    NOT NULL,
-                PAGECOUNT   INT     NOT NULL);''')
-
+        db = db or init_db()
+        cursor = db.reader.cursor()
         if pid:  # If pid specified, the other args are ignored
-            cursor.execute("SELECT * FROM PIXIV WHERE ILLUSTID = '{0}'".format(pid))
+            cursor.execute('SELECT * FROM PIXIV WHERE ILLUSTID = ?', (pid,))
             result = cursor.fetchone()
-            return {
-                'illustId': result[0],
-                'illustTitle': result[1],
-                'createDate': result[2],
-                'url': result[3],
-                'thumb': result[4],
-                'userId': result[5],
-                'userName': result[6],
-                'pageCount': result[7]
-            } if result else None
+            return _row_item(result) if result else None
         else:
-            select_str = "CREATEDATE >= '{0}' AND CREATEDATE <= '{1}'".format(t_upper, t_lower)
-            if pname:
-                select_str = "{0} AND ILLUSTTITLE GLOB '{1}'".format(select_str, pname)
-            if uid:
-                select_str = "{0} AND USERID = '{1}'".format(select_str, uid)
-            if uname:
-                select_str = "{0} AND USERNAME GLOB '{1}'".format(select_str, uname)
-            cursor.execute('SELECT * FROM PIXIV WHERE ' + select_str)
-            return ({
-                'illustId': row[0],
-                'illustTitle': row[1],
-                'createDate': row[2],
-                'url': row[3],
-                'thumb': row[4],
-                'userId': row[5],
-                'userName': row[6],
-                'pageCount': row[7]
-            } for row in cursor)
+            cursor.execute(*_select_query(pname, uid, uname, t_upper, t_lower, db.path not in _no_fts))
+            return [_row_item(row) for row in cursor.fetchall()]  # Ends the read, the reader is shared by the thread
     except sqlite3.OperationalError as e:
         print(repr(e))
         return None
 
 
-def pusher(all_item: list):
+def _contains(text: str) -> str:
+    """LIKE pattern of text anywhere, escaped by backslash."""
+    return '%{0}%'.format(re.sub(r'([\\%_])', r'\\\1', text))
+
+
+def search(text: str, uid: str = None, limit: int = 200) -> list:
+    """
+    Search cached illustrations by title and user name, best matches first.
+    Every word must be found in the title or the user name, ignoring case, so
+    'sky blu' finds 'Blue Sky', and words of Japanese titles are found without
+    spaces. Words shorter than 3 characters are checked on the rows found by
+    the others, or by a scan if all words are that short. Run it in thread.
+    Args:
+        text: Words separated by spaces.
+        uid: (optinal) Only search works of this user.
+        limit: (optinal) Max number of results.
+    Return:
+        A list of illustration info dicts.
+    """
+    words = text.split()
+    if not words:
+        return []
+    db = init_db()
+    indexed = [word for word in words if len(word) >= _MIN_RUN] if db.path not in _no_fts else []
+    scanned = [word for word in words if len(word) < _MIN_RUN] if indexed else words
+    conditions = ["(PIXIV.ILLUSTTITLE LIKE ? ESCAPE '\\' OR PIXIV.USERNAME LIKE ? ESCAPE '\\')"] * len(scanned)
+    params = [pattern for word in scanned for pattern in [_contains(word)] * 2]
+    if uid:
+        conditions.append('USERID = ?')
+        params.append(uid)
+    if indexed:
+        sql = _SEARCH_SQL.format(''.join(' AND ' + condition for condition in conditions))
+        params.insert(0, ' '.join(_phrase(word) for word in indexed))
+    else:
+        sql = 'SELECT * FROM PIXIV WHERE {0} ORDER BY CREATEDATE DESC LIMIT ?'.format(' AND '.join(conditions))
+    return [_row_item(row) for row in db.reader.execute(sql, params + [limit])]
+
+
+def fetch_many(pids, stale: float = STALE_TTL, expire: float = EXPIRE_TTL) -> tuple:
+    """
+    Fetch info of many illustrations out of database at once. Run it in thread.
+    Args:
+        pids: An iterable of illustration ids.
+        stale: (optinal) Seconds after which a cached row is reported as stale.
+            Stale rows are still returned as hits. 0 means never stale.
+        expire: (optinal) Seconds after which a cached row is treated as a miss.
+            0 means never expire.
+    Return:
+        A tuple of three values. A dict of {pid: info} found in database,
+        a list of pids not in database or expired, in the given order,
+        and a list of pids in hits which are stale.
+    """
+    pids = list(dict.fromkeys(str(pid) for pid in pids))  # Remove duplicates and keep order
+    now = time.time()
+    hits = {}
+    stale_list = []
+    cursor = init_db().reader.cursor()
+    for i in range(0, len(pids), _CHUNK_SIZE):
+        chunk = pids[i:i + _CHUNK_SIZE]
+        cursor.execute('SELECT * FROM PIXIV WHERE ILLUSTID IN ({0})'.format(', '.join('?' * len(chunk))), chunk)
+        for row in cursor:
+            age = now - row[8]
+            if expire and age > expire:
+                continue
+            hits[row[0]] = _row_item(row)
+            if stale and age > stale:
+                stale_list.append(row[0])
+    misses = [pid for pid in pids if pid not in hits]
+    return hits, misses, stale_list
+
+
+def pusher(all_item: list, db: database.Database = None):
     """
     Push illustration info into database. Run it in thread.
+    Existing rows are updated and marked as freshly fetched.
     Args:
         all_item: A list of dictionary that contains the illustration info.
+        db: (optinal) Database to write, given by init_db(). Default the shared one.
     """
-    pdb = sqlite3.connect('database.db')
-    cursor = pdb.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS PIXIV(
-        ILLUSTID    TEXT    PRIMARY KEY NOT NULL,
-        ILLUSTTITLE TEXT    NOT NULL,
-        CREATEDATE  TEXT    NOT NULL,
-        URL         TEXT    NOT NULL,
-        THUMB       TEXT    NOT NULL,
-        USERID      TEXT    NOT NULL,
-        USERNAME    TEXT    NOT NULL,
-        PAGECOUNT   INT     NOT NULL);''')
-
+    now = time.time()
     data = ((
         item['illustId'],
         item['illustTitle'],
@@ -407,24 +873,77 @@ def pusher(all_item: list):
         item['thumb'],
         item['userId'],
         item['userName'],
-        item['pageCount']
+        item['pageCount'],
+        now
     ) for item in all_item)
-    cursor.executemany('INSERT INTO PIXIV VALUES (?, ?, ?, ?, ?, ?, ?, ?)', data)
-    pdb.commit()
-    pdb.close()
+    with (db or init_db()).writer() as pdb:
+        pdb.executemany(_UPSERT, data)
 
 
 def cleaner():
     """Clear database info cache."""
-    pdb = sqlite3.connect('database.db')
-    cursor = pdb.cursor()
-    cursor.execute('''SELECT NAME FROM SQLITE_MASTER WHERE TYPE='table';''')
-    tables = cursor.fetchall()
-    for name in tables[0]:
-        cursor.execute('''DELETE FROM {0};'''.format(name))
-    pdb.commit()
-    pdb.close()
+    with init_db().writer() as pdb:
+        tables = pdb.execute("SELECT NAME FROM SQLITE_MASTER WHERE TYPE = 'table';").fetchall()
+        for (name,) in tables:
+            if not name.startswith('PIXIV_FTS'):  # Emptied by triggers of PIXIV
+                pdb.execute('DELETE FROM {0};'.format(name))
+
+
+def check_query_plans() -> dict:
+    """
+    Run EXPLAIN QUERY PLAN for every filter combination of fetcher().
+    Return:
+        A dict of {(pname, uid, uname): plan} whose plan scans PIXIV without index.
+        An empty dict means every combination uses an index.
+    """
+    db = init_db()
+    full_scan = {}
+    for shape in product((False, True), repeat=3):
+        args = [arg if used else None for arg, used in zip(('*title*', '12345', '*name*'), shape)]
+        sql, params = _select_query(*args, indexed=db.path not in _no_fts)
+        plan = [row[-1] for row in db.reader.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        if not any('INDEX' in detail for detail in plan):
+            full_scan[shape] = plan
+    return full_scan
 
 
 if __name__ == '__main__':
-    pass
+    import tempfile
+
+    _DB_PATH = os.path.join(tempfile.mkdtemp(prefix='PETSpider_'), 'database.db')  # Never touch the real cache
+    print('Full table scan:', check_query_plans() or 'none')
+
+    # Following list of 3000 users, 48 per page, 100 ms per page
+    def _following_page(se, proxy, page):
+        time.sleep(0.1)
+        return [(str(i), 'user' + str(i)) for i in range((page - 1) * 48, min(page * 48, 3000))]
+
+    for bench_workers in (1, 8):
+        begin = time.perf_counter()
+        count = len(get_following(None, None, 'bench', ttl=0, workers=bench_workers))
+        print('crawl {0} users, {1} workers: {2:.2f} s'.format(count, bench_workers, time.perf_counter() - begin))
+    begin = time.perf_counter()
+    count = len(get_following(None, None, 'bench'))
+    print('cached {0} users: {1:.4f} s'.format(count, time.perf_counter() - begin))
+
+    # Title search over 300000 cached works, GLOB scan versus trigram index
+    bench_words = ('sky', 'blue', 'night', 'girl', 'cat', 'rain', 'city', 'flower', 'sea', 'snow')
+    begin = time.perf_counter()
+    pusher([{'illustId': str(i), 'illustTitle': '{0} {1} tag{2}'.format(bench_words[i % 10], bench_words[i // 10 % 10],
+                                                                         i % 7919),
+             'createDate': '2020-01-01', 'url': '', 'thumb': '', 'userId': str(i % 3000),
+             'userName': 'user' + str(i % 3000), 'pageCount': 1} for i in range(300000)])
+    print('push 300000 works with index: {0:.2f} s'.format(time.perf_counter() - begin))
+    for bench_pattern in ('*tag4242*', '*ky*ue tag42*'):
+        _no_fts.add(init_db().path)
+        begin = time.perf_counter()
+        count = len(list(fetcher(pname=bench_pattern, t_upper='2000-01-01')))
+        print('{0} GLOB scan, {1} works: {2:.1f} ms'.format(bench_pattern, count, (time.perf_counter() - begin) * 1e3))
+        _no_fts.discard(init_db().path)
+        begin = time.perf_counter()
+        count = len(list(fetcher(pname=bench_pattern, t_upper='2000-01-01')))
+        print('{0} indexed, {1} works: {2:.1f} ms'.format(bench_pattern, count, (time.perf_counter() - begin) * 1e3))
+    begin = time.perf_counter()
+    count = len(search('rain sky'))
+    print('ranked search, first {0} works: {1:.1f} ms'.format(count, (time.perf_counter() - begin) * 1e3))
+    database.close_all()
@@ -2,16 +2,18 @@
 """GUI components for Pixiv tab."""
 import os
 import re
+from array import array
 from functools import partial
 
 import requests
-from PyQt5.QtCore import Qt, QSettings, QThread, pyqtSignal, QVariant, QRunnable, QObject, QThreadPool, QTimer
-from PyQt5.QtGui import QBrush, QColor, QPixmap
-from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QFormLayout, QGridLayout, QHeaderView, QTableWidgetItem,
+from PyQt5.QtCore import (Qt, QSettings, QThread, pyqtSignal, QRunnable, QObject, QThreadPool, QTimer,
+                          QAbstractTableModel, QAbstractProxyModel, QModelIndex)
+from PyQt5.QtGui import QBrush, QColor, QImage, QPixmap
+from PyQt5.QtWidgets import (QVBoxLayout, QHBoxLayout, QFormLayout, QGridLayout, QHeaderView, QTableView,
                              QSplitter, QButtonGroup, QWidget, QGroupBox, QTextEdit, QPushButton, QCheckBox, QFrame,
-                             QMessageBox, QTableWidget, QLabel, QAbstractItemView, QSpinBox, QComboBox, QFileDialog)
+                             QMessageBox, QLabel, QAbstractItemView, QSpinBox, QComboBox, QFileDialog)
 
-from modules import globj, pixiv
+from modules import globj, pixiv, jobs, library, transfer, workers
 
 
 class LoginWidget(QWidget):
@@ -173,9 +175,11 @@ class VerifyThread(QThread):
 
 class FetchThread(QThread):
     fetch_success = pyqtSignal(list)
+    fetch_part = pyqtSignal(list)
+    stale_found = pyqtSignal(list)
     except_signal = pyqtSignal(object, int, str, str)
 
-    def __init__(self, parent, session, proxy: dict, pid: str, uid: str, num: int):
+    def __init__(self, parent, session, proxy: dict, pid: str, uid: str, num: int, account: str = None):
         super().__init__()
         self.parent = parent
         self.session = session
@@ -183,25 +187,34 @@ class FetchThread(QThread):
         self.pid = pid
         self.uid = uid
         self.num = num
+        self.account = account  # Incremental sync of following for this account if given
+        self.batch_size = 20
+        self.settings = QSettings(os.path.join(os.path.abspath('.'), 'settings.ini'), QSettings.IniFormat)
 
     def run(self):
+        self.settings.beginGroup('MiscSetting')
+        stale = float(self.settings.value('cache_ttl', 7)) * 86400
+        expire = float(self.settings.value('cache_expire', 90)) * 86400
+        self.settings.endGroup()
+        since = None
+        synced = []
+        results = []
+        stale_list = []
         try:
             if self.pid:
-                new_set = {self.pid}
+                pages = [[self.pid]]
             else:
-                new_set = pixiv.get_new(self.session, self.proxy, user_id=self.uid, num=self.num)
-            updater = []
-            results = []
-            for pid in new_set:
-                fet_pic = pixiv.fetcher(pid)
-                if not fet_pic:
-                    print('Not in database.')
-                    fet_pic = pixiv.get_detail(self.session, pid=pid, proxy=self.proxy)
-                    updater.append(fet_pic)
-                else:
-                    print('Fetch from database')
-                results.append(fet_pic)
-            pixiv.pusher(updater)
+                since = pixiv.get_mark(self.account) if self.account and not self.uid else None
+                pages = pixiv.iter_new(self.session, self.proxy, user_id=self.uid, num=self.num, since=since)
+            for ids in pages:  # Resolve every page while the next pages are loading
+                synced.extend(ids)
+                hits, misses, stale_ids = pixiv.fetch_many(ids, stale, expire)
+                print('Fetch from database:', len(hits), 'Not in database:', len(misses), 'Stale:', len(stale_ids))
+                stale_list.extend(stale_ids)
+                if hits:
+                    self.fetch_part.emit(list(hits.values()))
+                    results.extend(hits.values())
+                self.resolve(misses, results)
         except (requests.exceptions.ProxyError,
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError) as e:
@@ -210,7 +223,43 @@ class FetchThread(QThread):
             self.except_signal.emit(self.parent, QMessageBox.Critical,
                                     '未知错误', '返回值错误，请向开发者反馈\n{0}'.format(repr(e)))
         else:
+            if since is not None:
+                pixiv.set_mark(self.account, synced)
             self.fetch_success.emit(results)
+            if stale_list:
+                self.stale_found.emit(stale_list)
+
+    def resolve(self, misses: list, results: list):
+        """Fetch details of misses, emit and store them in batches."""
+        updater = []
+        try:
+            for item in pixiv.fetch_details(self.session, misses, self.proxy, user_id=self.uid):
+                updater.append(item)
+                if len(updater) >= self.batch_size:
+                    self.fetch_part.emit(updater)
+                    pixiv.pusher(updater)
+                    results.extend(updater)
+                    updater = []
+        finally:  # Keep details fetched before an exception
+            if updater:
+                self.fetch_part.emit(updater)
+                pixiv.pusher(updater)
+                results.extend(updater)
+
+
+class RefreshThread(QThread):
+    """Refresh stale cached illustrations in background. Errors are ignored, stale rows stay usable."""
+
+    def __init__(self, session, proxy: dict, pids: list):
+        super().__init__()
+        self.session = session
+        self.proxy = proxy
+        self.pids = pids
+
+    def run(self):
+        updater = list(pixiv.fetch_details(self.session, self.pids, self.proxy, workers=2, ignore_errors=True))
+        pixiv.pusher(updater)
+        print('Refreshed:', len(updater))
 
 
 class SauceNAOThread(QThread):
@@ -255,7 +304,7 @@ class DownloadSignals(QObject):
 
 
 class DownloadPicThread(QRunnable):
-    def __init__(self, parent, session, proxy, info, path, page):
+    def __init__(self, parent, session, proxy, info, path, page, controller, job, processes=None):
         super().__init__()
         self.parent = parent
         self.session = session
@@ -263,39 +312,390 @@ class DownloadPicThread(QRunnable):
         self.info = info
         self.path = path
         self.page = page
+        self.controller = controller
+        self.job = job
+        self.processes = processes  # A workers.ProcessPool in multiprocess mode
         self.signals = DownloadSignals()
 
     def run(self):
         try:
-            pixiv.download_pic(self.session, self.proxy, self.info, self.path, self.page)
+            if self.processes:
+                stats = self.processes.download_pic(self.info, self.path, self.page)
+            else:
+                stats = pixiv.download_pic(self.session, self.proxy, self.info, self.path, self.page)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (403, 429):  # Throttled
+                self.controller.ban()
+            self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '连接失败',
+                                            '请检查网络或使用代理：\n' + repr(e))
         except (requests.exceptions.ProxyError,
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError,
                 requests.exceptions.ChunkedEncodingError) as e:
+            self.controller.failure()
             self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '连接失败',
                                             '请检查网络或使用代理：\n' + repr(e))
+        except workers.PoolStoppedError as e:  # Only closed after all threads end, so a worker died
+            self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '错误',
+                                            '下载进程异常退出：\n' + repr(e))
         except (FileNotFoundError, PermissionError) as e:
             self.signals.except_signal.emit(self.parent, QMessageBox.Critical, '错误',
                                             '文件系统错误：\n' + repr(e))
+        except globj.ResponseError as e:
+            self.signals.except_signal.emit(self.parent, QMessageBox.Critical,
+                                            '未知错误', '返回值错误，请向开发者反馈\n{0}'.format(repr(e)))
         else:
+            if stats:
+                self.controller.success(stats)
+            jobs.get().finish_page(self.job, self.page)
             self.signals.download_success.emit()
 
 
-class DownloadThumbThread(QThread):
-    download_success = pyqtSignal(tuple)
+class IllustModel(QAbstractTableModel):
+    """
+    Works listed in the result table, stored column by column. Integer columns
+    are arrays and text columns are lists, so a row costs a few machine words
+    and its strings, with no item objects. Cell styles are shared.
+    Columns are only appended to, or replaced as a whole by clear(). A last
+    column of thumbnail urls is kept for ThumbPrefetcher and not shown.
+    """
+    HEADERS = ('PID', '画廊名', '画师ID', '画师名', '页数', '创建日期')
+    _CENTERED = (0, 2, 4, 5)
+    _TINTED = (0, 2, 4)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.columns = self._empty()
+        self._tint = QBrush(QColor('#CCFFFF'))  # Shared by all cells
+        self._center = int(Qt.AlignCenter)
+
+    @staticmethod
+    def _empty() -> tuple:
+        return array('q'), [], array('q'), [], array('l'), [], []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns[0])
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def cell(self, row: int, column: int, role: int):
+        """Data of a cell by row and column numbers, without creating a QModelIndex."""
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            return self.columns[column][row]
+        if role == Qt.TextAlignmentRole and column in self._CENTERED:
+            return self._center
+        if role == Qt.BackgroundRole and column in self._TINTED:
+            return self._tint
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        return self.cell(index.row(), index.column(), role)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            return self.HEADERS[section] if orientation == Qt.Horizontal else section + 1
+        return None
+
+    def append(self, items: list):
+        """Append items to the end."""
+        if not items:
+            return
+        count = len(self.columns[0])
+        self.beginInsertRows(QModelIndex(), count, count + len(items) - 1)
+        ids, titles, user_ids, user_names, pages, dates, thumbs = self.columns
+        for item in items:
+            ids.append(int(item['illustId']))
+            titles.append(item['illustTitle'])
+            user_ids.append(int(item['userId']))
+            user_names.append(item['userName'])
+            pages.append(item['pageCount'])
+            dates.append(item['createDate'])
+            thumbs.append(item['thumb'])
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.columns = self._empty()
+        self.endResetModel()
+
+    def pid(self, row: int) -> str:
+        return str(self.columns[0][row])
+
+    def thumb(self, row: int) -> str:
+        return self.columns[6][row]
+
+
+class SortThread(QThread):
+    """Filter and sort the first rows of model columns."""
+    sort_success = pyqtSignal(object, int, int)  # Source rows in order, number of rows covered, generation
 
-    def __init__(self, session, proxy, pid):
+    def __init__(self, columns: tuple, count: int, column: int, reverse: bool, pattern: str, generation: int):
         super().__init__()
+        self.columns = columns  # Read only below count, while GUI thread appends after it
+        self.count = count
+        self.column = column
+        self.reverse = reverse
+        self.pattern = pattern
+        self.generation = generation
+
+    def run(self):
+        rows = range(self.count)
+        if self.pattern:
+            titles, names = self.columns[1], self.columns[3]
+            rows = [i for i in rows if self.pattern in titles[i].casefold() or self.pattern in names[i].casefold()]
+        if self.column >= 0:
+            rows = sorted(rows, key=self.columns[self.column].__getitem__, reverse=self.reverse)
+        self.sort_success.emit(array('l', rows), self.count, self.generation)
+
+
+class IllustProxy(QAbstractProxyModel):
+    """
+    Sorted and filtered rows of an IllustModel. Orders are computed by
+    SortThread, so GUI thread only swaps the row mapping. Rows appended
+    meanwhile are shown at the end, and sorted by the next order.
+    """
+
+    def __init__(self, source: IllustModel, parent=None):
+        super().__init__(parent)
+        self.setSourceModel(source)
+        self._source = source
+        self._rows = array('l')  # Source row of every proxy row
+        self._inverse = None  # {source row: proxy row}, built on demand
+        self._column = -1
+        self._order = Qt.AscendingOrder
+        self._pattern = ''  # Filter applied to _rows
+        self._wanted = ''  # Filter applied by the next order
+        self._generation = 0  # Orders of older requests are dropped
+        self._threads = set()  # Running SortThread, kept until finished
+        self._timer = QTimer(self)  # Coalesce appends and typing
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(200)
+        self._timer.timeout.connect(self._request)
+        source.rowsInserted.connect(self._inserted)
+        source.modelAboutToBeReset.connect(self.beginResetModel)
+        source.modelReset.connect(self._reset)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not 0 <= row < len(self._rows) or not 0 <= column < self._source.columnCount():
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=None):
+        if index is None:  # QObject.parent()
+            return super().parent()
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return self._source.columnCount(parent)
+
+    def data(self, index, role=Qt.DisplayRole):
+        return self._source.cell(self._rows[index.row()], index.column(), role)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        return self._source.headerData(section, orientation, role)  # Vertical header keeps numbering of proxy
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self._source.index(self._rows[index.row()], index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        if self._inverse is None:
+            self._inverse = {source: row for row, source in enumerate(self._rows)}
+        row = self._inverse.get(index.row())
+        return QModelIndex() if row is None else self.createIndex(row, index.column())
+
+    def source_row(self, row: int) -> int:
+        return self._rows[row]
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self._column = column
+        self._order = order
+        self._request()
+
+    def set_filter(self, text: str):
+        """Show rows whose title or user name contains text, ignoring case."""
+        self._wanted = text.strip().casefold()
+        self._timer.start()
+
+    def _accepts(self, row: int, pattern: str) -> bool:
+        columns = self._source.columns
+        return not pattern or pattern in columns[1][row].casefold() or pattern in columns[3][row].casefold()
+
+    def _inserted(self, parent, first: int, last: int):
+        rows = [row for row in range(first, last + 1) if self._accepts(row, self._pattern)]
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(rows) - 1)
+            self._rows.extend(rows)
+            self._inverse = None
+            self.endInsertRows()
+        if self._column >= 0 and not self._timer.isActive():
+            self._timer.start()
+
+    def _reset(self):
+        self._generation += 1
+        self._rows = array('l')
+        self._inverse = None
+        self.endResetModel()
+
+    def _request(self):
+        """Start a SortThread for current sort column and filter."""
+        self._timer.stop()
+        self._generation += 1
+        thread = SortThread(self._source.columns, self._source.rowCount(), self._column,
+                            self._order == Qt.DescendingOrder, self._wanted, self._generation)
+        thread.sort_success.connect(self._apply)
+        thread.finished.connect(partial(self._threads.discard, thread))
+        self._threads.add(thread)
+        thread.start()
+
+    def _apply(self, rows, count: int, generation: int):
+        if generation != self._generation:  # Superseded by a newer request or reset
+            return
+        rows.extend(row for row in range(count, self._source.rowCount()) if self._accepts(row, self._wanted))
+        if self._wanted != self._pattern or len(rows) != len(self._rows):  # Another set of rows
+            self.beginResetModel()
+            self._rows, self._pattern, self._inverse = rows, self._wanted, None
+            self.endResetModel()
+            return
+        self.layoutAboutToBeChanged.emit()
+        old = self.persistentIndexList()  # Selection and current index follow their rows
+        cells = [(self._rows[index.row()], index.column()) for index in old]
+        self._rows, self._inverse = rows, None
+        self.changePersistentIndexList(old, [self.mapFromSource(self._source.index(*cell)) for cell in cells])
+        self.layoutChanged.emit()
+
+    def wait(self):
+        """Wait for running sorts before exiting."""
+        for thread in list(self._threads):
+            thread.wait()
+
+
+class ThumbSignals(QObject):
+    fetched = pyqtSignal(str, QImage)  # Url and decoded thumbnail, image is null on failure
+
+
+class DownloadThumbThread(QRunnable):
+    def __init__(self, session, proxy, item, size):
+        super().__init__()
+        self.setAutoDelete(False)  # Kept by ThumbPrefetcher, so it can be taken back from the queue
         self.session = session
         self.proxy = proxy
-        self.pid = pid
+        self.item = item
+        self.size = size
+        self.signals = ThumbSignals()
 
     def run(self):
-        item = pixiv.fetcher(self.pid)
-        if item:
-            path = pixiv.download_thumb(self.session, self.proxy, item)
-            if path:
-                self.download_success.emit((self.pid, path))
+        path = pixiv.download_thumb(self.session, self.proxy, self.item)
+        image = globj.load_thumb(path, self.size) if path else QImage()  # Only the result reaches GUI thread
+        self.signals.fetched.emit(self.item['thumb'], image)
+
+
+class ThumbPrefetcher(QObject):
+    """
+    Fetch thumbnails of a table before their rows are selected, on a small pool
+    of its own. The current row goes first, then visible rows from the top, then
+    one screen below. Queued fetches of rows scrolled away are cancelled.
+    Thumbnails are decoded and scaled in the pool, and kept by globj.thumb_pixmap().
+    """
+    fetched = pyqtSignal(str)
+
+    def __init__(self, view, thumb_of, glovar, size, workers: int = 3):
+        """
+        Args:
+            view: The table watched.
+            thumb_of: A callable returning the thumbnail url of a row, or None.
+            glovar: Global vars of pixiv tab, whose session and proxy are used.
+            size: QSize the thumbnails are scaled down to.
+            workers: Concurrent thumbnail downloads.
+        """
+        super().__init__(view)
+        self.view = view
+        self.thumb_of = thumb_of  # Read from the model, no database access in GUI thread
+        self.glovar = glovar
+        self.size = size
+        self.enabled = True
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(workers)
+        self._tasks = dict()  # {url: DownloadThumbThread} queued or running
+        self._done = list()  # Finished tasks whose run() may not have returned yet, freed when the pool is idle
+        self._timer = QTimer(self)  # Coalesce scroll events
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(50)
+        self._timer.timeout.connect(self.refresh)
+        view.verticalScrollBar().valueChanged.connect(self.schedule)
+        view.model().layoutChanged.connect(self.schedule)  # Sorted
+        view.model().modelReset.connect(self.schedule)  # Filtered
+        view.model().rowsInserted.connect(self.schedule)
+
+    def schedule(self):
+        if self.enabled:
+            self._timer.start()
+
+    def wanted_rows(self) -> list:
+        """Rows to fetch, in order of priority."""
+        count = self.view.model().rowCount()
+        if not count:
+            return []
+        first = max(self.view.rowAt(0), 0)
+        last = self.view.rowAt(self.view.viewport().height() - 1)
+        last = count - 1 if last < 0 else last
+        end = min(count, last + 1 + last - first + 1)
+        current = self.view.currentIndex().row()
+        rows = [current] if current >= 0 else []
+        return rows + list(range(first, end))
+
+    def refresh(self):
+        """Queue thumbnails of wanted rows by priority, and cancel the others."""
+        self._timer.stop()
+        if not self.enabled:
+            return
+        if not self.pool.activeThreadCount():
+            self._done.clear()
+        wanted = dict()  # {url: None}, ordered by priority
+        for row in self.wanted_rows():
+            url = self.thumb_of(row)
+            if url and not globj.thumb_pixmap(url):
+                wanted.setdefault(url)
+        self.cancel()  # Requeued below if still wanted
+        for rank, url in enumerate(wanted):  # Idle threads take the first ones started at once, whatever priority
+            if url not in self._tasks:  # Not running
+                priority = len(wanted) - rank
+                task = DownloadThumbThread(self.glovar.session, self.glovar.proxy, {'thumb': url}, self.size)
+                task.signals.fetched.connect(self.finish)
+                self._tasks[url] = task
+                self.pool.start(task, priority)
+
+    def finish(self, url: str, image: QImage):
+        self._done.append(self._tasks.pop(url, None))  # Emitted inside run(), deleting it now frees a running task
+        if not self.pool.activeThreadCount():
+            self._done.clear()
+        if globj.thumb_pixmap(url, image):
+            self.fetched.emit(url)
+
+    def cancel(self):
+        """Take back fetches not started yet."""
+        for url, task in list(self._tasks.items()):
+            if self.pool.tryTake(task):
+                del self._tasks[url]
+
+    def reset(self):
+        """Drop fetches of old rows."""
+        self.cancel()
+
+    def stop(self):
+        self.enabled = False
+        self._timer.stop()
+        self.pool.clear()
+        self.pool.waitForDone()
+        self._tasks.clear()
+        self._done.clear()
 
 
 class MainWidget(QWidget):
@@ -307,8 +707,10 @@ class MainWidget(QWidget):
         self.settings = QSettings(os.path.join(os.path.abspath('.'), 'settings.ini'), QSettings.IniFormat)
         self.fetch_thread = QThread()
         self.sauce_thread = QThread()
-        self.thumb_thread = QThread()
-        self.thread_pool = QThreadPool.globalInstance()
+        self.refresh_thread = QThread()
+        self.account = info[0]
+        self.thread_pool = QThreadPool(self)  # Own pool, sized by the controller of this site
+        self.process_pool = None  # Worker processes of current download in multiprocess mode
         self.ATC_monitor = QTimer()  # Use QTimer to monitor ACT when exception catched
         self.ATC_monitor.setInterval(500)
         self.ATC_monitor.timeout.connect(self.except_checker)
@@ -316,10 +718,15 @@ class MainWidget(QWidget):
         self.thread_count = 0
         self.cancel_download_flag = 0
 
-        self.thumb_dict = dict()  # Store pid and corresponding thumbnail path
+        self.jobs = jobs.get()  # Unfinished downloads, listed again after a restart
         self.settings.beginGroup('MiscSetting')
         self.show_thumb_flag = int(self.settings.value('thumbnail', True))
+        self.controller = transfer.ConcurrencyController(int(self.settings.value('dl_min', 1)),
+                                                         int(self.settings.value('dl_sametime', 3)))
         self.settings.endGroup()
+        self.lbl_level = QLabel()
+        self.lbl_level.setToolTip('根据下载速度与错误自动调整，范围在首选项中设置。')
+        self.apply_level()
 
         self.ledit_pid = globj.LineEditor()
         self.ledit_uid = globj.LineEditor()
@@ -327,6 +734,8 @@ class MainWidget(QWidget):
         self.ledit_num.setContextMenuPolicy(Qt.NoContextMenu)
         self.ledit_num.setMaximum(999)
         self.ledit_num.clear()
+        self.cbox_incr = QCheckBox('增量同步')
+        self.cbox_incr.setToolTip('只获取上次同步之后的新作品，数量为空时获取全部新作品。')
 
         self.btn_snao = QPushButton('以图搜图')
         self.btn_snao.clicked.connect(self.search_pic)
@@ -356,25 +765,38 @@ class MainWidget(QWidget):
         self.btn_group.addButton(self.btn_uid, 3)
         self.btn_group.buttonClicked[int].connect(self.change_stat)
 
-        self.table_viewer = QTableWidget()  # Detail viewer of fetched info
-        self.table_viewer.cellPressed.connect(self.change_thumb)
-        self.table_viewer.itemSelectionChanged.connect(self.set_default_thumb)
+        self.table_model = IllustModel(self)  # Fetched info
+        self.table_proxy = IllustProxy(self.table_model, self)
+        self.ledit_filter = globj.LineEditor()
+        self.ledit_filter.setPlaceholderText('筛选画廊名或画师名')
+        self.ledit_filter.textChanged.connect(self.table_proxy.set_filter)
+        self.table_viewer = QTableView()  # Detail viewer of fetched info
+        self.table_viewer.setModel(self.table_proxy)
+        self.table_viewer.selectionModel().currentRowChanged.connect(self.change_thumb)  # Mouse and arrow keys
+        self.table_viewer.selectionModel().selectionChanged.connect(self.set_default_thumb)
         self.table_viewer.setWordWrap(False)
         self.table_viewer.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table_viewer.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.table_viewer.verticalScrollBar().setContextMenuPolicy(Qt.NoContextMenu)
-        self.table_viewer.setColumnCount(6)
         self.table_viewer.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
-        self.table_viewer.setHorizontalHeaderLabels(['PID', '画廊名', '画师ID', '画师名', '页数', '创建日期'])
         self.table_viewer.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table_viewer.horizontalHeader().setResizeContentsPrecision(0)  # Measure visible rows only
         self.table_viewer.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
         self.table_viewer.horizontalHeader().setStyleSheet('QHeaderView::section{background-color:#66CCFF;}')
         self.table_viewer.horizontalHeader().setHighlightSections(False)
+        self.table_viewer.setSortingEnabled(True)
 
         self.ledit_pid.setDisabled(True)
         self.ledit_num.setDisabled(True)
         self.ledit_uid.setDisabled(True)
+        self.cbox_incr.setDisabled(True)
         self.init_ui()
+        self.thumb_url = None  # Url of the thumbnail wanted on screen
+        self.prefetcher = ThumbPrefetcher(self.table_viewer, self.thumb_of, self.glovar,
+                                          self.thumbnail.contentsRect().size())
+        self.prefetcher.enabled = bool(self.show_thumb_flag)
+        self.prefetcher.fetched.connect(self.show_thumb)
+        self.restore_jobs()
 
     def init_ui(self):
         glay_lup = QHBoxLayout()
@@ -390,6 +812,7 @@ class MainWidget(QWidget):
         glay_ldown.addWidget(self.ledit_uid, 1, 1, 1, 5)
         glay_ldown.addWidget(QLabel('数量'), 2, 0, 1, 1)
         glay_ldown.addWidget(self.ledit_num, 2, 1, 1, 1)
+        glay_ldown.addWidget(self.cbox_incr, 2, 2, 1, 1)
         glay_ldown.setColumnStretch(1, 1)
         glay_ldown.setColumnStretch(2, 5)
 
@@ -415,6 +838,7 @@ class MainWidget(QWidget):
         vlay_right.addWidget(self.btn_logout)
         vlay_right.addWidget(self.btn_get)
         vlay_right.addWidget(self.btn_dl)
+        vlay_right.addWidget(self.lbl_level, alignment=Qt.AlignHCenter)
         right_wid = QWidget()
         right_wid.setLayout(vlay_right)
 
@@ -428,6 +852,7 @@ class MainWidget(QWidget):
 
         vlay_main = QVBoxLayout()
         vlay_main.addWidget(splitter)
+        vlay_main.addWidget(self.ledit_filter)
         vlay_main.addWidget(self.table_viewer)
         self.setLayout(vlay_main)
 
@@ -448,6 +873,7 @@ class MainWidget(QWidget):
         self.ledit_uid.setDisabled(True)
         self.ledit_pid.setDisabled(True)
         self.ledit_num.setDisabled(False)
+        self.cbox_incr.setDisabled(False)
 
     def pid_stat(self):
         self.btn_fo.setChecked(False)
@@ -456,6 +882,7 @@ class MainWidget(QWidget):
         self.ledit_uid.setDisabled(True)
         self.ledit_num.setDisabled(True)
         self.ledit_pid.setDisabled(False)
+        self.cbox_incr.setDisabled(True)
 
     def uid_stat(self):
         self.btn_fo.setChecked(False)
@@ -464,42 +891,38 @@ class MainWidget(QWidget):
         self.ledit_pid.setDisabled(True)
         self.ledit_uid.setDisabled(False)
         self.ledit_num.setDisabled(False)
+        self.cbox_incr.setDisabled(True)
+
+    def restore_jobs(self):
+        """List and select works not downloaded completely last time."""
+        items = [item for _, item in self.jobs.unfinished('pixiv')]
+        if items:
+            self.tabulate(items)
+            self.table_viewer.selectAll()
+            QTimer.singleShot(0, partial(globj.show_messagebox, self, QMessageBox.Information, '继续下载',
+                                         '有{0}个作品上次未下载完成，已列出并选中，点击下载即可继续。'.format(len(items))))
 
     def tabulate(self, items):
         """Construct list of items."""
-        self.table_viewer.setSortingEnabled(False)
-        self.table_viewer.clearContents()
-        self.table_viewer.setRowCount(len(items))
-        index = 0
-        for item in items:
-            illust_id = QTableWidgetItem()
-            illust_id.setTextAlignment(Qt.AlignCenter)
-            illust_id.setData(Qt.EditRole, QVariant(int(item['illustId'])))
-            illust_id.setBackground(QBrush(QColor('#CCFFFF')))
-            self.table_viewer.setItem(index, 0, illust_id)
-
-            self.table_viewer.setItem(index, 1, QTableWidgetItem(item['illustTitle']))
-
-            user_id = QTableWidgetItem()
-            user_id.setTextAlignment(Qt.AlignCenter)
-            user_id.setData(Qt.EditRole, QVariant(int(item['userId'])))
-            user_id.setBackground(QBrush(QColor('#CCFFFF')))
-            self.table_viewer.setItem(index, 2, user_id)
-
-            self.table_viewer.setItem(index, 3, QTableWidgetItem(item['userName']))
-
-            page_count = QTableWidgetItem()
-            page_count.setTextAlignment(Qt.AlignCenter)
-            page_count.setData(Qt.EditRole, QVariant(item['pageCount']))
-            page_count.setBackground(QBrush(QColor('#CCFFFF')))
-            self.table_viewer.setItem(index, 4, page_count)
-
-            create_date = QTableWidgetItem()
-            create_date.setTextAlignment(Qt.AlignCenter)
-            create_date.setData(Qt.EditRole, QVariant(item['createDate']))
-            self.table_viewer.setItem(index, 5, create_date)
-            index += 1
-        self.table_viewer.setSortingEnabled(True)
+        self.table_model.clear()
+        self.prefetcher.reset()
+        self.append_rows(items)
+
+    def append_rows(self, items):
+        """Append items to the end of list, sorted and filtered soon after."""
+        self.table_model.append(items)
+
+    def pid_of(self, row: int):
+        """Pid shown in row, None if there is no such row."""
+        if 0 <= row < self.table_proxy.rowCount():
+            return self.table_model.pid(self.table_proxy.source_row(row))
+        return None
+
+    def thumb_of(self, row: int):
+        """Thumbnail url of the work in row, None if there is no such row."""
+        if 0 <= row < self.table_proxy.rowCount():
+            return self.table_model.thumb(self.table_proxy.source_row(row))
+        return None
 
     def fetch_new(self):
         self.btn_get.setDisabled(True)
@@ -509,8 +932,10 @@ class MainWidget(QWidget):
         num = self.ledit_num.value() if self.ledit_num.value() else 0
         if pid or uid:
             if re.match(r'^\d{2,9}$', pid) or re.match(r'^\d{2,9}$', uid):
+                self.tabulate([])
                 self.fetch_thread = FetchThread(self, self.glovar.session, self.glovar.proxy, pid, uid, num)
-                self.fetch_thread.fetch_success.connect(self.tabulate)
+                self.fetch_thread.fetch_part.connect(self.append_rows)
+                self.fetch_thread.stale_found.connect(self.refresh_stale)
                 self.fetch_thread.except_signal.connect(globj.show_messagebox)
                 self.fetch_thread.finished.connect(self.fetch_new_finished)
                 self.fetch_thread.start()
@@ -518,9 +943,12 @@ class MainWidget(QWidget):
                 globj.show_messagebox(self, QMessageBox.Warning, '错误', 'ID号输入错误！')
                 self.btn_get.setDisabled(False)
                 self.btn_dl.setDisabled(False)
-        elif num:
-            self.fetch_thread = FetchThread(self, self.glovar.session, self.glovar.proxy, pid, uid, num)
-            self.fetch_thread.fetch_success.connect(self.tabulate)
+        elif num or self.cbox_incr.isChecked():
+            account = self.account if self.cbox_incr.isChecked() else None
+            self.tabulate([])
+            self.fetch_thread = FetchThread(self, self.glovar.session, self.glovar.proxy, pid, uid, num, account)
+            self.fetch_thread.fetch_part.connect(self.append_rows)
+            self.fetch_thread.stale_found.connect(self.refresh_stale)
             self.fetch_thread.except_signal.connect(globj.show_messagebox)
             self.fetch_thread.finished.connect(self.fetch_new_finished)
             self.fetch_thread.start()
@@ -533,66 +961,88 @@ class MainWidget(QWidget):
         self.btn_get.setDisabled(False)
         self.btn_dl.setDisabled(False)
 
-    def change_thumb(self, row):
-        if self.show_thumb_flag:
-            pid = self.table_viewer.item(row, 0).text()
-            if pid in self.thumb_dict:
-                thumb = QPixmap()
-                if thumb.load(self.thumb_dict[pid]):  # If thumbnail is deleted, redownload it
+    def refresh_stale(self, pids):
+        """Refresh stale cached items without blocking current results."""
+        if self.refresh_thread.isRunning():
+            return
+        self.refresh_thread = RefreshThread(self.glovar.session, self.glovar.proxy, pids)
+        self.refresh_thread.start()
+
+    def change_thumb(self, current):
+        if self.show_thumb_flag and current.isValid():
+            url = self.thumb_of(current.row())
+            if url:
+                self.thumb_url = url
+                thumb = globj.thumb_pixmap(self.thumb_url)
+                if thumb:  # Prefetched or shown before
                     self.thumbnail.setPixmap(thumb)
-                else:
-                    self.thumb_thread = DownloadThumbThread(self.glovar.session, self.glovar.proxy, pid)
-                    self.thumb_thread.download_success.connect(self.show_thumb)
-                    self.thumb_thread.start()
-            else:
-                self.thumb_thread = DownloadThumbThread(self.glovar.session, self.glovar.proxy, pid)
-                self.thumb_thread.download_success.connect(self.show_thumb)
-                self.thumb_thread.start()
+                else:  # Put it first, shown by show_thumb()
+                    self.prefetcher.refresh()
 
-    def show_thumb(self, info):
-        self.thumb_dict[info[0]] = info[1]
-        thumb = QPixmap(info[1])
-        self.thumbnail.setPixmap(thumb)
+    def show_thumb(self, url: str):
+        """Show a fetched thumbnail if it is still the wanted one."""
+        thumb = globj.thumb_pixmap(url)
+        if url == self.thumb_url and thumb:  # Ignore ones finished after another row was selected
+            self.thumbnail.setPixmap(thumb)
 
     def change_thumb_state(self, new):
         """Change state of whether show thumbnail in setting."""
         self.show_thumb_flag = new
+        self.prefetcher.enabled = bool(new)
         if self.show_thumb_flag:
             self.thumbnail.show()
+            self.prefetcher.schedule()
         else:
             self.thumbnail.hide()
 
     def set_default_thumb(self):
         """Set default thumbnail when no item selected."""
-        if not self.table_viewer.selectedItems() and self.show_thumb_flag:
+        if not self.table_viewer.selectionModel().hasSelection() and self.show_thumb_flag:
+            self.thumb_url = None
             self.thumbnail.setPixmap(self.thumb_default)
 
     def download(self):
-        items = self.table_viewer.selectedItems()
-        if items:
+        pids = [self.pid_of(index.row()) for index in self.table_viewer.selectionModel().selectedRows()]
+        if pids:
             self.btn_dl.setText('取消下载')
             self.btn_dl.clicked.disconnect(self.download)
             self.btn_dl.clicked.connect(self.cancel_download)
+            self.except_info = None
+            self.cancel_download_flag = 0
 
             self.settings.beginGroup('RuleSetting')
             root_path = self.settings.value('pixiv_root_path', os.path.abspath('.'))
             folder_rule = self.settings.value('pixiv_folder_rule', {0: 'illustId'})
             file_rule = self.settings.value('pixiv_file_rule', {0: 'illustId'})
             self.settings.endGroup()
-            self.settings.beginGroup('MiscSetting')
-            dl_sametime = int(self.settings.value('dl_sametime', 3))
-            self.settings.endGroup()
 
-            self.thread_pool.setMaxThreadCount(dl_sametime)
-            for i in range(len(items) // 6):
-                info = pixiv.fetcher(items[i * 6].text())
+            self.apply_level()
+            self.open_process_pool()
+            hits, misses, _ = pixiv.fetch_many(pids, 0, 0)  # Rows shown are downloaded however old they are
+            for info in hits.values():
                 path = pixiv.path_name(info, root_path, folder_rule, file_rule)
+                # Skip owned pages before queuing, by library index
+                owned = [page for page in range(info['pageCount']) if pixiv.page_owned(path, page)]
+                job = self.jobs.add('pixiv', info['illustId'], data=info, pages=range(info['pageCount']),
+                                    source=jobs.GUI)
+                self.jobs.finish_pages(job, owned)
                 for page in range(info['pageCount']):
-                    thread = DownloadPicThread(self, self.glovar.session, self.glovar.proxy, info, path, page)
+                    if page in owned:
+                        continue
+                    thread = DownloadPicThread(self, self.glovar.session, self.glovar.proxy, info, path, page,
+                                               self.controller, job, self.process_pool)
                     thread.signals.except_signal.connect(self.except_download)
                     thread.signals.download_success.connect(self.finish_download)
                     self.thread_count += 1
                     self.thread_pool.start(thread)
+            if not self.thread_count:  # Nothing queued, all pages are owned or skipped
+                self.close_process_pool()
+                if not misses:
+                    globj.show_messagebox(self, QMessageBox.Information, '下载完成', '所选作品均已下载！')
+                self.reset_download()
+            if misses:  # Removed from cache after listed, shown after the button is settled
+                globj.show_messagebox(self, QMessageBox.Warning, '警告',
+                                      '以下作品不在缓存中，已跳过，请重新获取：\n' + '\n'.join(misses))
         else:
             globj.show_messagebox(self, QMessageBox.Warning, '警告', '请选择至少一行！')
 
@@ -603,37 +1053,70 @@ class MainWidget(QWidget):
         self.thread_pool.clear()
 
     def except_download(self, *args):
-        """Cancel download threads when exceptions raised."""
+        """Cancel download threads when exceptions raised.
+
+        The first exception wins, later ones from threads still running are dropped. The download is
+        finished by except_checker once the pool is idle, whatever the concurrency level is.
+        """
+        if self.except_info:
+            return
+        self.except_info = args
+        self.apply_level()
         self.cancel_download()
-        if not self.except_info:
-            self.except_info = args
-            if self.thread_pool.maxThreadCount() == 1:
-                self.ATC_monitor.start()
+        self.ATC_monitor.start()
 
     def except_checker(self):
         """Check whether all thread in pool has ended."""
         if not self.thread_pool.activeThreadCount():
             self.ATC_monitor.stop()
+            self.close_process_pool()
             globj.show_messagebox(*self.except_info)
-            self.btn_dl.setDisabled(False)
-            self.btn_dl.setText('下载')  # Single thread needs this
-            self.btn_dl.clicked.disconnect(self.cancel_download)
-            self.btn_dl.clicked.connect(self.download)
+            self.reset_download()
 
     def finish_download(self):
         """Do some clearing stuff when thread has finished."""
+        self.apply_level()
         self.thread_count -= 1
         print('Thread finished:', self.thread_count)
-        if not self.thread_count:
-            if self.cancel_download_flag:
-                self.btn_dl.setDisabled(False)
-            elif self.except_info:
-                self.except_info()
-            else:
-                globj.show_messagebox(self, QMessageBox.Information, '下载完成', '下载成功完成！')
-            self.btn_dl.setText('下载')
-            self.btn_dl.clicked.disconnect(self.cancel_download)
-            self.btn_dl.clicked.connect(self.download)
+        if not self.thread_count and not self.except_info:  # Exceptions are finished by except_checker
+            self.close_process_pool()
+            print('Connections:', transfer.pool_report(self.glovar.session))
+            if not self.cancel_download_flag:
+                globj.show_messagebox(self, QMessageBox.Information, '下载完成', '下载成功完成！\n' + library.report_text())
+            self.reset_download()
+
+    def reset_download(self):
+        """Turn the cancel button back into the download button, only once per download."""
+        self.btn_dl.setDisabled(False)
+        if self.btn_dl.text() == '下载':
+            return
+        self.btn_dl.setText('下载')
+        self.btn_dl.clicked.disconnect(self.cancel_download)
+        self.btn_dl.clicked.connect(self.download)
+
+    def open_process_pool(self):
+        """Start worker processes for this download if multiprocess mode is on."""
+        self.settings.beginGroup('MiscSetting')
+        enabled = int(self.settings.value('multiprocess', False))
+        self.settings.endGroup()
+        if enabled and self.process_pool is None:
+            self.process_pool = workers.ProcessPool('pixiv', self.glovar.session, self.glovar.proxy,
+                                                    self.controller.upper)
+
+    def close_process_pool(self):
+        if self.process_pool:
+            self.process_pool.shutdown()
+            self.process_pool = None
+
+    def apply_level(self):
+        """Size the thread pool by the concurrency controller, and show it."""
+        self.thread_pool.setMaxThreadCount(self.controller.level)
+        self.lbl_level.setText('并发数：{0}/{1}'.format(self.controller.level, self.controller.upper))
+
+    def change_concurrency(self, lower: int, upper: int):
+        """Change bounds of download concurrency in setting."""
+        self.controller.set_bounds(lower, upper)
+        self.apply_level()
 
     def search_pic(self):
         path = QFileDialog.getOpenFileName(self, '选择图片', os.path.abspath('.'), '图片文件(*.gif *.jpg *.png *.bmp)')
@@ -664,8 +1147,11 @@ class MainWidget(QWidget):
                 self.cancel_download()
                 self.fetch_thread.exit(-1)
                 self.sauce_thread.exit(-1)
-                self.thumb_thread.exit(-1)
+                self.prefetcher.stop()
+                self.table_proxy.wait()
+                self.refresh_thread.wait()
                 self.thread_pool.waitForDone()  # Close all threads before logout
+                self.close_process_pool()
                 self.logout_sig.emit('pixiv')
                 return True
             else:
@@ -674,8 +1160,11 @@ class MainWidget(QWidget):
         else:
             self.fetch_thread.exit(-1)
             self.sauce_thread.exit(-1)
-            self.thumb_thread.exit(-1)
+            self.prefetcher.stop()
+            self.table_proxy.wait()
+            self.refresh_thread.wait()
             self.thread_pool.waitForDone()
+            self.close_process_pool()
             self.logout_sig.emit('pixiv')
             return True
 
@@ -0,0 +1,179 @@
+# coding:utf-8
+"""Disk cache of thumbnails shared by all tabs."""
+import hashlib
+import os
+import threading
+from urllib.parse import urlsplit
+
+from modules import transfer
+
+_FOLDER = 'thumbnails'
+CAP = 200 * 1000 * 1000  # Bytes
+_LOW_WATER = 0.9  # Evict down to this part of the cap, so eviction does not run on every store
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class ThumbCache(object):
+    """
+    Thumbnails stored in one folder, named by the SHA-1 of their url.
+    Reading a thumbnail refreshes its modified time, and when the folder grows
+    over the cap the least recently used ones are removed.
+    """
+
+    def __init__(self, folder: str = _FOLDER, cap: int = CAP):
+        """
+        Args:
+            folder: Folder of the cache, created on first store.
+            cap: Size limit in bytes.
+        """
+        self._folder = os.path.abspath(folder)
+        self._cap = cap
+        self._lock = threading.Lock()
+        self._sizes = None  # {path: size}, scanned on first store
+        self._total = 0
+
+    def path(self, url: str) -> str:
+        """Path of the cached thumbnail of url, whether it exists or not."""
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        ext = os.path.splitext(urlsplit(url).path)[1]
+        return os.path.join(self._folder, digest[:2], digest + ext)  # Fan out, keeping folders small
+
+    def get(self, url: str) -> str:
+        """
+        Look up a thumbnail and mark it as recently used.
+        Return:
+            Path of the cached thumbnail, '' if not cached.
+        """
+        path = self.path(url)
+        try:
+            os.utime(path)
+        except OSError:
+            return ''
+        return path
+
+    def fetch(self, se, url: str, headers: dict = None, proxy: dict = None, timeout=5) -> str:
+        """
+        Return the cached thumbnail of url, downloading it on a miss.
+        Exceptions of requests and OSError are raised.
+        """
+        path = self.get(url)
+        if path:
+            return path
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = '{0}.{1}.part'.format(path, threading.get_ident())  # Threads missing the same url write apart
+        try:
+            with se.get(url, headers=headers, proxies=proxy, stream=True, timeout=timeout) as res:
+                res.raise_for_status()  # Never cache an error page
+                with open(part, 'wb') as thumb:
+                    stats = transfer.write_stream(res, thumb)
+            os.replace(part, path)
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        self._stored(path, stats.size)
+        return path
+
+    def _scan(self):
+        """Sizes of cached files, read once. Hold the lock."""
+        if self._sizes is None:
+            self._sizes = dict()
+            try:
+                subs = [entry.path for entry in os.scandir(self._folder) if entry.is_dir()]
+            except OSError:
+                subs = []
+            for sub in subs:
+                for entry in os.scandir(sub):
+                    if entry.is_file() and not entry.name.endswith('.part'):
+                        self._sizes[entry.path] = entry.stat().st_size
+            self._total = sum(self._sizes.values())
+
+    def _stored(self, path: str, size: int):
+        with self._lock:
+            self._scan()
+            self._total += size - self._sizes.get(path, 0)
+            self._sizes[path] = size
+            if self._total > self._cap:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used files until under the low water mark. Hold the lock."""
+        def mtime(path):
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return 0
+
+        for path in sorted(self._sizes, key=mtime):
+            if self._total <= self._cap * _LOW_WATER:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._total -= self._sizes.pop(path)
+
+    def set_cap(self, cap: int):
+        """Change the size limit in bytes, evicting at once if needed."""
+        with self._lock:
+            self._cap = cap
+            if self._sizes is not None and self._total > self._cap:
+                self._evict()
+
+    def usage(self) -> tuple:
+        """Return (number of files, total bytes)."""
+        with self._lock:
+            self._scan()
+            return len(self._sizes), self._total
+
+
+def get() -> ThumbCache:
+    """Get the shared ThumbCache instance."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ThumbCache()
+    return _cache
+
+
+if __name__ == '__main__':  # Thumbnail reselected: temp file download per selection versus cache hit
+    import tempfile
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from tempfile import NamedTemporaryFile
+
+    import requests
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = b'\xff' * 30000  # A typical thumbnail
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    bench_server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=bench_server.serve_forever, daemon=True).start()
+    bench_urls = ['http://127.0.0.1:{0}/t/{1}.jpg'.format(bench_server.server_port, i) for i in range(20)] * 10
+    bench_se = requests.Session()
+    bench_cache = ThumbCache(os.path.join(tempfile.mkdtemp(prefix='PETSpider_'), _FOLDER), 1000000)
+
+    begin = time.perf_counter()
+    for bench_url in bench_urls:
+        with bench_se.get(bench_url, stream=True) as bench_res:
+            with NamedTemporaryFile('w+b', prefix='PETSpider_') as bench_file:
+                transfer.write_stream(bench_res, bench_file)
+    print('download per selection: {0:.2f} ms'.format((time.perf_counter() - begin) / len(bench_urls) * 1e3))
+    begin = time.perf_counter()
+    for bench_url in bench_urls:
+        bench_cache.fetch(bench_se, bench_url)
+    print('cached:                 {0:.2f} ms'.format((time.perf_counter() - begin) / len(bench_urls) * 1e3))
+    print('files, bytes: {0}'.format(bench_cache.usage()))
+    bench_server.shutdown()
@@ -0,0 +1,514 @@
+# coding:utf-8
+"""Network transfer helpers shared by site modules."""
+import hashlib
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, suppress
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+
+_BUFFER_SIZE = 1024 * 1024  # Bytes read per call when streaming a response body
+_buffers = threading.local()  # Reusable read buffer of every thread
+_RE_RANGE = re.compile(r'bytes (\d+)-')
+_PROBE_WINDOWS = 8  # Windows without improvement before ConcurrencyController tries one more worker
+
+
+class IncompleteDownloadError(requests.exceptions.ConnectionError):
+    """Exception for a transfer ending before Content-Length bytes are received. The .part file is kept."""
+
+
+class HostLimiter(object):
+    """Limit the number of concurrent requests sent to each host. Shared by threads."""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, host: str):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self._limit)
+            return self._semaphores[host]
+
+    @contextmanager
+    def hold(self, url: str):
+        """Block until the host of url has a free slot, release it on leaving."""
+        semaphore = self._semaphore(urlsplit(url).hostname or '')
+        with semaphore:
+            yield
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at rate per second up to burst. Shared by threads.
+    A taker reserves its tokens at once and sleeps off the debt, so takers
+    are served in order and amounts bigger than burst are allowed.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self._lock = threading.Lock()
+        self.total = (rate, burst)  # Budget before share()
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def share(self, parts: int):
+        """Keep 1/parts of the budget given at creation."""
+        with self._lock:
+            self.rate = self.total[0] / parts
+            self.burst = max(self.total[1] / parts, 1)
+
+    def take(self, amount: float = 1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate) - amount
+            self._stamp = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    Process-wide pacing of requests and of body bytes, by host suffix.
+    Hosts configured together share one bucket, as sites ban by IP, not by host.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules = {'request': {}, 'bytes': {}}  # {kind: {host suffix: TokenBucket}}
+        self._cache = {}  # {(kind, host): TokenBucket or None}
+        self._parts = {}  # {(kind, host): processes sharing its budget}, set by split()
+
+    def configure(self, kind: str, hosts, rate: float, burst: float):
+        """
+        Set the budget of hosts.
+        Args:
+            kind: 'request' for requests sent, 'bytes' for body bytes received.
+            hosts: Host suffixes sharing the budget, like 'exhentai.org'.
+            rate: Tokens per second, 0 for no limit.
+            burst: Tokens allowed at once after idling.
+        """
+        bucket = TokenBucket(rate, burst) if rate > 0 else None
+        with self._lock:
+            if bucket:  # Still shared with processes running
+                bucket.share(max(self._parts.get((kind, host), 1) for host in hosts))
+            for host in hosts:
+                if bucket:
+                    self._rules[kind][host] = bucket
+                else:
+                    self._rules[kind].pop(host, None)
+            self._cache = {}
+
+    def split(self, parts: int, hosts: dict = None) -> list:
+        """
+        Divide budgets among this process and parts - 1 others, so that their sum
+        stays the same. This process keeps one part until split(1, hosts).
+        Args:
+            parts: Number of processes sharing, this one included.
+            hosts: (optional) {kind: host suffixes} of the budgets divided, like
+                RATE_HOSTS of a site. Default all.
+        Return:
+            A list of tuples, the arguments of configure() in every other process.
+        """
+        with self._lock:
+            groups = {}
+            for kind, rules in self._rules.items():
+                for host, bucket in rules.items():
+                    if hosts is None or host in hosts.get(kind, ()):
+                        groups.setdefault((kind, id(bucket)), (bucket, []))[1].append(host)
+            for kind, suffixes in (hosts or {}).items():  # Budgets configured later are divided too
+                self._parts.update(((kind, host), parts) for host in suffixes)
+            for (kind, _), (bucket, suffixes) in groups.items():
+                self._parts.update(((kind, host), parts) for host in suffixes)
+                bucket.share(parts)
+        return [(kind, tuple(suffixes), bucket.total[0] / parts, bucket.total[1] / parts)
+                for (kind, _), (bucket, suffixes) in groups.items()]
+
+    def bucket(self, kind: str, url: str):
+        """Return the TokenBucket of url, or None if it is not limited."""
+        host = urlsplit(url).hostname or ''
+        try:
+            return self._cache[kind, host]
+        except KeyError:
+            pass
+        with self._lock:
+            rules = self._rules[kind]
+            matches = [suffix for suffix in rules if host == suffix or host.endswith('.' + suffix)]
+            bucket = rules[max(matches, key=len)] if matches else None
+            self._cache[kind, host] = bucket
+            return bucket
+
+    def wait_request(self, url: str):
+        """Block until a request to url is allowed."""
+        bucket = self.bucket('request', url)
+        if bucket:
+            bucket.take()
+
+    def wait_bytes(self, url: str, size: int):
+        """Block until size bytes from url are allowed."""
+        bucket = self.bucket('bytes', url)
+        if bucket:
+            bucket.take(size)
+
+
+rate_limiter = RateLimiter()  # Shared by all sessions
+
+
+class PoolAdapter(HTTPAdapter):
+    """HTTPAdapter pacing requests by rate_limiter, and reporting how well its pooled connections are reused."""
+
+    def send(self, request, **kwargs):
+        rate_limiter.wait_request(request.url)
+        return super().send(request, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Connection statistics of every pool, proxied ones included.
+        Return:
+            A dictionary. {host: (connections opened, requests sent)}
+        """
+        result = {}
+        for manager in [self.poolmanager] + list(self.proxy_manager.values()):
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:  # Evicted meanwhile
+                    continue
+                host = getattr(pool, '_tunnel_host', None) or pool.host
+                opened, sent = result.get(host, (0, 0))
+                result[host] = (opened + pool.num_connections, sent + pool.num_requests)
+        return result
+
+
+def mount_pools(se, pools: dict, default_size: int, max_retries=0):
+    """
+    Mount a PoolAdapter on session for every url prefix, replacing old ones.
+    Sized pools block when all connections are busy instead of opening
+    throwaway ones, so keep each size at least the concurrency of its host.
+    Args:
+        se: Session instance.
+        pools: A dictionary. {url prefix: pool size}
+        default_size: Pool size of any other host, which never blocks.
+        max_retries: (Optional) Retry configuration, the same as HTTPAdapter.
+    """
+    for prefix, size in pools.items():
+        _replace_adapter(se, prefix, size, True, max_retries)
+    _replace_adapter(se, ('http://', 'https://'), default_size, False, max_retries)
+
+
+def _replace_adapter(se, prefixes, size: int, block: bool, max_retries):
+    """Mount a new adapter on prefixes unless the mounted one is sized the same already."""
+    prefixes = (prefixes,) if isinstance(prefixes, str) else prefixes
+    olds = {se.adapters.get(prefix) for prefix in prefixes}
+    if all(isinstance(old, PoolAdapter) and old._pool_maxsize == size and old._pool_block == block for old in olds):
+        return  # Keep connections in use
+    adapter = PoolAdapter(pool_maxsize=size, pool_block=block, max_retries=max_retries)
+    for prefix in prefixes:
+        se.mount(prefix, adapter)
+    mounted = list(se.adapters.values())
+    for old in olds:
+        if old is not None and old not in mounted:
+            old.close()
+
+
+def pool_report(se) -> str:
+    """Connection reuse of every host of session, for logging."""
+    stats = {}
+    for adapter in set(se.adapters.values()):  # One adapter may be mounted on several prefixes
+        if isinstance(adapter, PoolAdapter):
+            for host, (opened, sent) in adapter.stats().items():
+                old_opened, old_sent = stats.get(host, (0, 0))
+                stats[host] = (old_opened + opened, old_sent + sent)
+    return ', '.join('{0}: {1} requests on {2} connections'.format(host, sent, opened)
+                     for host, (opened, sent) in sorted(stats.items()))
+
+
+class TransferStats(object):
+    """Size and duration of one transfer, and SHA-1 and path of the whole file if it is saved to disk."""
+
+    def __init__(self, size: int, seconds: float, digest: str = '', path: str = ''):
+        self.size = size
+        self.seconds = seconds
+        self.digest = digest
+        self.path = path
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second."""
+        return self.size / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return '{0:.2f} MB in {1:.2f} s, {2:.2f} MB/s'.format(self.size / 1e6, self.seconds, self.rate / 1e6)
+
+
+class ConcurrencyController(object):
+    """
+    AIMD controller of the download concurrency of one site. Shared by threads.
+    After every window of as many finished transfers as the current level,
+    the level grows by one if the summed throughput beats the best seen,
+    and halves if latency has doubled without more throughput. A level held
+    for several windows is probed with one more worker, kept only if the
+    throughput grows, in case the link got faster. Any
+    connection error halves it at once, and a ban drops it to the lower bound.
+    """
+
+    def __init__(self, lower: int, upper: int):
+        self._lock = threading.Lock()
+        self._lower = self._upper = self._level = 1
+        self._window = []  # TransferStats of current window
+        self._best_rate = 0.0  # Best summed throughput of a window
+        self._base_latency = 0.0  # Lowest median duration of a window
+        self._holds = 0  # Windows without improvement since the last increase
+        self._probing = False  # The last increase is a probe
+        self._skip = 0  # Transfers started before the last decrease, which say nothing of the new level
+        self.set_bounds(lower, upper)
+        self._level = self._lower
+
+    @property
+    def level(self) -> int:
+        return self._level
+
+    @property
+    def upper(self) -> int:
+        return self._upper
+
+    def set_bounds(self, lower: int, upper: int):
+        with self._lock:
+            self._lower = max(1, min(lower, upper))
+            self._upper = max(self._lower, upper)
+            self._level = min(max(self._level, self._lower), self._upper)
+
+    def success(self, stats: TransferStats):
+        """Record a finished transfer."""
+        with self._lock:
+            if self._skip:
+                self._skip -= 1
+                return
+            self._window.append(stats)
+            if len(self._window) < self._level:
+                return
+            window, self._window = self._window, []
+            latency = sorted(item.seconds for item in window)[len(window) // 2]
+            rate = sum(item.rate for item in window)
+            if not self._base_latency or latency < self._base_latency:
+                self._base_latency = latency
+            if latency > 2 * self._base_latency and rate < self._best_rate:  # Queued somewhere, not faster
+                self._decrease(self._level // 2)
+            elif rate > 1.05 * self._best_rate:  # More workers paid off
+                self._best_rate = rate
+                self._holds = 0
+                self._probing = False
+                self._level = min(self._level + 1, self._upper)
+            elif self._probing:  # The probe did not pay off, step back
+                self._probing = False
+                self._level = max(self._level - 1, self._lower)
+            elif self._holds >= _PROBE_WINDOWS and self._level < self._upper:
+                self._holds = 0
+                self._probing = True
+                self._level = min(self._level + 1, self._upper)
+            else:  # Link is saturated, more workers would only queue
+                self._holds += 1
+
+    def failure(self):
+        """Record a connection error or timeout."""
+        with self._lock:
+            if not self._skip:  # Errors of the same burst count once
+                self._decrease(self._level // 2)
+
+    def ban(self):
+        """Record a ban or throttling response."""
+        with self._lock:
+            self._decrease(self._lower)
+
+    def _decrease(self, level: int):
+        self._skip = self._level - 1
+        self._level = max(level, self._lower)
+        self._window = []
+        self._best_rate = 0.0  # Conditions changed, measure again
+        self._base_latency = 0.0
+        self._holds = 0
+        self._probing = False
+
+
+def _buffer(size: int) -> memoryview:
+    view = getattr(_buffers, 'view', None)
+    if view is None or len(view) != size:
+        view = _buffers.view = memoryview(bytearray(size))
+    return view
+
+
+def write_stream(res, fileobj, buffer_size: int = _BUFFER_SIZE, digest=None) -> TransferStats:
+    """
+    Copy the body of a streamed response into a file object.
+    Data is read into a reusable per-thread buffer and written through
+    a memoryview slice, so no bytes object is created on our side per chunk.
+    Body bytes are paced by rate_limiter.
+    Args:
+        res: A response of requests, opened with stream=True.
+        fileobj: A binary file object opened for writing.
+        buffer_size: (Optional) Bytes read per call.
+        digest: (Optional) A hashlib object updated with every chunk written.
+    Return:
+        A TransferStats instance.
+    """
+    raw = res.raw
+    raw.decode_content = True  # Undo gzip/deflate like iter_content() does
+    bytes_bucket = rate_limiter.bucket('bytes', res.url)
+    view = _buffer(buffer_size)
+    size = 0
+    begin = time.perf_counter()
+    try:  # Raise the same exceptions as iter_content() does
+        while True:
+            n = raw.readinto(view)
+            if not n:
+                break
+            fileobj.write(view[:n])
+            if bytes_bucket:
+                bytes_bucket.take(n)
+            if digest:
+                digest.update(view[:n])
+            size += n
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except SSLError as e:
+        raise requests.exceptions.SSLError(e)
+    return TransferStats(size, time.perf_counter() - begin)
+
+
+def _identity(res) -> bool:
+    """Whether the body is sent as is, so its length and byte ranges match the file."""
+    return res.headers.get('Content-Encoding', 'identity') == 'identity'
+
+
+def _save(res, path: str, offset: int) -> TransferStats:
+    """Write res into path.part from offset, check its size and move it to path."""
+    part = path + '.part'
+    if res.status_code == 416:  # The partial file is not valid for server, start again next time
+        with suppress(FileNotFoundError):  # Another thread of the same file may have removed it
+            os.remove(part)
+        raise IncompleteDownloadError('Range not satisfiable: ' + path)
+    res.raise_for_status()
+    match = _RE_RANGE.match(res.headers.get('Content-Range', ''))
+    if res.status_code != 206 or not match or int(match.group(1)) != offset:
+        offset = 0  # Server sends the whole file
+    length = res.headers.get('Content-Length')
+    expected = offset + int(length) if length and _identity(res) else None
+
+    digest = hashlib.sha1()
+    if offset:  # Hash the part received before
+        with open(part, 'rb') as data:
+            view = _buffer(_BUFFER_SIZE)
+            for n in iter(lambda: data.readinto(view), 0):
+                digest.update(view[:n])
+    with open(part, 'ab' if offset else 'wb') as data:
+        stats = write_stream(res, data, digest=digest)
+    stats.digest = digest.hexdigest()
+    stats.path = path
+    if expected is not None and offset + stats.size != expected:
+        raise IncompleteDownloadError('Received {0} of {1} bytes: {2}'.format(offset + stats.size, expected, path))
+    os.replace(part, path)  # Only complete files get the final name
+    return stats
+
+
+def save_response(se, res, path: str, headers: dict = None, proxy: dict = None, timeout=5) -> TransferStats:
+    """
+    Save an opened streamed response to path atomically.
+    If a .part file is left by an interrupted transfer and the server
+    accepts byte ranges, the rest is requested from res.url instead.
+    Args:
+        se: Session instance.
+        res: A response of requests, opened with stream=True, without Range.
+        path: Path of the file to write.
+        headers: (Optional) Request headers used for resuming.
+        proxy: (Optional) The proxy used.
+        timeout: (Optional) Timeout of connecting and every read.
+    Return:
+        A TransferStats instance of this transfer.
+    """
+    part = path + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset and res.status_code == 200 and res.headers.get('Accept-Ranges') == 'bytes' and _identity(res):
+        res.close()
+        ranged = dict(headers or {}, Range='bytes={0}-'.format(offset))
+        with se.get(res.url,
+                    headers=ranged,
+                    proxies=proxy,
+                    stream=True,
+                    timeout=timeout) as resumed:
+            return _save(resumed, path, offset)
+    return _save(res, path, 0)
+
+
+def download_file(se, url: str, path: str, headers: dict = None, proxy: dict = None, timeout=5) -> TransferStats:
+    """
+    Stream url into a file atomically. Data goes to path.part first and is
+    renamed to path after its size is checked against Content-Length. An
+    existing .part file is resumed with a Range request.
+    Args:
+        se: Session instance.
+        url: Address of the file.
+        path: Path of the file to write.
+        headers: (Optional) Request headers.
+        proxy: (Optional) The proxy used.
+        timeout: (Optional) Timeout of connecting and every read.
+    Return:
+        A TransferStats instance of this transfer.
+    Exceptions:
+        IncompleteDownloadError: Raised when the transfer is cut, call it again to resume.
+        requests.HTTPError: Raised when server responds an error status.
+    """
+    part = path + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        headers = dict(headers or {}, Range='bytes={0}-'.format(offset))
+    with se.get(url,
+                headers=headers,
+                proxies=proxy,
+                stream=True,
+                timeout=timeout) as res:
+        return _save(res, path, offset)
+
+
+if __name__ == '__main__':  # Benchmark against a local HTTP server, iter_content() versus write_stream()
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    payload = os.urandom(4 * 1024 * 1024)  # iter_content() takes minutes on bigger files
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    bench_url = 'http://127.0.0.1:{0}/pic.jpg'.format(server.server_port)
+    bench_path = os.path.join(tempfile.mkdtemp(prefix='PETSpider_'), 'pic.jpg')
+    bench_se = requests.Session()
+
+    begin = time.perf_counter()
+    with bench_se.get(bench_url, stream=True) as bench_res:
+        with open(bench_path, 'wb') as bench_file:
+            for chunk in bench_res.iter_content():
+                bench_file.write(chunk)
+    old = time.perf_counter() - begin
+    print('iter_content():', TransferStats(len(payload), old))
+    print('write_stream(): ', download_file(bench_se, bench_url, bench_path))
+    os.remove(bench_path)
+    server.shutdown()
@@ -0,0 +1,175 @@
+# coding:utf-8
+"""Process pool mode. Downloads and page parsing run in worker processes, each with its own session."""
+import multiprocessing
+import threading
+from concurrent.futures import BrokenExecutor, CancelledError, ProcessPoolExecutor
+
+import requests
+from urllib3 import Retry
+
+from modules import ehentai, library, pixiv, transfer
+
+_session = None  # Session of this worker process
+_proxy = {}
+
+
+def cookies_of(se) -> list:
+    """Cookies of a session as picklable tuples. (name, value, domain, path)"""
+    return [(cookie.name, cookie.value, cookie.domain, cookie.path) for cookie in se.cookies]
+
+
+def _init(tab: str, cookies: list, headers: dict, proxy: dict, limits: list):
+    """Initializer of worker processes, logging in by cookies of the GUI."""
+    global _session, _proxy
+    site = pixiv if tab == 'pixiv' else ehentai
+    _session = requests.Session()
+    transfer.mount_pools(_session, site.pools(1), 2, Retry(total=3, backoff_factor=0.2))  # One task at a time
+    _session.headers.update(headers)
+    for name, value, domain, path in cookies:
+        _session.cookies.set(name, value, domain=domain, path=path)
+    _proxy = proxy
+    for args in limits:
+        transfer.rate_limiter.configure(*args)
+
+
+def _call(fn, *args):
+    """Call fn with the session of this process, and make exceptions picklable."""
+    try:
+        return fn(_session, _proxy, *args)
+    except requests.exceptions.RequestException as e:  # Holding connection pools, which cannot be pickled
+        error = type(e)(repr(e))
+        if e.response is not None:
+            error.response = requests.Response()
+            error.response.status_code = e.response.status_code
+        raise error from None
+
+
+def _compact(stats):
+    return stats and (stats.size, stats.seconds, stats.digest, stats.path)
+
+
+def _download_pic(item: dict, path: tuple, page: int):
+    return _compact(_call(pixiv.download_pic, item, path, page))
+
+
+def _download(info: dict, keys: dict, page: int, path: str, rename, rewrite):
+    return _compact(_call(ehentai.download, info, keys, page, path, rename, rewrite))
+
+
+def _imgkeys(info: dict, p: int) -> dict:
+    return _call(ehentai.fetch_imgkeys, info, p)
+
+
+def _showkey(info: dict, imgkey: str) -> str:
+    return _call(ehentai.fetch_showkey, info, imgkey)
+
+
+class PoolStoppedError(Exception):
+    """The pool was shut down, or a worker process died, before a task finished."""
+
+
+class ProcessPool(object):
+    """
+    Worker processes logged in with cookies of one session. Threads of the GUI
+    submit to it and wait, so only arguments and small result tuples cross the
+    process boundary, while parsing, hashing and file writing use other cores.
+    Rate limits of the site are divided among the workers and this process,
+    which still resolves urls, until shutdown().
+    """
+
+    def __init__(self, tab: str, se, proxy: dict, processes: int):
+        """
+        Args:
+            tab: 'pixiv' or 'ehentai'.
+            se: The logged in session whose cookies and headers are copied.
+            proxy: The proxy used.
+            processes: Number of worker processes, one for each concurrent download.
+        """
+        self.processes = processes
+        self.closed = False  # Shut down on purpose, PoolStoppedError is no failure then
+        self._session = se
+        self._proxy = proxy
+        self._hosts = (pixiv if tab == 'pixiv' else ehentai).RATE_HOSTS
+        self._executor = ProcessPoolExecutor(processes,
+                                             mp_context=multiprocessing.get_context('spawn'),  # No fork of Qt
+                                             initializer=_init,
+                                             initargs=(tab, cookies_of(se), dict(se.headers), proxy,
+                                                       transfer.rate_limiter.split(processes + 1, self._hosts)))
+
+    def download_pic(self, item: dict, path: tuple, page: int):
+        """pixiv.download_pic() in a worker process."""
+        if not item['url']:  # Resolved once here, a worker's copy of item would be lost with every page
+            pixiv.resolve_url(self._session, item, self._proxy)
+        return self._stats(self._wait(self._submit(_download_pic, item, path, page)))
+
+    def download(self, info: dict, keys: dict, page: int, path: str, rename=False, rewrite=False):
+        """ehentai.download() in a worker process."""
+        result = self._wait(self._submit(_download, info, keys, page, path, bool(rename), bool(rewrite)))
+        return self._stats(result, ehentai.page_key(info['addr'].split('/')[-3], page))
+
+    def fetch_keys(self, info: dict) -> dict:
+        """ehentai.fetch_keys(), with thumbnail pages fetched and parsed by all workers."""
+        keys = dict()
+        for future in [self._submit(_imgkeys, info, p) for p in range(ehentai.key_pages(info))]:
+            keys.update(self._wait(future))
+        keys['0'] = self._wait(self._submit(_showkey, info, keys['1']))
+        return keys
+
+    def _submit(self, fn, *args):
+        try:
+            return self._executor.submit(fn, *args)
+        except RuntimeError as e:  # Shut down, or broken
+            raise PoolStoppedError(repr(e)) from None
+
+    @staticmethod
+    def _wait(future):
+        """Result of a task. Exceptions raised by the task itself are passed on."""
+        try:
+            return future.result()
+        except (BrokenExecutor, CancelledError) as e:
+            raise PoolStoppedError(repr(e)) from None
+
+    @staticmethod
+    def _stats(result, key: str = None):
+        """Index the file saved by a worker in library of this process, and rebuild its TransferStats."""
+        if not result:
+            return None
+        size, seconds, digest, path = result
+        library.get().learn(path, key)
+        return transfer.TransferStats(size, seconds, digest, path)
+
+    def shutdown(self, wait: bool = False):
+        """
+        Stop workers after their current tasks. Tasks submitted later raise
+        PoolStoppedError, which threads still running should catch.
+        """
+        closing, self.closed = not self.closed, True
+        self._executor.shutdown(wait=wait)
+        if closing:  # Whole budget back to this process once workers have stopped sending
+            if wait:
+                self._release()
+            else:
+                threading.Thread(target=self._release, daemon=True).start()
+
+    def _release(self):
+        self._executor.shutdown(wait=True)
+        transfer.rate_limiter.split(1, self._hosts)
+
+
+if __name__ == '__main__':  # Parse cost of thumbnail pages over threads and over processes
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    bench_page = ''.join(['<html><head><title>g</title></head><body><div id="gdt">'] +
+                         ['<div class="gdtm"><div style="margin:1px"><a href="https://exhentai.org/s/{0:010x}/1-{1}">'
+                          '<img alt="{1}" title="Page {1}" src="https://exhentai.org/t/{0:010x}.jpg"></a></div></div>'
+                          .format(i * 7919, i) for i in range(1, 41)] +
+                         ['<p>{0}</p>'.format('x' * 80) for _ in range(2000)] + ['</div></body></html>'])
+    bench_pages = [bench_page] * 64  # A gallery of 2560 pictures
+    for bench_workers in (1, 4):
+        for bench_name, bench_cls in (('threads', ThreadPoolExecutor), ('processes', ProcessPoolExecutor)):
+            with bench_cls(bench_workers) as bench_executor:
+                list(bench_executor.map(ehentai.parse_imgkeys, bench_pages[:bench_workers]))  # Warm up
+                begin = time.perf_counter()
+                parsed = list(bench_executor.map(ehentai.parse_imgkeys, bench_pages))
+                print('{0} {1}: {2:.3f} s'.format(bench_workers, bench_name, time.perf_counter() - begin))
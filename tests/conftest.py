@@ -0,0 +1,11 @@
+# coding:utf-8
+import pytest
+
+from modules import database
+
+
+@pytest.fixture(autouse=True)
+def close_databases():
+    """Close databases opened by a test, so its temp directory can be removed."""
+    yield
+    database.close_all()
@@ -0,0 +1,57 @@
+# coding:utf-8
+"""Stand-ins of requests sessions, answering from a handler instead of the network."""
+import io
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class FakeRaw(object):
+    """Body of a streamed response, read by transfer.write_stream()."""
+
+    def __init__(self, body: bytes):
+        self._data = io.BytesIO(body)
+        self.decode_content = False
+
+    def readinto(self, buffer) -> int:
+        return self._data.readinto(buffer)
+
+
+class FakeResponse(object):
+    def __init__(self, url: str, status_code: int = 200, body: bytes = b'', headers: dict = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.raw = FakeRaw(body)
+        self.text = body.decode('utf-8', 'replace')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{0} for {1}'.format(self.status_code, self.url), response=self)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FakeSession(object):
+    """
+    Answer get() by handler(url, headers, params), which returns a FakeResponse.
+    Every request is recorded in requests as a tuple of (url, headers, params).
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.headers = {}
+
+    def get(self, url: str, headers: dict = None, params: dict = None, **kwargs) -> FakeResponse:
+        headers = dict(headers or {})
+        params = dict(params or {})
+        self.requests.append((url, headers, params))
+        return self.handler(url, headers, params)
@@ -0,0 +1,113 @@
+# coding:utf-8
+import pytest
+
+from modules import jobs
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return jobs.JobQueue(str(tmp_path / 'jobs.db'), max_attempts=3)
+
+
+def test_add_returns_unfinished_job_of_same_target(queue):
+    job = queue.add('pixiv', '100', data={}, pages=[0])
+    assert queue.add('pixiv', '100', data={}, pages=[0, 1]) == job
+    assert len(queue.claim_pages('a', ['pixiv'], limit=10)) == 2
+
+
+def test_leased_pages_are_not_claimed_twice(queue):
+    queue.add('pixiv', '100', data={'illustId': '100'}, pages=[0, 1, 2])
+    first = queue.claim_pages('a', ['pixiv'], limit=2)
+    assert [item['page'] for item in first] == [0, 1]
+    assert first[0]['data'] == {'illustId': '100'}
+    assert [item['page'] for item in queue.claim_pages('b', ['pixiv'], limit=10)] == [2]
+    assert queue.claim_pages('c', ['pixiv'], limit=10) == []
+    assert queue.claim_pages('c', ['ehentai'], limit=10) == []
+
+
+def test_expired_lease_is_claimable_again(queue):
+    queue.add('pixiv', '100', data={}, pages=[0])
+    assert queue.claim_pages('a', ['pixiv'], lease=0)
+    assert [item['page'] for item in queue.claim_pages('b', ['pixiv'])] == [0]
+
+
+def test_renew_keeps_lease(queue):
+    queue.add('pixiv', '100', data={}, pages=[0])
+    queue.claim_pages('a', ['pixiv'], lease=0)
+    queue.renew('a')
+    assert queue.claim_pages('b', ['pixiv']) == []
+
+
+def test_release_gives_leases_back(queue):
+    queue.add('pixiv', '100', data={}, pages=[0])
+    queue.claim_pages('a', ['pixiv'])
+    queue.release('a')
+    assert queue.claim_pages('b', ['pixiv'])
+
+
+def test_backoff_doubles_up_to_limit():
+    assert [jobs.backoff(n) for n in (1, 2, 3)] == [15, 30, 60]
+    assert jobs.backoff(100) == 1800
+
+
+def test_failed_page_waits_for_backoff(queue):
+    job = queue.add('pixiv', '100', data={}, pages=[0])
+    queue.claim_pages('a', ['pixiv'])
+    assert queue.fail_page(job, 0, 'timeout') == 1
+    assert queue.claim_pages('a', ['pixiv']) == []
+    assert queue.summary()['pages'] == {jobs.PENDING: 1}
+
+
+def test_page_fails_after_max_attempts(queue):
+    job = queue.add('pixiv', '100', data={}, pages=[0, 1])
+    queue.finish_page(job, 1)
+    for attempts in range(1, 4):
+        assert queue.fail_page(job, 0, 'timeout') == attempts
+    assert queue.summary() == {'jobs': {jobs.FAILED: 1}, 'pages': {jobs.DONE: 1, jobs.FAILED: 1}}
+    assert queue.idle()
+    assert queue.retry_failed() == 1
+    assert queue.summary()['jobs'] == {jobs.READY: 1}
+    assert [item['page'] for item in queue.claim_pages('a', ['pixiv'])] == [0]
+
+
+def test_postpone_does_not_count_attempt(queue):
+    job = queue.add('pixiv', '100', data={}, pages=[0])
+    queue.claim_pages('a', ['pixiv'])
+    queue.postpone(job, 0, 0)
+    assert queue.claim_pages('a', ['pixiv'])[0]['attempts'] == 0
+
+
+def test_job_is_done_with_its_last_page(queue):
+    job = queue.add('pixiv', '100', data={}, pages=[0, 1])
+    queue.finish_pages(job, [0])
+    assert not queue.idle()
+    queue.finish_page(job, 1)
+    assert queue.summary()['jobs'] == {jobs.DONE: 1}
+    assert queue.idle()
+
+
+def test_expand_queues_pages_and_children(queue):
+    user = queue.add('pixiv_user', '7', options={'root': '/tmp'})
+    claimed = queue.claim_job('a', ['pixiv_user'])
+    assert claimed['id'] == user and claimed['options'] == {'root': '/tmp'}
+    assert queue.claim_job('b', ['pixiv_user']) is None
+    queue.expand(user, {'userId': '7'}, children=[('pixiv', '1'), ('pixiv', '2')])
+    child = queue.claim_job('a', ['pixiv'])
+    assert child['target'] == '1' and child['options'] == {'root': '/tmp'}
+    queue.expand(child['id'], {'illustId': '1'}, pages=[0, 1])
+    assert [item['page'] for item in queue.claim_pages('a', ['pixiv'], limit=10)] == [0, 1]
+    assert queue.summary()['jobs'] == {jobs.DONE: 1, jobs.READY: 1, jobs.NEW: 1}
+
+
+def test_failed_job_is_retried_after_backoff(queue):
+    job = queue.add('ehentai', 'https://e-hentai.org/g/1/abc/')
+    queue.claim_job('a', ['ehentai'])
+    assert queue.fail_job(job, 'timeout') == 1
+    assert queue.claim_job('a', ['ehentai']) is None
+    assert queue.summary()['jobs'] == {jobs.NEW: 1}
+
+
+def test_gui_jobs_are_not_claimed(queue):
+    job = queue.add('pixiv', '100', data={'illustId': '100'}, pages=[0], source=jobs.GUI)
+    assert queue.claim_pages('a', ['pixiv']) == []
+    assert queue.unfinished('pixiv') == [(job, {'illustId': '100'})]
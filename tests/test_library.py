@@ -0,0 +1,100 @@
+# coding:utf-8
+import os
+
+import pytest
+
+from modules import library
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'user').mkdir(parents=True)
+    for name in ('1_p0.jpg', '1_p1.png', '2_p0.jpg.part'):
+        (root / 'user' / name).write_bytes(name.encode())
+    return str(root)
+
+
+@pytest.fixture
+def lib(tmp_path):
+    return library.Library(str(tmp_path / 'library.db'))
+
+
+def write(path: str, data: bytes) -> str:
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_scan_indexes_files_but_parts(lib, root):
+    lib.scan(root)
+    folder = os.path.join(root, 'user')
+    assert lib.exists(os.path.join(folder, '1_p0.jpg'))
+    assert lib.find_stem(folder, '1_p1') == os.path.join(library._norm(folder), '1_p1.png')
+    assert lib.find_stem(folder, '2_p0') == ''
+    assert not lib.exists(os.path.join(folder, '2_p0.jpg.part'))
+
+
+def test_scanned_root_answers_from_index(lib, root):
+    lib.scan(root)
+    path = os.path.join(root, 'user', '3_p0.jpg')
+    write(path, b'3')  # Written behind the library
+    assert not lib.exists(path)
+    lib.scan(root)
+    assert lib.exists(path)
+
+
+def test_rescan_forgets_removed_files(lib, root):
+    lib.scan(root)
+    path = os.path.join(root, 'user', '1_p0.jpg')
+    os.remove(path)
+    lib.scan(root)
+    assert not lib.exists(path)
+    assert lib.find_stem(os.path.dirname(path), '1_p0') == ''
+
+
+def test_outside_scanned_roots_falls_back_to_disk(lib, tmp_path):
+    path = write(str(tmp_path / 'other.jpg'), b'x')
+    assert lib.exists(path)
+    assert lib.find_stem(str(tmp_path), 'other') == path
+
+
+def test_index_is_loaded_by_scan(tmp_path, root):
+    db_path = str(tmp_path / 'library.db')
+    path = os.path.join(root, 'user', '1_p0.jpg')
+    library.Library(db_path).add(path, 'pixiv:1:0')
+    lib = library.Library(db_path)
+    assert lib.find_key('pixiv:1:0') == library._norm(path)  # Read from library.db before loading
+    lib.scan_async([root]).join()
+    assert lib.find_key('pixiv:1:0') == library._norm(path)
+    assert lib.exists(path)
+
+
+def test_add_links_duplicated_content(lib, tmp_path):
+    first = write(str(tmp_path / 'a.jpg'), b'same' * 100)
+    second = write(str(tmp_path / 'b.jpg'), b'same' * 100)
+    other = write(str(tmp_path / 'c.jpg'), b'diff' * 100)
+    assert lib.add(first, digest=library.file_digest(first)) == 0
+    assert lib.add(other, digest=library.file_digest(other)) == 0
+    assert lib.add(second, digest=library.file_digest(second)) == 400
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, other)
+    assert lib.report() == (1.5, 400)
+
+
+def test_deduplicate_hashes_scanned_files(lib, root):
+    write(os.path.join(root, 'user', '9_p0.jpg'), b'1_p0.jpg')  # Same content as 1_p0.jpg
+    lib.scan(root)
+    assert lib.deduplicate(root) == len(b'1_p0.jpg')
+    assert os.path.samefile(os.path.join(root, 'user', '1_p0.jpg'), os.path.join(root, 'user', '9_p0.jpg'))
+    assert lib.deduplicate(root) == 0
+
+
+def test_ensure_dir_recreates_removed_folder(lib, tmp_path):
+    folder = str(tmp_path / 'new')
+    lib.ensure_dir(folder)
+    os.rmdir(folder)
+    lib.ensure_dir(folder)  # Known to exist, not checked
+    assert not os.path.isdir(folder)
+    lib.ensure_dir(folder, recheck=True)
+    assert os.path.isdir(folder)
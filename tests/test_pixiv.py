@@ -0,0 +1,95 @@
+# coding:utf-8
+import html
+import json
+
+import pytest
+
+from modules import pixiv
+from tests.fakes import FakeResponse, FakeSession
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = pixiv.init_db(str(tmp_path / 'database.db'))
+    if db.path in pixiv._no_fts:
+        pytest.skip('SQLite has no FTS5 trigram tokenizer')
+    return db
+
+
+def item(pid: str, title: str, user: str = 'alice') -> dict:
+    return {'illustId': pid, 'illustTitle': title, 'createDate': '2020-01-01', 'url': '', 'thumb': '',
+            'userId': '7', 'userName': user, 'pageCount': 1}
+
+
+def titles(db, **kwargs) -> list:
+    return sorted(info['illustTitle'] for info in pixiv.fetcher(db=db, **kwargs))
+
+
+def indexed(db, text: str) -> list:
+    """Pids found by the trigram index alone."""
+    return [pid for (pid,) in db.reader.execute('SELECT rowid FROM PIXIV_FTS WHERE PIXIV_FTS MATCH ?',
+                                                (pixiv._phrase(text),))]
+
+
+def test_insert_is_indexed(db):
+    pixiv.pusher([item('1', 'blue sky'), item('2', 'night city', 'bob')], db)
+    assert indexed(db, 'sky') == [1]
+    assert titles(db, pname='*sky*') == ['blue sky']
+    assert titles(db, uname='bo*') == ['night city']  # Too short to be looked up, scanned instead
+
+
+def test_update_replaces_indexed_text(db):
+    pixiv.pusher([item('1', 'blue sky')], db)
+    pixiv.pusher([item('1', 'red moon', 'carol')], db)
+    assert indexed(db, 'sky') == []
+    assert indexed(db, 'moon') == [1]
+    assert indexed(db, 'carol') == [1]
+    assert titles(db, pname='*sky*') == []
+    assert titles(db, pname='*moon*') == ['red moon']
+
+
+def test_delete_removes_indexed_text(db):
+    pixiv.pusher([item('1', 'blue sky'), item('2', 'sky high')], db)
+    with db.writer() as pdb:
+        pdb.execute("DELETE FROM PIXIV WHERE ILLUSTID = '1'")
+    assert indexed(db, 'sky') == [2]
+    assert titles(db, pname='*sky*') == ['sky high']
+
+
+def test_glob_is_checked_after_index(db):
+    pixiv.pusher([item('1', 'blue sky'), item('2', 'sky blue')], db)
+    assert titles(db, pname='blue*') == ['blue sky']
+    assert titles(db, pname='*b?ue s*') == ['blue sky']
+
+
+def new_pages(pages: dict):
+    """A handler of following's new illustration pages, empty after the given ones."""
+    def handler(url, headers, params):
+        ids = pages.get(int(params['p']), [])
+        items = html.escape(json.dumps([{'illustId': pid} for pid in ids]))
+        body = '<div id="js-mount-point-latest-following" data-items="{0}"></div>'.format(items)
+        return FakeResponse(url, 200, body.encode())
+    return handler
+
+
+PAGES = {1: ['130', '129', '128'], 2: ['127', '126', '125'], 3: ['124', '123'], 4: ['122']}
+
+
+def test_iter_new_stops_at_high_water_mark():
+    se = FakeSession(new_pages(PAGES))
+    assert list(pixiv.iter_new(se, since=126, workers=1)) == [['130', '129', '128'], ['127']]
+    assert max(int(params['p']) for _, _, params in se.requests) <= 3  # Older pages are not fetched
+
+
+def test_iter_new_with_mark_and_number():
+    full = {page: [str(1000 - page * 20 + i) for i in range(20, 0, -1)] for page in range(1, 6)}  # 20 per page
+    se = FakeSession(new_pages(full))
+    pages = list(pixiv.iter_new(se, num=25, since=900, workers=2))
+    assert [len(ids) for ids in pages] == [20, 5]
+    assert pages[1] == ['980', '979', '978', '977', '976']
+    assert max(int(params['p']) for _, _, params in se.requests) == 2  # Enough pages for num
+
+
+def test_iter_new_stops_at_empty_page():
+    se = FakeSession(new_pages(PAGES))
+    assert sum(pixiv.iter_new(se, since=0, workers=3), []) == [str(pid) for pid in range(130, 121, -1)]
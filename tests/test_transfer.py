@@ -0,0 +1,166 @@
+# coding:utf-8
+import hashlib
+import os
+
+import pytest
+
+from modules import transfer
+from tests.fakes import FakeResponse, FakeSession
+
+URL = 'https://i.pximg.net/img-original/1_p0.jpg'
+PAYLOAD = bytes(range(256)) * 40
+
+
+def file_server(payload: bytes = PAYLOAD, cut: int = None, ranges: bool = True):
+    """
+    A handler serving payload, honouring Range if ranges.
+    The first response stops after cut bytes of its body, with the full Content-Length.
+    """
+    cuts = [cut]
+
+    def handler(url, headers, params):
+        start = int(headers['Range'][6:-1]) if ranges and 'Range' in headers else 0
+        if start >= len(payload):
+            return FakeResponse(url, 416)
+        body = payload[start:]
+        length = {'Content-Length': str(len(body))}
+        limit = cuts.pop() if cuts else None
+        if limit is not None:
+            body = body[:limit]
+        if start:
+            return FakeResponse(url, 206, body, dict(length, **{
+                'Content-Range': 'bytes {0}-{1}/{2}'.format(start, len(payload) - 1, len(payload))}))
+        return FakeResponse(url, 200, body, dict(length, **{'Accept-Ranges': 'bytes'}))
+    return handler
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / '1_p0.jpg')
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as data:
+        return data.read()
+
+
+def test_download_writes_whole_file(path):
+    stats = transfer.download_file(FakeSession(file_server()), URL, path)
+    assert read(path) == PAYLOAD
+    assert not os.path.exists(path + '.part')
+    assert stats.size == len(PAYLOAD)
+    assert stats.digest == hashlib.sha1(PAYLOAD).hexdigest()
+
+
+def test_cut_transfer_is_kept_and_resumed(path):
+    se = FakeSession(file_server(cut=1000))
+    with pytest.raises(transfer.IncompleteDownloadError):
+        transfer.download_file(se, URL, path)
+    assert not os.path.exists(path)
+    assert os.path.getsize(path + '.part') == 1000
+
+    stats = transfer.download_file(se, URL, path)
+    assert se.requests[-1][1]['Range'] == 'bytes=1000-'
+    assert read(path) == PAYLOAD
+    assert stats.size == len(PAYLOAD) - 1000
+    assert stats.digest == hashlib.sha1(PAYLOAD).hexdigest()  # Of the whole file, not the resumed part
+
+
+def test_server_ignoring_range_restarts(path):
+    with open(path + '.part', 'wb') as data:
+        data.write(b'stale')
+    transfer.download_file(FakeSession(file_server(ranges=False)), URL, path)
+    assert read(path) == PAYLOAD
+
+
+def test_unsatisfiable_range_drops_part(path):
+    with open(path + '.part', 'wb') as data:
+        data.write(PAYLOAD + b'extra')
+    se = FakeSession(file_server())
+    with pytest.raises(transfer.IncompleteDownloadError):
+        transfer.download_file(se, URL, path)
+    assert not os.path.exists(path + '.part')
+    transfer.download_file(se, URL, path)
+    assert read(path) == PAYLOAD
+
+
+def test_unsatisfiable_range_without_part(path):
+    se = FakeSession(lambda url, headers, params: FakeResponse(url, 416))
+    with pytest.raises(transfer.IncompleteDownloadError):
+        transfer.download_file(se, URL, path)
+
+
+def test_save_response_resumes_opened_response(path):
+    with open(path + '.part', 'wb') as data:
+        data.write(PAYLOAD[:300])
+    se = FakeSession(file_server())
+    with se.get(URL) as res:
+        transfer.save_response(se, res, path)
+    assert se.requests[-1][1]['Range'] == 'bytes=300-'
+    assert read(path) == PAYLOAD
+
+
+def test_http_error_keeps_part(path):
+    with open(path + '.part', 'wb') as data:
+        data.write(PAYLOAD[:300])
+    se = FakeSession(lambda url, headers, params: FakeResponse(url, 503))
+    with pytest.raises(transfer.requests.HTTPError):
+        transfer.download_file(se, URL, path)
+    assert os.path.getsize(path + '.part') == 300
+
+
+def window(controller, size: int, seconds: float):
+    """Finish as many transfers as the current level."""
+    for _ in range(controller.level):
+        controller.success(transfer.TransferStats(size, seconds))
+
+
+def test_controller_grows_while_throughput_grows():
+    controller = transfer.ConcurrencyController(1, 3)
+    for level in (2, 3, 3):
+        window(controller, 1000, 1.0)
+        assert controller.level == level
+
+
+def test_controller_halves_on_failure_once_per_burst():
+    controller = transfer.ConcurrencyController(1, 8)
+    for _ in range(3):
+        window(controller, 1000, 1.0)
+    assert controller.level == 4
+    controller.failure()
+    assert controller.level == 2
+    controller.failure()  # Started before the decrease
+    assert controller.level == 2
+
+
+def test_controller_halves_when_latency_doubles():
+    controller = transfer.ConcurrencyController(1, 8)
+    for _ in range(2):
+        window(controller, 1000, 1.0)
+    assert controller.level == 3
+    window(controller, 100, 3.0)
+    assert controller.level == 1
+
+
+def test_controller_holds_then_probes():
+    controller = transfer.ConcurrencyController(1, 8)
+    window(controller, 1000, 1.0)
+    assert controller.level == 2
+    for _ in range(transfer._PROBE_WINDOWS):  # Saturated, no more throughput
+        window(controller, 500, 1.0)
+        assert controller.level == 2
+    window(controller, 500, 1.0)
+    assert controller.level == 3  # Probe
+    window(controller, 1000 / 3, 1.0)
+    assert controller.level == 2  # Not paid off
+
+
+def test_controller_drops_to_lower_bound_on_ban():
+    controller = transfer.ConcurrencyController(2, 8)
+    assert controller.level == 2
+    for _ in range(3):
+        window(controller, 1000, 1.0)
+    controller.ban()
+    assert controller.level == 2
+    controller.set_bounds(1, 1)
+    assert controller.level == 1